@@ -1,33 +1,32 @@
 """
-ASD4ME.py is the main file of the project. It contains the main code for the project, and also has the blueprint
-for the market. The blueprint is registered with the app, and the app is run on the server. This file is where
-database connections are initialized, and where users first interact with the website. The program contains these
-functions:
+ASD4ME.py is the main file of the project. It contains the app factory, which builds the app, binds the extensions and
+registers the blueprint for the market. This file is where database connections are initialized, and where users first
+interact with the website. The program contains these functions:
+        - create_app(): This function builds and configures the app. Gunicorn runs it with "ASD4ME:create_app()" and
+        the flask command finds it automatically.
         - home(): This function renders the index.html template, the homepage of the website
         - login(): This function renders the login.html template, and allows users to log in to the website using forms.
         - logout(): This function logs the user out of the website.
         - signup(): This function renders the signup.html template, allowing users to sign up for the website via forms.
         - load_user(): This function loads the user's id from the database.
+        - hashing_busy(): This function answers with 503 Service Unavailable when the password hashing pool is full.
         - app.run(): This function runs the app on the server.
 """
 
-# os import to retrieve database path
-import os
-
 # General flask imports
 from flask import Flask, render_template, url_for, redirect
 from flask_login import login_user, login_required, logout_user
-from flask_wtf import CSRFProtect
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import InputRequired, Length
 
-# Import the market blueprint
-from Market import market_bp
+# Import the config objects and the database engine profiles
+from config import get_config, engine_profile, register_sqlite_pragmas
 # Import extensions such as db and bcrypt from extensions.py
-from extensions import db, bcrypt, login_manager, migrate
-# Import the User model from models.py
-from models import User
+from extensions import (CACHES, db, bcrypt, csrf, identity_cache, login_manager, migrate, password_hasher,
+                        request_metrics)
+# Import the error raised when the password hashing pool is full
+from password_pool import HashingBusy
 
 '''
 Things to know:
@@ -38,42 +37,114 @@ SubmitField: Button that receives submit input
 InputRequired: Checks if the field is filled
 Length: Checks if the length of the field is within a certain range
 NumberRange: Checks if the number is within a certain range
+The models and the market blueprint are imported inside the functions that use them, so importing this file (for
+example in the gunicorn master before it forks its workers) stays cheap.
 '''
 
-# Get the path of the database
-file_path = os.path.abspath(os.getcwd()) + "/Database.db"
-
-# Initialize the app
-app = Flask(__name__)
-# Set the app configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + file_path
-# Set the app configuration
-app.config['SECRET_KEY'] = 'Study4Money'
-# Initialize the database
-db.init_app(app)
-# Initialize the migration system
-migrate.init_app(app, db)
-# Initialize the CSRF protection
-csrf = CSRFProtect(app)
-
-# Initialize bcrypt
-bcrypt.init_app(app)
-# Initialize the login manager
-login_manager.init_app(app)
-# Set the login view
-login_manager.login_view = 'login'
-
-# Register the market blueprint with the app to gain access to market.py
-app.register_blueprint(market_bp, url_prefix='/market')
+
+def create_app(config=None):
+    """
+    This function builds and configures the app. config is a config name ("development", "testing" or "production"),
+    a config class from config.py, or None to use the ASD4ME_CONFIG environment variable. The extensions from
+    extensions.py are bound to the new app and the market blueprint is registered with it.
+    """
+    # Initialize the app
+    app = Flask(__name__)
+    # Set the app configuration from the chosen config object
+    app.config.from_object(get_config(config))
+    # Get the database engine profile (ASD4ME_DB_PROFILE overrides the profile of the config)
+    db_profile = engine_profile(app.config['DB_PROFILE'])
+    # Set the engine options (connection pool sizing) and the pragmas run on each new connection
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', db_profile['engine_options'])
+    app.config.setdefault('SQLITE_PRAGMAS', db_profile['pragmas'])
+
+    # Initialize the database
+    db.init_app(app)
+    # Run the profile's pragmas on every connection the engine makes
+    with app.app_context():
+        register_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
+    # Initialize the migration system
+    migrate.init_app(app, db)
+    # Initialize the CSRF protection
+    csrf.init_app(app)
+    # Initialize bcrypt
+    bcrypt.init_app(app)
+    # Initialize the password hashing pool
+    password_hasher.init_app(app)
+    # Initialize the search result, catalog listing, logged-in user and owned study guide caches
+    for cache in CACHES:
+        cache.init_app(app)
+    # Count and time the SQL statements of every request (Server-Timing header, slow query log, per-endpoint metrics)
+    with app.app_context():
+        request_metrics.init_app(app, db.engine)
+    # Initialize the login manager
+    login_manager.init_app(app)
+    # Set the login view
+    login_manager.login_view = 'login'
+
+    # Register the pages defined in this file
+    app.add_url_rule('/', view_func=home)
+    app.add_url_rule('/login', view_func=login, methods=['GET', 'POST'])
+    app.add_url_rule('/logout', view_func=logout, methods=['GET', 'POST'])
+    app.add_url_rule('/signup', view_func=signup, methods=['GET', 'POST'])
+    # Answer with 503 when the password hashing pool is full
+    app.register_error_handler(HashingBusy, hashing_busy)
+
+    # Register the fingerprinted static assets (the /dist route, asset_url() and "flask assets build")
+    import assets
+    assets.init_app(app)
+
+    # Import the market blueprint (this also imports the models) now that the app needs it
+    from Market import market_bp
+    # Initialize the catalog version used to key cached catalog pages
+    from catalog import catalog_version
+    catalog_version.init_app(app)
+    # Initialize the worker paying creators for their sales (and the "flask worker" command)
+    from payouts import payout_worker
+    payout_worker.init_app(app)
+    # Initialize the search bar's typeahead index (built in the background in each worker process)
+    from typeahead import typeahead
+    typeahead.init_app(app)
+    # Register the "flask ledger compact", "flask ledger audit" and "flask ledger rebuild" commands
+    import ledger
+    ledger.init_app(app)
+    # Register the "flask catalog import" and "flask catalog export" commands
+    import catalog_csv
+    catalog_csv.init_app(app)
+    # Register the "flask facets rebuild" command
+    import facets
+    facets.init_app(app)
+    # Register the "flask sales rebuild" command
+    import sales
+    sales.init_app(app)
+    # Register the market blueprint with the app to gain access to market.py
+    app.register_blueprint(market_bp, url_prefix='/market')
+    return app
 
 
 @login_manager.user_loader
 def load_user(user_id):
     """
-    This function loads the user's id by querying the database and returning the id when found.
+    This function loads the user's id by querying the database and returning the id when found. Users are kept in the
+    logged-in user cache for a short time, so most requests load them without a query. Code that changes a user's
+    wallet or admin flag must call identity_cache.invalidate() with the user's id after committing.
     """
-    # return the user's database id
-    return User.query.get(int(user_id))
+    # Import the User model from models.py
+    from models import User
+    # Look for the user in the logged-in user cache
+    user_id = int(user_id)
+    cached_user = identity_cache.get(user_id)
+    if cached_user is None:
+        # Query the database for the user
+        cached_user = db.session.get(User, user_id)
+        if cached_user is None:
+            return None
+        # Detach the user from this request's session and cache it. The cached copy is never changed, because each
+        # request gets its own copy below
+        db.session.expunge(cached_user)
+        identity_cache.set(user_id, cached_user)
+    # return a copy of the user attached to this request's session, without querying the database (load=False)
+    return db.session.merge(cached_user, load=False)
 
 
 class SignupForm(FlaskForm):
@@ -100,7 +171,6 @@ class LoginForm(FlaskForm):
     submit = SubmitField('Login')
 
 
-@app.route('/')
 def home():
     """
     This function renders the index.html template, the homepage of the website.
@@ -109,19 +179,28 @@ def home():
     return render_template('index.html')
 
 
-@app.route('/login', methods=['GET', 'POST'])
 def login():
     """
     This function renders the login.html template, and allows users to log in to the website using forms.
     """
+    # Import the User model from models.py
+    from models import User
     # Initialize LoginForm
     form = LoginForm()
     # Check if the form is validated
     if form.validate_on_submit():
         # Query the database for the user
         user = User.query.filter_by(username=form.username.data).first()
-        # Check if the user exists and the password is correct
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        # Check if the user exists and the password is correct (hashing runs in the password hashing pool)
+        if user and password_hasher.check_password_hash(user.password, form.password.data):
+            # Rehash the password if it was hashed with a different cost factor than the configured one
+            if password_hasher.needs_rehash(user.password):
+                try:
+                    user.password = password_hasher.generate_password_hash(form.password.data)
+                    db.session.commit()
+                # The rehash is optional, so skip it rather than fail the login when the pool is full
+                except HashingBusy:
+                    db.session.rollback()
             # Log the user in, starting their session
             login_user(user)
             # Redirect to the market blueprint's home
@@ -130,7 +209,6 @@ def login():
     return render_template('login.html', form=form)
 
 
-@app.route('/logout', methods=['GET', 'POST'])
 @login_required
 def logout():
     """
@@ -142,17 +220,18 @@ def logout():
     return redirect(url_for('login'))
 
 
-@app.route('/signup', methods=['GET', 'POST'])
 def signup():
     """
     This function renders the signup.html template, allowing users to create an account for the website via forms.
     """
+    # Import the User model from models.py
+    from models import User
     # Initialize SignupForm
     form = SignupForm()
     # Check if the form is validated
     if form.validate_on_submit():
-        # Create a new hashed password
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        # Create a new hashed password (hashing runs in the password hashing pool)
+        hashed_password = password_hasher.generate_password_hash(form.password.data)
         # Create a new user with the username and hashed password
         new_user = User(username=form.username.data, password=hashed_password)
         # Add the new user to the database
@@ -165,8 +244,19 @@ def signup():
     return render_template('signup.html', form=form)
 
 
+def hashing_busy(error):
+    """
+    This function answers with 503 Service Unavailable when the password hashing pool is full, telling the client when
+    to try again instead of letting logins pile up behind each other.
+    """
+    # Return the 503 response with the Retry-After header
+    return 'The server is busy, please try again shortly.', 503, {'Retry-After': str(error.retry_after)}
+
+
 # Run the app on the server
 if __name__ == '__main__':
+    # Build the app
+    app = create_app()
     # Create all the tables in the database
     with app.app_context():
         db.create_all()
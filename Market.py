@@ -3,35 +3,87 @@ Market.py is a blueprint that contains all the routes and functions for the mark
 ASD4ME.py when necessary, and contains many market operations such as purchasing and sharing. The functions in this
 file are:
         - market_home(): Home page of the market application. Displays basic user info such as wallet balance, and
-        allows navigation to other parts of the website. Also displays all study guides available for purchase.
+        allows navigation to other parts of the website. Also displays one page of the study guides available for
+        purchase.
         - share(): Page for users to share study guides. Users enter the necessary information to share a study guide in
         share.html
         - account_home(): account_home is the user's account page, which displays account info such as wallet balance
         and cart. This function gives users the option to remove study guides, finalize their cart purchases, and view
-        items in their inventory.
+        items in their inventory one page at a time.
         - finalize_purchase(): finalize_purchase allows users to finish adding the items in their cart to their
         inventory, and accordingly checks and subtracts from wallet balance. If the wallet_balance is high enough, the
         transaction is completed and items are moved to their inventory. Otherwise, it does not go through.
-        - admin_home(): Admin home page. Displays pending study guides and allows admin to approve or reject them.
-        - search(): Page for users to search study guides. Users enter a string in searchbar.html and the string is
+        - sales_dashboard(): Creator dashboard showing the units sold and revenue of the user's study guides, per guide
+        and per day.
+        - admin_home(): Admin home page. Displays one page of the pending study guides and allows admin to approve or
+        reject them.
+        - moderate(): Approves or rejects the pending study guides selected on the admin page, in one transaction.
+        - search(): Page for users to search study guides. Users enter a string in Searchbar.html and the string is
         retrieved and stored
         - results(): results allows users to view the results of their search query, and add study guides to their cart
+        - add_cart_items(): Adds study guides to the user's cart and answers with JSON (called by add-to-cart buttons).
+        - remove_cart_items(): Removes study guides from the user's cart and answers with JSON.
+        - cache_stats(): Admin-only page returning the size and hit/miss counters of the search result and logged-in
+        user caches.
+        - metrics(): Admin-only page returning the per-endpoint request, database time and query count histograms in
+        the Prometheus text format.
+        - export_catalog(): Admin-only download of the whole catalog as a CSV file, streamed as it is read.
+        - api_guides(): JSON API listing the catalog a page at a time, or streaming it as NDJSON.
+        - api_search(): JSON API returning the study guides matching a search query.
+        - api_suggest(): JSON API returning the search bar's typeahead suggestions for what the user typed so far.
+        - api_inventory(): JSON API listing the current user's inventory, newest first.
+        - api_error(): Answers API errors with a JSON error object.
         - logout(): logout logs the user out of the website.
+        - catalog_changed(): Drops everything cached from the catalog after it changed.
 """
 
+# hashlib and time imports to build ETags
+import hashlib
+import time
+# datetime import for the time of sales
+from datetime import datetime, timezone
+
 # General flask imports
-from flask import Blueprint, redirect, url_for, request
+from flask import Blueprint, Response, current_app, flash, redirect, url_for, request, jsonify, make_response
+from flask import stream_with_context
 from flask import render_template
 from flask_login import login_required, current_user, logout_user
 from flask_wtf import FlaskForm
+from markupsafe import Markup
 from wtforms import StringField, SubmitField, IntegerField
 from wtforms.validators import DataRequired
 from wtforms.validators import InputRequired, Length, NumberRange
 
+# JSON API imports
+from api import (GUIDE_FIELDS, INVENTORY_FIELDS, SEARCH_FIELDS, STREAM_CHUNK_SIZE, ApiError, decode_cursor,
+                 encode_cursor, ndjson_response, page_response, parse_fields, parse_limit, require_login,
+                 wants_ndjson)
+# Cart imports
+from cart import get_cart
+# Catalog CSV export imports
+from catalog_csv import iter_catalog_csv
+# Catalog listing imports
+from catalog import (SORT_ORDERS, approve_pending_guides, catalog_page, catalog_query, catalog_version,
+                     clamp_page_size, reject_pending_guides)
+# Facet imports
+from facets import get_facets, parse_filters, price_label
 # Database imports
-from extensions import db
+from sqlalchemy.orm import joinedload
+from extensions import db, fragment_cache, identity_cache, ownership_cache, request_metrics, search_cache
 # Model imports
-from models import StudyGuide, PendingStudyGuide, Cart, CartItem, Inventory, User
+from models import StudyGuide, PendingStudyGuide, Inventory, PayoutOutbox
+# Ownership imports
+from inventory import add_to_inventory, owned_guide_ids
+# Wallet ledger imports
+from ledger import PURCHASE, debit_wallet
+# Creator payout imports
+from payouts import payout_worker
+# Full-text search imports
+from search_index import search_guides
+# Creator sales rollup imports
+from sales import DEFAULT_DASHBOARD_DAYS, MAX_DASHBOARD_DAYS, creator_dashboard, record_sales
+# Search bar typeahead imports
+from typeahead import typeahead
 
 '''
 Things to know:
@@ -47,6 +99,13 @@ NumberRange: Checks if the number is within a certain range
 # Blueprint for the market application (Accessed by ASD4ME.py and HTML templates)
 market_bp = Blueprint('market_bp', __name__)
 
+# Number of inventory items shown on each page of the account page
+INVENTORY_PAGE_SIZE = 20
+# Largest number of study guides added to or removed from a cart in one request
+MAX_CART_BATCH = 100
+# Number of pending study guides shown on each page of the admin page (and the most approved or rejected at once)
+PENDING_PAGE_SIZE = 50
+
 
 class ShareForm(FlaskForm):
     """
@@ -90,19 +149,98 @@ class SearchForm(FlaskForm):
     submit = SubmitField('Search')
 
 
+def catalog_changed():
+    """
+    Drops everything cached from the catalog after this process changed it: cached search results and catalog
+    listings, and the cached catalog version. Other processes notice the change when their caches expire.
+    """
+    search_cache.clear()
+    fragment_cache.clear()
+    catalog_version.invalidate()
+
+
+def _facet_links(facets, filters, sort, per_page):
+    """
+    Returns the links of the facet panel of the catalog listing, as {facet: [(label, count, url, active), ...]}. The
+    link of a value narrows the listing to it (keeping the other filters), and the link of the active value removes
+    that filter again. Every link goes back to the first page.
+    """
+    links = {}
+    for facet, values in facets.items():
+        links[facet] = []
+        for value, count in values:
+            active = str(filters.get(facet)) == value
+            args = {key: current for key, current in filters.items() if key != facet}
+            if not active:
+                args[facet] = value
+            label = price_label(int(value)) if facet == 'price' else value
+            links[facet].append((label, count, url_for('market_bp.market_home', sort=sort, per_page=per_page, **args),
+                                 active))
+    return links
+
+
 @market_bp.route('/')
 @login_required
 def market_home():
     """
     Home page of the market application. Displays basic user info such as wallet balance, and allows navigation to other
-    parts of the website. Also displays all study guides available for purchase.
+    parts of the website. Also displays one page of the study guides available for purchase. The page is chosen with the
+    sort, cursor and per_page query arguments, and the listing can be narrowed with the class, creator and price
+    (range) arguments, which the facet panel beside it links to along with the number of guides under each value.
+    The catalog listing is the same for every user, so it is rendered once per catalog version and cached; only the
+    header with the user's name and wallet, and the list of the page's guides the user owns (which a script marks in
+    the listing), are rendered on each request. Responses carry an ETag, and repeat visits that send it back get 304
+    Not Modified without touching the database.
     """
     # Get the current user
     user = current_user
-    # Get all study guides
-    items = StudyGuide.query.all()
-    # Render market.html for the users to see the market home page
-    return render_template('market.html', user=user, items=items)
+    # Get the sort order, the cursor of the page to show, the page size and the facet filters from the query string
+    sort = request.args.get('sort', 'id')
+    if sort not in SORT_ORDERS:
+        sort = 'id'
+    cursor = request.args.get('cursor')
+    per_page = clamp_page_size(request.args.get('per_page'))
+    filters = parse_filters(request.args)
+    # Get the catalog version (usually without a query) and the guides the user owns (usually from the cache), and
+    # build the ETag of the page from everything shown on it. Guides are never removed from an inventory, so the number
+    # of guides owned changes whenever the set does. The page also holds the CSRF token used by the add-to-cart
+    # buttons, so the ETag changes every half token lifetime too, and a page kept by the browser never holds an
+    # expired token
+    version = catalog_version.get()
+    owned = owned_guide_ids(user.id)
+    page_key = (version, sort, cursor, per_page, tuple(sorted(filters.items())))
+    token_lifetime = current_app.config.get('WTF_CSRF_TIME_LIMIT')
+    token_period = int(time.time() // (token_lifetime / 2)) if token_lifetime else 0
+    etag = hashlib.sha1(repr((page_key, user.id, user.username, user.wallet, len(owned), token_period))
+                        .encode()).hexdigest()
+    # Answer 304 Not Modified if the browser already has this exact page
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        # Use the cached catalog listing of this page (and the ids of the guides on it) if there is one
+        cached = fragment_cache.get(page_key)
+        if cached is None:
+            # Get one page of study guides (only the columns shown in the listing) and the cursor of the next page
+            items, next_cursor = catalog_page(sort=sort, cursor=cursor, page_size=per_page, filters=filters)
+            # Get the facet counts, read from the facet table once per catalog version and shared by every page
+            facets = fragment_cache.get(('facets', version))
+            if facets is None:
+                facets = get_facets()
+                fragment_cache.set(('facets', version), facets)
+            # Render the catalog listing and cache it
+            catalog_html = Markup(render_template('catalog_listing.html', items=items, sort=sort, cursor=cursor,
+                                                  per_page=per_page, next_cursor=next_cursor, filters=filters,
+                                                  facet_links=_facet_links(facets, filters, sort, per_page)))
+            cached = (catalog_html, frozenset(item.id for item in items))
+            fragment_cache.set(page_key, cached)
+        catalog_html, guide_ids = cached
+        # Render market.html for the users to see the market home page
+        response = make_response(render_template('market.html', user=user, catalog_html=catalog_html,
+                                                 owned_ids=sorted(owned & guide_ids)))
+    # Set the ETag, and make browsers check it on every visit (the page is per user, so shared caches must not keep it)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @market_bp.route('/share', methods=['GET', 'POST'])
@@ -123,6 +261,7 @@ def share():
             UnitTopic=form.UnitTopic.data,
             Price=form.Price.data,
             Creator=form.Creator.data,
+            creator_id=current_user.id,
             Link=form.Link.data
         )
         # Add the new pending study guide to the database
@@ -140,39 +279,32 @@ def share():
 def account_home():
     """
     account_home is the user's account page, which displays account info such as wallet balance and cart. This function
-    gives users the option to remove study guides, finalize their cart purchases, and view items in their inventory.
+    gives users the option to remove study guides (one, or every guide ticked in the cart at once), finalize their
+    cart purchases, and view items in their inventory.
     """
     # Initialize the form
     form = FlaskForm()
-    # Fetch current user's cart
-    cart = current_user.cart
-    # Query user's cart database to get all the items
-    if cart:
-        cart_items = CartItem.query.filter_by(cart_id=cart.id).all()
-    else:
-        cart_items = []
+    # Get the user's cart from the configured store (CART_STORE)
+    cart = get_cart(current_user.id)
     # Check for a request in account.html
-    if request.method == 'POST':
-        # Get the item_id from the form
-        item_id = request.form.get('item_id')
-        # Check if the item_id is valid
-        if item_id:
-            # Get the item_id of the study guide in the cart
-            cart_item = CartItem.query.get(item_id)
-            # Check if the cart_item exists, and whether the current user's id matches the user_id stored in cart_item
-            if cart_item and cart_item.cart.user_id == current_user.id:
-                # Delete the cart_item from the database
-                db.session.delete(cart_item)
-                # Commit changes to the database
-                db.session.commit()
+    if request.method == 'POST' and form.validate_on_submit():
+        # Remove the selected study guides from the cart (at most one cart's worth of them)
+        cart.remove(request.form.getlist('study_guide_ids', type=int)[:MAX_CART_BATCH])
         # Redirect to the account page after removed
         return redirect(url_for('market_bp.account_home'))
 
-    # Fetch all the user's inventory items from their inventory database
-    inventory_items = Inventory.query.filter_by(user_id=current_user.id).all()
+    # Get the lines of the user's cart (each with its study guide's details) in one query
+    cart_items = cart.lines()
+    # Fetch one page of the user's inventory items (newest first), also loading their study guides in the same query
+    inventory_page = (Inventory.query
+                      .filter_by(user_id=current_user.id)
+                      .options(joinedload(Inventory.study_guide))
+                      .order_by(Inventory.id.desc())
+                      .paginate(page=request.args.get('page', 1, type=int), per_page=INVENTORY_PAGE_SIZE,
+                                error_out=False))
     # Render the account.html template (Setting wallet, cart_items, inventory_items, and the form to what is necessary)
-    return render_template('account.html', wallet=current_user.wallet, cart_items=cart_items, inventory=inventory_items,
-                           form=form)
+    return render_template('account.html', wallet=current_user.wallet, cart_items=cart_items,
+                           inventory=inventory_page.items, inventory_page=inventory_page, form=form)
 
 
 @market_bp.route('/finalize_purchase', methods=['POST'])
@@ -181,102 +313,143 @@ def finalize_purchase():
     """
     finalize_purchase allows users to finish adding the items in their cart to their inventory, and accordingly checks
     and subtracts from wallet balance. If the wallet_balance is high enough, the transaction is completed and items are
-    moved to their inventory. Otherwise, it does not go through.
-    """
-    # Fetch the current user's cart
-    cart = current_user.cart
-    # Calculate the total cost of all the items in the cart
-    total_cost = sum(item.study_guide.Price * item.quantity for item in cart.items)
-    # Check if the user does not have enough money in their wallet
-    if current_user.wallet < total_cost:
-        # Redirect to the account page if they don't have enough money
+    moved to their inventory. Otherwise, it does not go through. Creators are paid shortly after by the payout worker
+    (payouts.py), from the PayoutOutbox rows written here. The purchase is one write transaction whichever store holds
+    the cart; with CART_STORE = 'session' it is the only transaction the cart ever causes. The transaction starts by
+    claiming the cart (see cart.py), so a checkout sent twice at once buys the cart only once.
+    """
+    # Take every line out of the current user's cart, with the price and creator of its study guide. This is the
+    # transaction's first statement and a write, so the rest of the checkout runs under the write lock
+    cart = get_cart(current_user.id)
+    lines = cart.claim()
+    # Redirect to the account page if the cart is empty (or another checkout already bought it)
+    if not lines:
+        db.session.rollback()
+        flash('Your cart is empty.')
         return redirect(url_for('market_bp.account_home'))
-    # For each item in the cart
-    for item in cart.items:
-        # Get the corresponding study guide from the item
-        study_guide = item.study_guide
-        # Find the creator using info from the study guide
-        creator = User.query.filter_by(username=study_guide.Creator).first()
-        # If the creator exists, add the price of the study guide to their wallet
-        if creator:
-            creator.wallet += study_guide.Price * item.quantity
-        # For each item in the cart
-        for _ in range(item.quantity):
-            # Create a new inventory item for the user
-            inventory_item = Inventory(user_id=current_user.id, study_guide_id=study_guide.id)
-            # Add the inventory item to the database
-            db.session.add(inventory_item)
-
-    # Subtract the total cost from the user's wallet
-    current_user.wallet -= total_cost
-
-    # Delete all items in the cart
-    CartItem.query.filter_by(cart_id=cart.id).delete()
-
-    # Delete the cart itself
-    db.session.delete(cart)
-    # Commit changes to the database
+    # Calculate the total cost of the claimed items
+    total_cost = sum(line.Price * line.quantity for line in lines)
+
+    # Subtract the total cost from the user's wallet (and record it in the ledger), but only if the wallet covers it.
+    # The check and the write are a single statement, so two checkouts at once can never both spend the same money
+    if not debit_wallet(current_user.id, total_cost, kind=PURCHASE, reference_id=cart.id):
+        # Undo the transaction (which puts the lines back in the cart) and redirect to the account page if they don't
+        # have enough money
+        db.session.rollback()
+        flash('Your wallet does not cover this cart.')
+        return redirect(url_for('market_bp.account_home'))
+
+    # Record what each creator is owed for each study guide sold. The payout worker adds it to their wallets after the
+    # checkout, so the checkout's work does not grow with the number of creators in the cart. Guides without a creator
+    # account are recorded too, as already paid (there is nobody to pay), so the sales totals still add up to what
+    # buyers were charged
+    sold_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    sold = [{'creator_id': line.creator_id, 'study_guide_id': line.study_guide_id, 'units': line.quantity,
+             'amount': line.Price * line.quantity, 'created_at': sold_at,
+             'applied_at': sold_at if line.creator_id is None else None}
+            for line in lines]
+    unattributed = [sale['study_guide_id'] for sale in sold if sale['creator_id'] is None]
+    if unattributed:
+        current_app.logger.warning('Sold study guides without a creator account: %s', unattributed)
+    db.session.execute(db.insert(PayoutOutbox), sold)
+    # Add the same sales to the creators' dashboard rollups
+    record_sales(sold)
+
+    # Add the guides to the user's inventory (one row per guide, counting the copies), with a single upsert
+    add_to_inventory(current_user.id, {line.study_guide_id: line.quantity for line in lines})
+
+    # Commit changes to the database, then empty the cart (a database cart was already deleted by the claim)
     db.session.commit()
+    cart.clear()
+    # Drop the cached copy of the buyer and of the guides they own, which just changed, and wake the payout worker to
+    # pay the creators
+    identity_cache.invalidate(current_user.id)
+    ownership_cache.invalidate(current_user.id)
+    payout_worker.notify()
+    # Rank the classes, topics and creators just sold higher in this process's search suggestions
+    typeahead.record_sales(lines)
 
     # Redirect to the account page
     return redirect(url_for('market_bp.account_home'))
 
 
-@market_bp.route('/admin', methods=['GET', 'POST'])
+@market_bp.route('/dashboard')
+@login_required
+def sales_dashboard():
+    """
+    Creator dashboard showing what the user's study guides sold: totals, the best selling guides with their units sold
+    and revenue, and the units and revenue of each of the last days (the days query argument, 30 by default). It reads
+    the sales rollups (sales.py) rather than the purchase history, so it costs the same however many sales there were.
+    """
+    # Get the number of days to show, between 1 and MAX_DASHBOARD_DAYS
+    days = max(1, min(request.args.get('days', DEFAULT_DASHBOARD_DAYS, type=int), MAX_DASHBOARD_DAYS))
+    dashboard = creator_dashboard(current_user.id, days=days)
+    # Scale the daily bars to the best day shown
+    best_day = max((revenue for day, units, revenue in dashboard['series']), default=0)
+    # Render dashboard.html with the totals, the guides and the daily series
+    return render_template('dashboard.html', user=current_user, days=days, best_day=best_day, **dashboard)
+
+
+@market_bp.route('/admin')
 @login_required
 def admin_home():
     """
-    Admin home page. Displays pending study guides and allows admin to approve or reject them.
+    Admin home page. Displays one page of the pending study guides (oldest first), and allows admin to approve or
+    reject them one at a time or by selecting several. The page is chosen with the page query argument.
     """
     # Check if the user is an admin. If not, redirect to the market home page (is_admin is a boolean in user database)
     if not current_user.is_admin:
         return redirect(url_for('market_bp.market_home'))
     # Initialize form
     form = AdminForm()
+    # Retrieve one page of the pending study guides, oldest first
+    pending_page = (PendingStudyGuide.query
+                    .order_by(PendingStudyGuide.id)
+                    .paginate(page=request.args.get('page', 1, type=int), per_page=PENDING_PAGE_SIZE,
+                              error_out=False))
+    # Render admin.html for the admin to approve or reject study guides
+    return render_template('admin.html', pending_guides=pending_page.items, pending_page=pending_page,
+                           user=current_user, form=form)
+
+
+@market_bp.route('/admin/moderate', methods=['POST'])
+@login_required
+def moderate():
+    """
+    Approves or rejects the pending study guides selected in admin.html (one guide, or every guide ticked on the
+    page). All of the selected guides are handled by a couple of statements in one transaction, then the admin is sent
+    back to the page they were on.
+    """
+    # Check if the user is an admin. If not, redirect to the market home page
+    if not current_user.is_admin:
+        return redirect(url_for('market_bp.market_home'))
+    # Initialize form
+    form = AdminForm()
     # Check for form validation
-    if request.method == 'POST' and form.validate_on_submit():
-        # Get the action and guide_id from the form (Found in the hidden input fields in admin.html)
+    if form.validate_on_submit():
+        # Get the action and the ids of the selected guides from the form (at most one page of them)
         action = request.form.get('action')
-        # Receive the guide_id from the form
-        guide_id = int(request.form.get('guide_id'))
+        guide_ids = request.form.getlist('guide_ids', type=int)[:PENDING_PAGE_SIZE]
         # Check if the action is approve
         if action == 'approve':
-            # Create a new approved study guide using data from the pending study guide
-            approved_guide = PendingStudyGuide.query.get(guide_id)
-            if approved_guide:
-                new_guide = StudyGuide(
-                    Class=approved_guide.Class,
-                    UnitTopic=approved_guide.UnitTopic,
-                    Price=approved_guide.Price,
-                    Creator=approved_guide.Creator,
-                    Link=approved_guide.Link
-                )
-                # Add the new study guide to the database
-                db.session.add(new_guide)
-                # Delete the old study guide from the database
-                db.session.delete(approved_guide)
-                # Commit changes to the database
-                db.session.commit()
+            # Move the selected guides into the catalog
+            if approve_pending_guides(guide_ids):
+                # Drop cached pages and search results, which do not include the new study guides, and add the new
+                # guides to the search suggestions
+                catalog_changed()
+                typeahead.refresh()
         elif action == 'reject':
-            # Reject a pending study guide
-            rejected_guide = PendingStudyGuide.query.get(guide_id)
-            # Delete the rejected study guide from the database
-            db.session.delete(rejected_guide)
-            # Commit changes to the database
-            db.session.commit()
-        # Redirect to the admin page
-        return redirect(url_for('market_bp.admin_home'))
-    # Retrieve all pending study guides
-    pending_guides = PendingStudyGuide.query.all()
-    # Render admin.html for the admin to approve or reject study guides
-    return render_template('admin.html', pending_guides=pending_guides, user=current_user, form=form)
+            # Delete the selected guides
+            reject_pending_guides(guide_ids)
+    # Redirect to the admin page the admin was on
+    return redirect(url_for('market_bp.admin_home', page=request.form.get('page', 1, type=int)))
 
 
 @market_bp.route('/search', methods=['GET', 'POST'])
 @login_required
 def search():
     """
-    Page for users to search study guides. Users enter a string in searchbar.html and the string is retrieved and stored
+    Page for users to search study guides. Users enter a string in Searchbar.html and the string is retrieved and stored
     """
     # Initialize form
     form = SearchForm()
@@ -286,72 +459,247 @@ def search():
         query = form.query.data
         # Redirect to the results page using the query
         return redirect(url_for('market_bp.results', query=query))
-    # Render searchbar.html for the users to search for study guides
-    return render_template('searchbar.html', form=form, user=current_user)
+    # Render Searchbar.html for the users to search for study guides
+    return render_template('Searchbar.html', form=form, user=current_user)
 
 
-@market_bp.route('/search/results', methods=['GET', 'POST'])
+@market_bp.route('/search/results')
 @login_required
 def results():
     """
-    results allows users to view the results of their search query, and add study guides to their cart
+    results allows users to view the results of their search query. Study guides the user already owns are marked;
+    the others have an add-to-cart button, which calls add_cart_items() without reloading the page.
     """
-    # Initialize form
-    form = FlaskForm()
-    # Check whether the request went through
-    if request.method == 'POST':
-        # Get the action from the form
-        action = request.form.get('action')
-        # Check if the action is add_to_cart in results.html (Obtained from clicking the "add-to-cart" button
-        if action == 'add_to_cart':
-            # Get the study guide id from the form
-            study_guide_id = request.form.get('study_guide_id')
-            # Check if the study guide id is valid
-            if study_guide_id:
-                # Get the study guide from the database
-                study_guide = StudyGuide.query.get(study_guide_id)
-                # Check if the study guide exists
-                if study_guide:
-                    # Check if the user has a cart.
-                    if not current_user.cart:
-                        # If the user does not have a cart, create a new cart
-                        cart = Cart(user_id=current_user.id)
-                        # Add the cart to the database
-                        db.session.add(cart)
-                        # Commit changes to the database
-                        db.session.commit()
-                    # If the user has a cart, get the cart
-                    else:
-                        cart = current_user.cart
-                    # Check if the item is already in the cart
-                    cart_item = CartItem.query.filter_by(cart_id=cart.id, study_guide_id=study_guide_id).first()
-                    # If the item is in the cart, do nothing
-                    if cart_item:
-                        cart_item.quantity += 0
-                    # If the item is not in the cart, add the item to the cart
-                    else:
-                        # Create a new cart item
-                        cart_item = CartItem(cart_id=cart.id, study_guide_id=study_guide_id, quantity=1)
-                        # Add the cart item to the database
-                        db.session.add(cart_item)
-                    # Commit changes to the database
-                    db.session.commit()
     # Get the query from the form
     query = request.args.get('query')
     # Get the study guides from the database using the query
     if query:
-        # Get the study guides from the database by filtering using the query
-        results = StudyGuide.query.filter(
-            (StudyGuide.Class.ilike(f'%{query}%')) |
-            (StudyGuide.UnitTopic.ilike(f'%{query}%')) |
-            (StudyGuide.Creator.ilike(f'%{query}%'))
-        ).all()
+        # Normalize the query so queries differing only in case or spacing share a cache entry
+        cache_key = ' '.join(query.lower().split())
+        # Use the cached results of the query if there are any
+        results = search_cache.get(cache_key)
+        if results is None:
+            # Get the best matching study guides from the full-text search index and cache them
+            results = search_guides(cache_key)
+            search_cache.set(cache_key, results)
     else:
         # If there is no query, set results to an empty list
         results = []
 
-    # Render the results.html template for the users to view the results of their search query
-    return render_template('results.html', query=query, results=results, form=form)
+    # Render the results.html template for the users to view the results of their search query, marking the study
+    # guides they own (a set lookup per result, instead of a query)
+    return render_template('results.html', query=query, results=results, owned=owned_guide_ids(current_user.id))
+
+
+def _requested_guide_ids():
+    """
+    Returns the study guide ids sent to the cart endpoints: a list in study_guide_ids or a single study_guide_id, as
+    JSON or as form fields, at most MAX_CART_BATCH of them ([] when none are sent, so the caller can answer that they
+    are required). Raises ApiError if an id is not a number.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        values = request.form.getlist('study_guide_ids') or request.form.getlist('study_guide_id')
+    elif not isinstance(data, dict):
+        raise ApiError(400, 'The request body must be a JSON object')
+    elif 'study_guide_ids' in data:
+        values = data['study_guide_ids']
+    else:
+        # A missing (or null) study_guide_id means no ids were sent, not an id that is not a number
+        values = [] if data.get('study_guide_id') is None else [data['study_guide_id']]
+    try:
+        return [int(value) for value in values][:MAX_CART_BATCH]
+    except (TypeError, ValueError):
+        raise ApiError(400, 'study_guide_ids must be numbers')
+
+
+@market_bp.route('/cart/items', methods=['POST'])
+def add_cart_items():
+    """
+    Adds study guides to the current user's cart, for the add-to-cart buttons of the search results and the market
+    listing (which call it with fetch(), sending the CSRF token in the X-CSRFToken header). The ids are sent as JSON
+    ({"study_guide_ids": [12, 15]}, or {"study_guide_id": 12} for one guide) or as form fields. However many guides are
+    sent, a database cart is written with two statements in one transaction, and a session cart is not written to the
+    database at all. The answer is a small JSON object instead of a page: {"added": [12]}, listing the guides that were
+    not in the cart yet. Guides the user owns are skipped; when a single guide is sent, a guide the user owns answers
+    409 and a missing guide 404.
+    """
+    require_login()
+    guide_ids = _requested_guide_ids()
+    if not guide_ids:
+        raise ApiError(400, 'study_guide_ids is required')
+    # Study guides the user owns cannot be bought again (checked against the cached set, without a query)
+    owned = owned_guide_ids(current_user.id)
+    if len(guide_ids) == 1 and guide_ids[0] in owned:
+        raise ApiError(409, 'You already own this study guide')
+    cart = get_cart(current_user.id)
+    added = cart.add([guide_id for guide_id in guide_ids if guide_id not in owned])
+    # Tell a single missing guide apart from one that was already in the cart
+    if len(guide_ids) == 1 and not added and not cart.contains(guide_ids[0]):
+        raise ApiError(404, 'Study guide not found')
+    return jsonify(added=added)
+
+
+@market_bp.route('/cart/items', methods=['DELETE'])
+def remove_cart_items():
+    """
+    Removes study guides from the current user's cart. The ids are sent like to add_cart_items(), and the answer is
+    {"removed": 2}, the number of guides that were in the cart.
+    """
+    require_login()
+    return jsonify(removed=get_cart(current_user.id).remove(_requested_guide_ids()))
+
+
+@market_bp.route('/admin/cache')
+@login_required
+def cache_stats():
+    """
+    Admin-only page returning the size and hit/miss counters of the search result and logged-in user caches, used to
+    size the caches.
+    """
+    # Check if the user is an admin. If not, redirect to the market home page
+    if not current_user.is_admin:
+        return redirect(url_for('market_bp.market_home'))
+    # Return the cache statistics as JSON
+    return jsonify(search=search_cache.stats(), identity=identity_cache.stats())
+
+
+@market_bp.route('/admin/metrics')
+@login_required
+def metrics():
+    """
+    Admin-only page returning the per-endpoint histograms of request duration, database time and query count, and the
+    slow query counters, in the Prometheus text format. Each worker process reports its own numbers.
+    """
+    # Check if the user is an admin. If not, redirect to the market home page
+    if not current_user.is_admin:
+        return redirect(url_for('market_bp.market_home'))
+    # Return the metrics in the Prometheus text exposition format
+    return Response(request_metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@market_bp.route('/admin/catalog.csv')
+@login_required
+def export_catalog():
+    """
+    Admin-only download of the whole catalog as a CSV file (the format read by "flask catalog import"). The file is
+    sent as it is read from the database, a chunk of rows at a time, so large catalogs are never held in memory.
+    """
+    # Check if the user is an admin. If not, redirect to the market home page
+    if not current_user.is_admin:
+        return redirect(url_for('market_bp.market_home'))
+    # Stream the CSV, keeping the request (and its database session) open until the last chunk is sent
+    response = Response(stream_with_context(iter_catalog_csv()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=catalog.csv'
+    return response
+
+
+@market_bp.route('/api/v1/guides')
+def api_guides():
+    """
+    JSON API listing the catalog a page at a time, in the order given by sort (id or price), with the fields given by
+    fields. With format=ndjson the catalog is streamed one guide per line instead.
+    """
+    require_login()
+    # Get the sort order and the requested fields
+    sort = request.args.get('sort', 'id')
+    if sort not in SORT_ORDERS:
+        raise ApiError(400, f'sort must be one of {", ".join(SORT_ORDERS)}')
+    fields = parse_fields(GUIDE_FIELDS)
+    # Decode the cursor (cursors of one sort order cannot be used with the other)
+    kind = f'guides:{sort}'
+    position = decode_cursor(kind, request.args.get('cursor'))
+    # Select the requested fields, plus the fields the cursor is built from
+    cursor_fields = ('id', 'Price') if sort == 'price' else ('id',)
+    columns = [getattr(StudyGuide, field) for field in dict.fromkeys(fields + list(cursor_fields))]
+    if wants_ndjson():
+        # Stream every guide after the cursor (or at most limit guides) straight from the database cursor
+        query = catalog_query(sort, position, columns)
+        limit = parse_limit(required=False)
+        if limit is not None:
+            query = query.limit(limit)
+        return ndjson_response(db.session.execute(query.execution_options(yield_per=STREAM_CHUNK_SIZE)), fields)
+    # Get one page of guides and the cursor of the next page
+    rows, next_position = catalog_page(sort=sort, cursor=position, page_size=parse_limit(), columns=columns)
+    return page_response(rows, fields, encode_cursor(kind, next_position))
+
+
+@market_bp.route('/api/v1/search')
+def api_search():
+    """
+    JSON API returning the study guides matching the search query q, best matches first, a page at a time. With
+    format=ndjson the page is sent one guide per line.
+    """
+    require_login()
+    # Get the query, normalized like the search page does
+    query = ' '.join(request.args.get('q', '').lower().split())
+    if not query:
+        raise ApiError(400, 'q is required')
+    fields = parse_fields(SEARCH_FIELDS)
+    limit = parse_limit()
+    # The cursor holds the number of results already returned, and only works for the query it was made for
+    kind = f'search:{query}'
+    offset = decode_cursor(kind, request.args.get('cursor')) or 0
+    # Fetch one extra result to find out whether there is a next page
+    rows = search_guides(query, limit=limit + 1, offset=offset)
+    if wants_ndjson():
+        return ndjson_response(rows[:limit], fields)
+    return page_response(rows[:limit], fields, encode_cursor(kind, offset + limit if len(rows) > limit else None))
+
+
+@market_bp.route('/api/v1/suggest')
+def api_suggest():
+    """
+    JSON API returning the classes, topics and creators starting with q (or with a word starting with q), most sold
+    first, for the search bar's typeahead. Suggestions come from the in-memory index (typeahead.py), without a query.
+    """
+    require_login()
+    query = request.args.get('q', '')
+    if not query.strip():
+        raise ApiError(400, 'q is required')
+    suggestions = typeahead.suggest(query, parse_limit())
+    return jsonify(data=[{'text': text, 'field': field, 'weight': weight} for text, field, weight in suggestions])
+
+
+@market_bp.route('/api/v1/inventory')
+def api_inventory():
+    """
+    JSON API listing the current user's inventory a page at a time, newest first, with the fields given by fields.
+    With format=ndjson the inventory is streamed one item per line instead.
+    """
+    require_login()
+    fields = parse_fields(INVENTORY_FIELDS)
+    # Columns of each field (the guide's columns come from a join that is skipped when none of them are requested)
+    field_columns = {'id': Inventory.id, 'study_guide_id': Inventory.study_guide_id, 'quantity': Inventory.quantity,
+                     'Class': StudyGuide.Class, 'UnitTopic': StudyGuide.UnitTopic, 'Price': StudyGuide.Price,
+                     'Creator': StudyGuide.Creator, 'Link': StudyGuide.Link}
+    query = db.select(*(field_columns[field].label(field) for field in dict.fromkeys(['id'] + fields)))
+    if set(fields) - {'id', 'study_guide_id', 'quantity'}:
+        query = query.join(StudyGuide, StudyGuide.id == Inventory.study_guide_id)
+    query = query.where(Inventory.user_id == current_user.id).order_by(Inventory.id.desc())
+    # Seek past the last inventory item of the previous page
+    before = decode_cursor('inventory', request.args.get('cursor'))
+    if before is not None:
+        query = query.where(Inventory.id < before)
+    if wants_ndjson():
+        # Stream every item after the cursor (or at most limit items) straight from the database cursor
+        limit = parse_limit(required=False)
+        if limit is not None:
+            query = query.limit(limit)
+        return ndjson_response(db.session.execute(query.execution_options(yield_per=STREAM_CHUNK_SIZE)), fields)
+    # Fetch one extra item to find out whether there is a next page
+    limit = parse_limit()
+    rows = db.session.execute(query.limit(limit + 1)).all()
+    next_cursor = encode_cursor('inventory', rows[limit - 1].id) if len(rows) > limit else None
+    return page_response(rows[:limit], fields, next_cursor)
+
+
+@market_bp.errorhandler(ApiError)
+def api_error(error):
+    """
+    Answers errors raised by the API views with a JSON error object and the error's status code.
+    """
+    return error.to_response()
 
 
 @market_bp.route('/logout')
@@ -0,0 +1,173 @@
+"""
+api.py contains the helpers of the versioned JSON API served by the market blueprint (/market/api/v1/...). The API
+returns the catalog, search results and a user's inventory as JSON instead of HTML, so other programs do not have to
+scrape the pages. Its conventions are:
+        - Pages are JSON objects: {"data": [...], "next_cursor": "..."}. next_cursor is null on the last page.
+        - Cursors are opaque, signed tokens. Clients pass them back unchanged in the cursor argument, and cannot build
+        or edit them.
+        - fields=id,Class,Price returns only those fields of each row (a sparse fieldset), and only those columns are
+        read from the database.
+        - format=ndjson (or an Accept header asking for application/x-ndjson) streams one JSON object per line, read
+        from the database cursor a chunk at a time, instead of building the page in memory. Without a limit argument
+        it streams every remaining row.
+        - Errors are JSON objects: {"error": {"status": 400, "message": "..."}}.
+The classes and functions in this file are:
+        - ApiError: Raised by the API views to answer with a JSON error.
+        - require_login(): Answers 401 (instead of redirecting to the login page) when the client is not logged in.
+        - parse_fields(): Turns the fields argument into the list of fields to return.
+        - parse_limit(): Turns the limit argument into the number of rows to return.
+        - encode_cursor() / decode_cursor(): Sign and check opaque cursors.
+        - wants_ndjson(): Whether the client asked for NDJSON.
+        - page_response(): Returns a page of rows as JSON.
+        - ndjson_response(): Streams rows as NDJSON.
+"""
+
+# Imports for encoding rows
+import json
+
+# General flask imports
+from flask import Response, current_app, jsonify, request, stream_with_context
+from flask_login import current_user
+from itsdangerous import BadSignature, URLSafeSerializer
+
+# Catalog listing imports
+from catalog import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+# Salt of the cursor signatures, so cursors cannot be swapped with other signed values (like session cookies)
+CURSOR_SALT = 'asd4me-api-cursor'
+# Media type of NDJSON responses
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Rows read from the database at a time when streaming NDJSON
+STREAM_CHUNK_SIZE = 1000
+# Fields of the study guides in the catalog and in search results (the Link is only given out after purchase)
+GUIDE_FIELDS = ('id', 'Class', 'UnitTopic', 'Price', 'Creator', 'creator_id')
+SEARCH_FIELDS = ('id', 'Class', 'UnitTopic', 'Price', 'Creator')
+# Fields of the items in a user's inventory (id is the inventory item, study_guide_id the guide it holds, quantity the
+# number of copies bought)
+INVENTORY_FIELDS = ('id', 'study_guide_id', 'quantity', 'Class', 'UnitTopic', 'Price', 'Creator', 'Link')
+
+
+class ApiError(Exception):
+    """
+    Raised by the API views to answer with a JSON error instead of an HTML page.
+    - status: The HTTP status code of the response
+    - message: The description of the error sent to the client
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+    def to_response(self):
+        """
+        Returns the JSON error response.
+        """
+        return jsonify(error={'status': self.status, 'message': self.message}), self.status
+
+
+def require_login():
+    """
+    Raises ApiError 401 when the client is not logged in. The API uses the same session cookie as the pages, but
+    answers with a JSON error instead of redirecting to the login page like @login_required.
+    """
+    if not current_user.is_authenticated:
+        raise ApiError(401, 'Login required')
+
+
+def parse_fields(allowed):
+    """
+    Turns the fields argument (a comma-separated list) into the list of fields to return, in the order of allowed.
+    Without the argument every allowed field is returned. Raises ApiError for unknown fields.
+    """
+    value = request.args.get('fields')
+    if not value:
+        return list(allowed)
+    requested = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = requested - set(allowed)
+    if unknown:
+        raise ApiError(400, f'Unknown fields: {", ".join(sorted(unknown))}. Allowed fields: {", ".join(allowed)}')
+    return [field for field in allowed if field in requested]
+
+
+def parse_limit(required=True):
+    """
+    Turns the limit argument into the number of rows to return, between 1 and MAX_PAGE_SIZE. Without the argument the
+    default page size is used, or None (no limit) when required is False. Raises ApiError for invalid values.
+    """
+    value = request.args.get('limit')
+    if value is None:
+        return DEFAULT_PAGE_SIZE if required else None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ApiError(400, 'limit must be a number')
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _serializer():
+    """
+    Returns the serializer signing cursors with the app's secret key.
+    """
+    return URLSafeSerializer(current_app.secret_key, salt=CURSOR_SALT)
+
+
+def encode_cursor(kind, position):
+    """
+    Returns an opaque cursor for a position in a listing. kind names the listing (and its order), so a cursor from one
+    listing is rejected by another.
+    """
+    if position is None:
+        return None
+    return _serializer().dumps([kind, position])
+
+
+def decode_cursor(kind, token):
+    """
+    Returns the position stored in a cursor made by encode_cursor() for the same kind of listing, or None when there is
+    no cursor. Raises ApiError for cursors that were edited or made for another listing.
+    """
+    if not token:
+        return None
+    try:
+        cursor_kind, position = _serializer().loads(token)
+    except (BadSignature, ValueError, TypeError):
+        raise ApiError(400, 'Invalid cursor')
+    if cursor_kind != kind:
+        raise ApiError(400, 'Cursor belongs to a different listing')
+    return position
+
+
+def wants_ndjson():
+    """
+    Returns True if the client asked for NDJSON, with format=ndjson or an Accept header preferring it to JSON.
+    """
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def page_response(rows, fields, next_cursor):
+    """
+    Returns a page of rows (objects with the fields as attributes) as JSON, with the cursor of the next page.
+    """
+    return jsonify(data=[{field: getattr(row, field) for field in fields} for row in rows], next_cursor=next_cursor)
+
+
+def ndjson_response(rows, fields):
+    """
+    Streams rows (an iterable of objects with the fields as attributes, usually a database result) as NDJSON, one
+    line per row. Lines are sent in chunks of STREAM_CHUNK_SIZE rows.
+    """
+    def generate():
+        lines = []
+        for row in rows:
+            lines.append(json.dumps({field: getattr(row, field) for field in fields}) + '\n')
+            if len(lines) >= STREAM_CHUNK_SIZE:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+    # Keep the request (and its database session) open until the last line is sent
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
@@ -0,0 +1,194 @@
+"""
+assets.py contains the static asset pipeline. "flask assets build" copies every file in static/assets to static/dist
+under a name containing a hash of its content (bootstrap.min.css -> bootstrap.min.3f2a9c1b7d4e.css), writes gzip and,
+when the optional brotli package is installed, brotli compressed copies next to it, and records the names in
+static/dist/manifest.json. Since a file's name changes whenever its content does, these files can be cached by
+browsers forever. The functions in this file are:
+        - build_assets(): Fingerprints and compresses the assets and writes the manifest.
+        - init_app(): Loads the manifest, registers the /dist route, the asset_url() template helper and the CLI command.
+        - asset_url(): Returns the URL of an asset, fingerprinted if it has been built.
+        - serve_asset(): Serves a fingerprinted asset, picking the precompressed copy the browser accepts.
+"""
+
+# Imports for hashing, compressing and writing the files
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+# General flask imports
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import AppGroup
+
+# brotli is optional: without it only gzip copies are written
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Folder (inside the static folder) holding the source assets, and the folder the build writes to
+SOURCE_DIR = 'assets'
+DIST_DIR = 'dist'
+# Name of the manifest mapping each asset to its fingerprinted name
+MANIFEST_NAME = 'manifest.json'
+# Extensions of files worth compressing (fonts like woff2 and images like png are already compressed)
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.eot', '.ttf', '.map'}
+# Cache header of fingerprinted files: cache for a year and never revalidate
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Matches url(...) references in CSS files
+CSS_URL_PATTERN = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+# Command group for "flask assets ..."
+assets_cli = AppGroup('assets', help='Build the fingerprinted static assets.')
+
+
+def _fingerprint(relative_path, content):
+    """
+    Returns the fingerprinted name of an asset: its path with a hash of its content before the extension.
+    """
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    root, extension = posixpath.splitext(relative_path)
+    return f'{root}.{digest}{extension}'
+
+
+def _rewrite_css_urls(relative_path, css, manifest):
+    """
+    Points the url(...) references of a CSS file at the fingerprinted files, so fonts and images keep loading after
+    they are renamed. External URLs, data: URLs and files missing from the manifest are left alone.
+    """
+    css_dir = posixpath.dirname(relative_path)
+    fingerprinted_dir = posixpath.dirname(manifest.get(relative_path, relative_path))
+
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(('data:', 'http:', 'https:', '//', '#', '/')):
+            return match.group(0)
+        # Keep query strings and fragments such as "?#iefix"
+        path, separator, suffix = re.match(r'([^?#]*)([?#]?)(.*)', url).groups()
+        target = posixpath.normpath(posixpath.join(css_dir, path))
+        if target not in manifest:
+            return match.group(0)
+        new_url = posixpath.relpath(manifest[target], fingerprinted_dir) + separator + suffix
+        return f'url({quote}{new_url}{quote})'
+
+    return CSS_URL_PATTERN.sub(replace, css)
+
+
+def _write_asset(dist_root, fingerprinted_path, content):
+    """
+    Writes one fingerprinted asset, plus its gzip and brotli copies when the file type is worth compressing.
+    """
+    destination = os.path.join(dist_root, *fingerprinted_path.split('/'))
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    with open(destination, 'wb') as file:
+        file.write(content)
+    if posixpath.splitext(fingerprinted_path)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+        return
+    # mtime=0 keeps the gzip output identical between builds of the same content
+    with open(destination + '.gz', 'wb') as file:
+        file.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(destination + '.br', 'wb') as file:
+            file.write(brotli.compress(content, quality=11))
+
+
+def build_assets(static_folder):
+    """
+    Fingerprints and compresses every file in static/assets into static/dist, and writes the manifest. CSS files are
+    built last because their url(...) references need the fingerprinted names of the files they point at. Returns
+    the manifest.
+    """
+    source_root = os.path.join(static_folder, SOURCE_DIR)
+    dist_root = os.path.join(static_folder, DIST_DIR)
+    # Start from an empty dist folder so files of old builds do not pile up
+    shutil.rmtree(dist_root, ignore_errors=True)
+    # Collect every asset as a path relative to the static folder (e.g. assets/css/styles.min.css)
+    paths = []
+    for directory, _, filenames in os.walk(source_root):
+        for filename in filenames:
+            full_path = os.path.join(directory, filename)
+            paths.append(os.path.relpath(full_path, static_folder).replace(os.sep, '/'))
+    # Build everything except CSS first, then CSS
+    paths.sort(key=lambda path: (path.endswith('.css'), path))
+    manifest = {}
+    for relative_path in paths:
+        with open(os.path.join(static_folder, *relative_path.split('/')), 'rb') as file:
+            content = file.read()
+        if relative_path.endswith('.css'):
+            css = content.decode('utf-8')
+            content = _rewrite_css_urls(relative_path, css, manifest).encode('utf-8')
+        manifest[relative_path] = _fingerprint(relative_path, content)
+        _write_asset(dist_root, manifest[relative_path], content)
+    with open(os.path.join(dist_root, MANIFEST_NAME), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+@assets_cli.command('build')
+def build_command():
+    """
+    Fingerprint and precompress static/assets into static/dist.
+    """
+    manifest = build_assets(current_app.static_folder)
+    click.echo(f'Built {len(manifest)} assets into {os.path.join(current_app.static_folder, DIST_DIR)}'
+               f'{"" if brotli else " (brotli not installed, gzip only)"}')
+
+
+def load_manifest(app):
+    """
+    Returns the manifest of the last build, or an empty manifest if the assets have not been built.
+    """
+    try:
+        with open(os.path.join(app.static_folder, DIST_DIR, MANIFEST_NAME)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(path):
+    """
+    Returns the URL of an asset given its path inside the static folder (e.g. 'assets/css/styles.min.css'). Built
+    assets get the URL of their fingerprinted copy; assets that have not been built fall back to the plain static URL.
+    """
+    fingerprinted_path = current_app.extensions['asset_manifest'].get(path)
+    if fingerprinted_path is None:
+        return url_for('static', filename=path)
+    return url_for('serve_asset', filename=fingerprinted_path)
+
+
+def serve_asset(filename):
+    """
+    Serves a fingerprinted asset from static/dist, picking the brotli or gzip copy when the browser accepts it, with
+    headers that let browsers cache it forever.
+    """
+    dist_root = os.path.join(current_app.static_folder, DIST_DIR)
+    # Keep the content type of the original file, not of the compressed copy
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for candidate, extension in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[candidate] and os.path.isfile(os.path.join(dist_root, filename + extension)):
+            encoding = candidate
+            filename += extension
+            break
+    response = send_from_directory(dist_root, filename, mimetype=mimetype, max_age=31536000)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    # The response depends on Accept-Encoding, so caches must keep one copy per encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+def init_app(app):
+    """
+    Loads the manifest, and registers the /dist route, the asset_url() template helper and the "flask assets" command.
+    """
+    app.extensions['asset_manifest'] = load_manifest(app)
+    app.add_url_rule(f'/{DIST_DIR}/<path:filename>', view_func=serve_asset)
+    app.add_template_global(asset_url)
+    app.cli.add_command(assets_cli)
@@ -0,0 +1,10 @@
+"""
+benchmarks contains the tools used to measure the market under load:
+        - generate.py: Fills a fresh database with a seeded synthetic dataset of a chosen scale.
+        - run.py: Drives the market routes through the Flask test client against a generated database, and saves the
+        latency, throughput and query counts of each route as JSON so runs can be compared.
+Run them from the project folder, for example:
+        python -m benchmarks.generate --scale 100k --database bench.db
+        python -m benchmarks.run --database bench.db --output results/before.json
+        python -m benchmarks.run --compare results/before.json results/after.json
+"""
@@ -0,0 +1,228 @@
+"""
+generate.py fills a fresh database with a seeded synthetic dataset, so the market can be measured at realistic sizes.
+The same seed and scale always produce the same database. The data is skewed the way a real market is: a few classes
+and creators account for most of the guides, a few guides account for most of the sales, and most users own little
+while a few own a lot. The functions in this file are:
+        - create_benchmark_app(): Builds an app bound to a benchmark database file.
+        - zipf_weights(): Returns cumulative weights that make a few items much more likely to be picked than the rest.
+        - generate_dataset(): Writes the users (and their opening ledger entries), study guides (and their facet
+        counts), pending guides, carts, inventory and sales history (paid payouts and the sales rollups) of a dataset.
+        - main(): Command line entry point ("python -m benchmarks.generate --scale 100k").
+Every user gets the password BENCHMARK_PASSWORD, and user 1 is an admin.
+"""
+
+# Imports for the dataset and the timing of each step
+import datetime
+import itertools
+import os
+from collections import Counter
+import random
+import time
+
+# General flask imports
+import click
+from flask_migrate import stamp
+
+# Import the app factory and the testing config, which the benchmark config is built from
+from ASD4ME import create_app
+from config import BASE_DIR, TestingConfig
+# Database imports
+from extensions import bcrypt, db
+
+# Number of rows of each table per scale. Users, carts and inventory rows grow with the number of guides
+SCALES = {
+    '10k': {'guides': 10_000, 'users': 2_000},
+    '100k': {'guides': 100_000, 'users': 20_000},
+    '1m': {'guides': 1_000_000, 'users': 200_000},
+}
+# Share of users that have an open cart, and the largest number of guides in a cart
+CART_SHARE = 0.25
+MAX_CART_ITEMS = 5
+# Copies bought per study guide (copies of a guide owned by the same user share an inventory row)
+INVENTORY_PER_GUIDE = 2
+# Pending guides per study guide
+PENDING_PER_GUIDE = 0.01
+# Days back over which the purchases behind the inventory are spread (the sales history of the creator dashboard)
+SALES_HISTORY_DAYS = 90
+# Share of users that have shared at least one guide
+CREATOR_SHARE = 0.1
+# Rows written per INSERT statement
+CHUNK_SIZE = 10_000
+# Password of every generated user
+BENCHMARK_PASSWORD = 'benchmark-password'
+# Classes and unit topics guides are drawn from (the first entries are picked most often)
+CLASSES = ('Biology', 'Chemistry', 'Calculus', 'Physics', 'ComputerScience', 'Statistics', 'USHistory',
+           'WorldHistory', 'EnglishLit', 'Spanish', 'Psychology', 'Economics', 'Government', 'Geography',
+           'EnvScience', 'French', 'ArtHistory', 'MusicTheory', 'Latin', 'Chinese')
+TOPICS = ('Cells', 'Genetics', 'Evolution', 'Ecology', 'Stoichiometry', 'Equilibrium', 'Kinetics', 'Derivatives',
+          'Integrals', 'Limits', 'Series', 'Kinematics', 'Momentum', 'Circuits', 'Waves', 'Strings', 'Recursion',
+          'Arrays', 'Sorting', 'Probability', 'Regression', 'Inference', 'Revolution', 'CivilWar', 'ColdWar',
+          'Poetry', 'Rhetoric', 'Grammar', 'Cognition', 'Markets', 'Elasticity', 'Congress', 'Climate', 'Review')
+
+
+def create_benchmark_app(database, profile='production'):
+    """
+    Builds an app bound to the benchmark database file, using the testing config (no CSRF tokens, cheap bcrypt) with
+    the given database engine profile.
+    """
+    uri = 'sqlite:///' + os.path.abspath(database)
+    config = type('BenchmarkConfig', (TestingConfig,), {'SQLALCHEMY_DATABASE_URI': uri, 'DB_PROFILE': profile})
+    return create_app(config)
+
+
+def zipf_weights(count, exponent=1.1):
+    """
+    Returns cumulative weights for random.choices() that pick the item of rank n with a probability proportional to
+    1 / n ** exponent, so the first few items are picked far more often than the rest.
+    """
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def _insert(connection, table, rows):
+    """
+    Writes rows (an iterable of dicts) into table, CHUNK_SIZE rows per statement. Returns the number of rows written.
+    """
+    written = 0
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, CHUNK_SIZE)):
+        connection.execute(table.insert(), chunk)
+        written += len(chunk)
+    return written
+
+
+def generate_dataset(connection, guides, users, seed=0, echo=print):
+    """
+    Writes the users, study guides, pending guides, carts, inventory and sales history of a dataset with the given
+    number of guides and users into an empty database. echo is called with a line of progress after each table.
+    """
+    # Import the models only when they are needed
+    from models import Cart, CartItem, Inventory, PayoutOutbox, PendingStudyGuide, StudyGuide, User, WalletLedger
+    from facets import rebuild_facets
+    from sales import rebuild_sales
+    rng = random.Random(seed)
+    # Hash the shared password once (with the testing config's cheap cost factor) instead of once per user
+    password = bcrypt.generate_password_hash(BENCHMARK_PASSWORD).decode('utf-8')
+
+    def timed(name, table, rows):
+        started = time.perf_counter()
+        count = _insert(connection, table, rows)
+        echo(f'{name}: {count} rows in {time.perf_counter() - started:.1f}s')
+
+    # Users: wallets are log-normal, so most users hold a little money and a few hold a lot. User 1 is an admin
+    timed('user', User.__table__, (
+        {'id': user_id, 'username': f'user{user_id:07d}', 'password': password,
+         'wallet': int(rng.lognormvariate(6, 1.2)), 'is_admin': user_id == 1}
+        for user_id in range(1, users + 1)))
+    # Open the wallet ledger with every balance, as the migration creating the ledger does
+    started = time.perf_counter()
+    opened = connection.execute(db.insert(WalletLedger).from_select(
+        ['user_id', 'amount', 'kind', 'created_at'],
+        db.select(User.id, User.wallet, db.literal('opening'), db.func.datetime('now')).where(User.wallet != 0)
+    )).rowcount
+    echo(f'wallet_ledger: {opened} rows in {time.perf_counter() - started:.1f}s')
+
+    # Creators are a random tenth of the users, and a few of them share most of the guides
+    creators = rng.sample(range(1, users + 1), max(1, int(users * CREATOR_SHARE)))
+    creator_weights = zipf_weights(len(creators))
+    class_weights = zipf_weights(len(CLASSES), exponent=0.8)
+
+    def guide_rows(count, first_id=1):
+        for guide_id in range(first_id, first_id + count):
+            creator_id = rng.choices(creators, cum_weights=creator_weights)[0]
+            yield {'id': guide_id,
+                   'Class': rng.choices(CLASSES, cum_weights=class_weights)[0],
+                   'UnitTopic': rng.choice(TOPICS),
+                   # Most guides are cheap, a few are expensive
+                   'Price': min(1000, int(rng.lognormvariate(2.5, 0.9))),
+                   'Creator': f'user{creator_id:07d}',
+                   'creator_id': creator_id,
+                   'Link': f'https://docs.example.com/guide/{guide_id}'}
+
+    timed('study_guide', StudyGuide.__table__, guide_rows(guides))
+    # Count the guides under each facet value, as approving them would have
+    started = time.perf_counter()
+    echo(f'catalog_facet: {rebuild_facets(connection)} rows in {time.perf_counter() - started:.1f}s')
+    timed('pending_study_guide', PendingStudyGuide.__table__, guide_rows(max(1, int(guides * PENDING_PER_GUIDE))))
+
+    # Popularity of each guide: a random order of the guides, where the first are bought far more often than the rest
+    popular_guides = rng.sample(range(1, guides + 1), guides)
+    guide_weights = zipf_weights(guides)
+
+    # Carts: a quarter of the users have one, holding a few distinct guides
+    cart_users = rng.sample(range(1, users + 1), int(users * CART_SHARE))
+    timed('cart', Cart.__table__, ({'id': cart_id, 'user_id': user_id}
+                                   for cart_id, user_id in enumerate(cart_users, start=1)))
+
+    def cart_item_rows():
+        for cart_id in range(1, len(cart_users) + 1):
+            picked = set(rng.choices(popular_guides, cum_weights=guide_weights, k=rng.randint(1, MAX_CART_ITEMS)))
+            for guide_id in picked:
+                yield {'cart_id': cart_id, 'study_guide_id': guide_id, 'quantity': 1}
+
+    timed('cart_item', CartItem.__table__, cart_item_rows())
+
+    # Inventory: buyers are also skewed, so most users own a few guides and some own hundreds. Copies of a guide
+    # bought more than once by the same user are counted in one row
+    buyer_weights = zipf_weights(users, exponent=0.9)
+    buyers = rng.sample(range(1, users + 1), users)
+    copies = Counter(
+        (rng.choices(buyers, cum_weights=buyer_weights)[0], rng.choices(popular_guides, cum_weights=guide_weights)[0])
+        for _ in range(guides * INVENTORY_PER_GUIDE))
+    timed('inventory', Inventory.__table__, ({'user_id': user_id, 'study_guide_id': guide_id, 'quantity': quantity}
+                                             for (user_id, guide_id), quantity in copies.items()))
+
+    # Sales history: the purchase behind each inventory row, made on a random day of the last SALES_HISTORY_DAYS and
+    # already paid out (so the payout worker leaves it alone), then the sales rollups built from it as checkouts would
+    # have built them
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    prices = dict(connection.execute(db.select(StudyGuide.id, StudyGuide.Price)).all())
+    creator_ids = dict(connection.execute(db.select(StudyGuide.id, StudyGuide.creator_id)).all())
+
+    def payout_rows():
+        for (user_id, guide_id), quantity in copies.items():
+            sold_at = now - datetime.timedelta(seconds=rng.randint(0, SALES_HISTORY_DAYS * 86400))
+            yield {'creator_id': creator_ids[guide_id], 'study_guide_id': guide_id, 'units': quantity,
+                   'amount': prices[guide_id] * quantity, 'created_at': sold_at, 'applied_at': sold_at}
+
+    timed('payout_outbox', PayoutOutbox.__table__, payout_rows())
+    started = time.perf_counter()
+    guide_sales, creator_days = rebuild_sales(connection)
+    echo(f'guide_sales / creator_daily_sales: {guide_sales} / {creator_days} rows '
+         f'in {time.perf_counter() - started:.1f}s')
+
+
+@click.command()
+@click.option('--scale', type=click.Choice(list(SCALES)), default='10k', show_default=True,
+              help='Number of study guides (users, carts and inventory grow with it).')
+@click.option('--guides', type=int, help='Number of study guides, overriding --scale.')
+@click.option('--users', type=int, help='Number of users, overriding --scale.')
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed of the random generator.')
+@click.option('--database', default=os.path.join(BASE_DIR, 'benchmark.db'), show_default=True,
+              help='Database file to create.')
+@click.option('--force', is_flag=True, help='Replace the database file if it exists.')
+def main(scale, guides, users, seed, database, force):
+    """
+    Create a database file filled with a seeded synthetic dataset.
+    """
+    if os.path.exists(database):
+        if not force:
+            raise click.UsageError(f'{database} exists, pass --force to replace it')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(database + suffix):
+                os.remove(database + suffix)
+    guides = guides or SCALES[scale]['guides']
+    users = users or SCALES[scale]['users']
+    app = create_benchmark_app(database)
+    with app.app_context():
+        # Create the tables (and the search index) and mark the database as up to date with the migrations
+        db.create_all()
+        stamp(directory=os.path.join(BASE_DIR, 'migrations'))
+        started = time.perf_counter()
+        with db.engine.begin() as connection:
+            generate_dataset(connection, guides, users, seed=seed, echo=click.echo)
+        click.echo(f'Generated {guides} guides and {users} users into {database} '
+                   f'in {time.perf_counter() - started:.1f}s (seed {seed})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+run.py drives the market routes through the Flask test client against a database made by generate.py, and reports
+the latency percentiles (p50, p95, p99), throughput and number of SQL queries of each route. The results are saved as
+JSON, and two result files can be compared to see what a change did. Requests are sent one after another from a single
+thread, so the throughput is what one worker process serves, not what the whole server serves. The functions in this
+file are:
+        - Scenario: One benchmarked route, with the requests it sends and the setup each request needs.
+        - build_scenarios(): Returns the scenarios of the market_home (whole and filtered), results, account_home,
+        finalize_purchase, add_cart_item, sales_dashboard and admin_home routes for a database.
+        - run_scenario(): Sends the requests of a scenario and measures them.
+        - summarize(): Turns the measurements of a scenario into percentiles, throughput and queries per request.
+        - compare(): Prints the difference between two result files.
+        - main(): Command line entry point ("python -m benchmarks.run --database benchmark.db").
+"""
+
+# Imports for the measurements and the result files
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+# General flask imports
+import click
+from sqlalchemy import event
+
+# Import the app built for benchmark databases
+from benchmarks.generate import create_benchmark_app
+from config import BASE_DIR
+# Database imports
+from extensions import CACHES, db, identity_cache
+# Catalog version import, whose cached value cold runs drop too
+from catalog import catalog_version
+
+
+class Scenario:
+    """
+    One benchmarked route.
+    - name: The name of the route in the results (the name of its view function)
+    - user_id: The id of the user the requests are sent as
+    - make_request: Function taking a random generator and returning (method, url, form data) of one request
+    - setup: Optional function run (untimed) before each request, for example to fill the cart checked out
+    - expected_status: The status code every response must have
+    """
+
+    def __init__(self, name, user_id, make_request, setup=None, expected_status=200):
+        self.name = name
+        self.user_id = user_id
+        self.make_request = make_request
+        self.setup = setup
+        self.expected_status = expected_status
+
+
+def build_scenarios(app, rng):
+    """
+    Returns the scenarios of the market_home (whole and filtered), results, account_home, finalize_purchase,
+    add_cart_item, sales_dashboard and admin_home routes for the database the app is bound to.
+    """
+    # Import the models and the search vocabulary only when they are needed
+    from models import Cart, CartItem, GuideSales, Inventory, StudyGuide, User
+    from benchmarks.generate import CLASSES, TOPICS
+    from facets import PRICE_BUCKETS
+    from inventory import owned_guide_ids
+    from ledger import ADJUSTMENT, credit_wallets
+    with app.app_context():
+        max_guide_id = db.session.scalar(db.select(db.func.max(StudyGuide.id))) or 1
+        # The user owning the most guides, whose account page is the most expensive to show
+        owner_id = db.session.scalar(
+            db.select(Inventory.user_id).group_by(Inventory.user_id).order_by(db.func.count().desc()).limit(1)) or 1
+        # A user without a cart, who checks out the carts filled by the finalize_purchase setup
+        buyer_id = db.session.scalar(
+            db.select(User.id).outerjoin(Cart, Cart.user_id == User.id).where(Cart.id.is_(None), User.id != 1)
+            .order_by(User.id.desc()).limit(1))
+        # The creator who sold the most, whose dashboard has the most rows to read
+        creator_id = db.session.scalar(
+            db.select(GuideSales.creator_id).group_by(GuideSales.creator_id)
+            .order_by(db.func.sum(GuideSales.revenue).desc()).limit(1)) or 1
+
+    def market_request(rng):
+        # Mostly the first pages, sometimes a page deep in the catalog, in either order
+        sort = rng.choice(('id', 'id', 'price'))
+        if rng.random() < 0.5:
+            return 'GET', f'/market/?sort={sort}', None
+        cursor = rng.randint(1, max_guide_id) if sort == 'id' else f'{rng.randint(0, 50)}:{rng.randint(1, max_guide_id)}'
+        return 'GET', f'/market/?sort={sort}&cursor={cursor}', None
+
+    def market_browse_request(rng):
+        # The first page of a class, a price range or both, in either order
+        filters = rng.choice((f'class={rng.choice(CLASSES)}', f'price={rng.choice(PRICE_BUCKETS)}',
+                              f'class={rng.choice(CLASSES)}&price={rng.choice(PRICE_BUCKETS)}'))
+        return 'GET', f'/market/?sort={rng.choice(("id", "price"))}&{filters}', None
+
+    def results_request(rng):
+        # Whole class names, topics, and prefixes of them as typed into the search bar
+        word = rng.choice(CLASSES + TOPICS)
+        return 'GET', f'/market/search/results?query={word[:rng.randint(3, len(word))]}', None
+
+    def account_request(rng):
+        return 'GET', f'/market/account?page={rng.randint(1, 3)}', None
+
+    def dashboard_request(rng):
+        # The default 30 days, or a week or a quarter
+        return 'GET', f'/market/dashboard?days={rng.choice((7, 30, 30, 90))}', None
+
+    def fill_cart():
+        # Give the buyer a cart of three guides and enough money to pay for it
+        with app.app_context():
+            cart = Cart(user_id=buyer_id)
+            db.session.add(cart)
+            db.session.flush()
+            for guide_id in random.sample(range(1, max_guide_id + 1), 3):
+                db.session.add(CartItem(cart_id=cart.id, study_guide_id=guide_id, quantity=1))
+            # Credit through the ledger (three guides cost at most 3000), so the wallets still audit cleanly
+            credit_wallets({buyer_id: 3000}, kind=ADJUSTMENT)
+            db.session.commit()
+            identity_cache.invalidate(buyer_id)
+
+    def empty_cart():
+        # Delete the buyer's cart, so each add-to-cart request adds a new item to a new cart
+        with app.app_context():
+            cart_ids = db.select(Cart.id).where(Cart.user_id == buyer_id).scalar_subquery()
+            db.session.execute(db.delete(CartItem).where(CartItem.cart_id.in_(cart_ids)))
+            db.session.execute(db.delete(Cart).where(Cart.user_id == buyer_id))
+            db.session.commit()
+
+    def add_cart_item_request(rng):
+        # A random guide the buyer does not own (guides bought by the finalize_purchase scenario included)
+        with app.app_context():
+            owned = owned_guide_ids(buyer_id)
+        guide_id = rng.randint(1, max_guide_id)
+        while guide_id in owned:
+            guide_id = rng.randint(1, max_guide_id)
+        return 'POST', '/market/cart/items', {'study_guide_id': guide_id}
+
+    return [
+        Scenario('market_home', buyer_id, market_request),
+        Scenario('market_browse', buyer_id, market_browse_request),
+        Scenario('results', buyer_id, results_request),
+        Scenario('account_home', owner_id, account_request),
+        Scenario('finalize_purchase', buyer_id, lambda rng: ('POST', '/market/finalize_purchase', {}),
+                 setup=fill_cart, expected_status=302),
+        Scenario('add_cart_item', buyer_id, add_cart_item_request, setup=empty_cart),
+        Scenario('sales_dashboard', creator_id, dashboard_request),
+        # User 1 is the admin made by generate.py
+        Scenario('admin_home', 1, lambda rng: ('GET', '/market/admin', None)),
+    ]
+
+
+def run_scenario(app, scenario, rng, iterations, warmup=10, cold=False):
+    """
+    Sends warmup + iterations requests of a scenario, and returns the duration (in seconds) and number of SQL queries
+    of each measured request. With cold=True every in-process cache the app registers (and the cached catalog version)
+    is emptied before every request.
+    """
+    client = app.test_client()
+    # Log the client in as the scenario's user
+    with client.session_transaction() as session:
+        session['_user_id'] = str(scenario.user_id)
+        session['_fresh'] = True
+    # Count the statements sent to the database
+    queries = [0]
+
+    def count_query(*args):
+        queries[0] += 1
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count_query)
+    durations, query_counts = [], []
+    try:
+        for iteration in range(warmup + iterations):
+            if scenario.setup:
+                scenario.setup()
+            if cold:
+                for cache in CACHES:
+                    cache.clear()
+                catalog_version.invalidate()
+            method, url, data = scenario.make_request(rng)
+            queries[0] = 0
+            started = time.perf_counter()
+            response = client.open(url, method=method, data=data)
+            elapsed = time.perf_counter() - started
+            if response.status_code != scenario.expected_status:
+                raise click.ClickException(f'{scenario.name}: {method} {url} answered {response.status_code}, '
+                                           f'expected {scenario.expected_status}')
+            if iteration >= warmup:
+                durations.append(elapsed)
+                query_counts.append(queries[0])
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_query)
+    return durations, query_counts
+
+
+def summarize(durations, query_counts):
+    """
+    Turns the measurements of a scenario into latency percentiles (in milliseconds), throughput (requests per second)
+    and queries per request.
+    """
+    # quantiles() needs at least two values
+    cuts = statistics.quantiles(durations * 2 if len(durations) < 2 else durations, n=100, method='inclusive')
+    return {
+        'requests': len(durations),
+        'p50_ms': round(cuts[49] * 1000, 3),
+        'p95_ms': round(cuts[94] * 1000, 3),
+        'p99_ms': round(cuts[98] * 1000, 3),
+        'mean_ms': round(statistics.fmean(durations) * 1000, 3),
+        'max_ms': round(max(durations) * 1000, 3),
+        'throughput_rps': round(len(durations) / sum(durations), 1),
+        'queries_per_request': round(statistics.fmean(query_counts), 2),
+        'max_queries': max(query_counts),
+    }
+
+
+def _git_revision():
+    """
+    Returns the short hash of the checked out commit, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    """
+    Prints the p50, p95, p99 and queries per request of each route in two result files, with the change in percent.
+    """
+    with open(old_path) as file:
+        old = json.load(file)['routes']
+    with open(new_path) as file:
+        new = json.load(file)['routes']
+    click.echo(f'{"route":<20}' + ''.join(f'{metric:>28}' for metric in ('p50_ms', 'p95_ms', 'p99_ms',
+                                                                        'queries_per_request')))
+    for route in sorted(old.keys() & new.keys()):
+        cells = []
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request'):
+            before, after = old[route][metric], new[route][metric]
+            change = f'{(after - before) / before * 100:+.1f}%' if before else 'n/a'
+            cells.append(f'{before:>9} -> {after:<9} {change:>7}')
+        click.echo(f'{route:<20}' + ''.join(f'{cell:>28}' for cell in cells))
+
+
+@click.command()
+@click.option('--database', default=os.path.join(BASE_DIR, 'benchmark.db'), show_default=True,
+              help='Database file made by benchmarks.generate.')
+@click.option('--iterations', type=int, default=200, show_default=True, help='Measured requests per route.')
+@click.option('--warmup', type=int, default=10, show_default=True, help='Unmeasured requests sent first per route.')
+@click.option('--route', 'routes', multiple=True, help='Only benchmark these routes (repeatable).')
+@click.option('--profile', default='production', show_default=True, help='Database engine profile.')
+@click.option('--cold', is_flag=True, help='Empty the in-process caches before every request.')
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed of the random requests.')
+@click.option('--output', help='JSON file to write (default: benchmarks/results/<time>.json).')
+@click.option('--compare', 'compare_paths', nargs=2, help='Compare two result files instead of running.')
+def main(database, iterations, warmup, routes, profile, cold, seed, output, compare_paths):
+    """
+    Benchmark the market routes against a generated database.
+    """
+    if compare_paths:
+        compare(*compare_paths)
+        return
+    if not os.path.exists(database):
+        raise click.UsageError(f'{database} does not exist, create it with "python -m benchmarks.generate"')
+    rng = random.Random(seed)
+    random.seed(seed)
+    app = create_benchmark_app(database, profile)
+    results = {}
+    for scenario in build_scenarios(app, rng):
+        if routes and scenario.name not in routes:
+            continue
+        durations, query_counts = run_scenario(app, scenario, rng, iterations, warmup=warmup, cold=cold)
+        results[scenario.name] = summarize(durations, query_counts)
+        summary = results[scenario.name]
+        click.echo(f'{scenario.name:<20} p50 {summary["p50_ms"]:>8.2f}ms  p95 {summary["p95_ms"]:>8.2f}ms  '
+                   f'p99 {summary["p99_ms"]:>8.2f}ms  {summary["throughput_rps"]:>8.1f} req/s  '
+                   f'{summary["queries_per_request"]:>5.1f} queries')
+    # Record what was measured alongside the results, so runs on different datasets are not compared by mistake
+    with app.app_context():
+        from models import StudyGuide, User
+        guides = db.session.scalar(db.select(db.func.count()).select_from(StudyGuide))
+        users = db.session.scalar(db.select(db.func.count()).select_from(User))
+    created_at = datetime.datetime.now(datetime.timezone.utc)
+    report = {
+        'meta': {'created_at': created_at.isoformat(timespec='seconds'), 'revision': _git_revision(),
+                 'python': platform.python_version(), 'database': os.path.abspath(database), 'guides': guides,
+                 'users': users, 'profile': profile, 'cold': cold, 'iterations': iterations, 'warmup': warmup,
+                 'seed': seed},
+        'routes': results,
+    }
+    if output is None:
+        output = os.path.join(BASE_DIR, 'benchmarks', 'results', created_at.strftime('%Y%m%dT%H%M%SZ') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    click.echo(f'Saved results to {output}')
+
+
+if __name__ == '__main__':
+    main()
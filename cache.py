@@ -0,0 +1,97 @@
+"""
+cache.py contains the in-process caches used by the market. Each cache keeps a bounded number of entries, evicts the
+least recently used entry when it is full, and drops entries older than its time-to-live (TTL). Caches live in a single
+worker process, so entries changed by another process are only noticed once they expire. The classes in this file are:
+        - TTLCache: Thread-safe LRU cache with a TTL and hit/miss counters.
+"""
+
+# Imports for the LRU ordering, thread safety and expiry times
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with a TTL and hit/miss counters. Like the other extensions in extensions.py, it can be
+    created without an app and configured later with init_app(), which reads the size and TTL from the app config.
+    - maxsize: The largest number of entries kept before the least recently used entry is evicted
+    - ttl: The number of seconds an entry stays valid
+    - hits / misses: The number of get() calls that found / did not find a valid entry
+    """
+
+    def __init__(self, maxsize=256, ttl=300, config_prefix=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Prefix of the config keys read by init_app() (e.g. SEARCH_CACHE -> SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+        self.config_prefix = config_prefix
+        self.hits = 0
+        self.misses = 0
+        # Maps each key to (expiry time, value), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Reads the size and TTL of the cache from the app config, keeping the current values for missing keys.
+        """
+        if self.config_prefix:
+            self.maxsize = app.config.get(f'{self.config_prefix}_SIZE', self.maxsize)
+            self.ttl = app.config.get(f'{self.config_prefix}_TTL', self.ttl)
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key, or default if there is no entry or the entry has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            # Count a miss for missing and expired entries (and drop the expired entry)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            # Mark the entry as the most recently used one
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Stores value for key, evicting the least recently used entry if the cache is full.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """
+        Drops the entries of the given keys, for example after the data behind them has changed.
+        """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Drops every entry, for example after the data behind the cache has changed. The counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the size, settings and hit/miss counters of the cache, used to size the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
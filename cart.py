@@ -0,0 +1,292 @@
+"""
+cart.py contains the carts of the market, which can be kept in one of two stores (chosen by CART_STORE):
+        - 'database': The cart and cart_item tables. Every add and remove is a small write transaction. Each user has at
+        most one cart, which a unique index on cart.user_id guarantees, so the cart is created or found with a single
+        upsert.
+        - 'session': The signed session cookie, as a list of study guide ids. Adding and removing guides only read the
+        database (to check that the guides exist), so browsing never takes SQLite's write lock; the cart is only
+        turned into rows (inventory, payouts) by finalize_purchase, in the checkout transaction. Session carts are
+        limited to CART_MAX_ITEMS guides so the cookie stays small, and are lost when the session ends. Each one
+        carries a random nonce that checkout records in the cart_checkout table, so a cart is bought at most once even
+        when an old copy of the cookie is sent again; such a copy is dropped from the session as soon as it is seen,
+        so guides added afterwards go into a new cart with a new nonce.
+Both stores hold each study guide at most once, and let many guides be added or removed in one request. Checkout takes
+the cart with claim(), whose first statement is a write, so it runs under SQLite's write lock: of two checkouts of the
+same cart sent at once, the second waits for the first to commit and then finds nothing left to buy (its cart rows
+are gone, or its nonce is already recorded). The classes and functions in this file are:
+        - DatabaseCart: Cart kept in the cart and cart_item tables.
+        - SessionCart: Cart kept in the signed session cookie.
+        - get_cart(): Returns the current user's cart from the configured store.
+"""
+
+# Imports for the nonces of session carts and the time of their checkout
+import secrets
+from datetime import datetime, timezone
+
+# General flask imports
+from flask import current_app, session
+# SQLite's INSERT, which supports ON CONFLICT (upserts)
+from sqlalchemy.dialects.sqlite import insert
+
+# Database imports
+from extensions import db
+# Model imports
+from models import Cart, CartCheckout, CartItem, StudyGuide
+
+# Key of the cart in the session
+CART_SESSION_KEY = 'cart'
+# Columns of each line of a cart, as read by the account page and by finalize_purchase
+LINE_COLUMNS = (StudyGuide.id.label('study_guide_id'), StudyGuide.Class, StudyGuide.UnitTopic, StudyGuide.Creator,
+                StudyGuide.Price, StudyGuide.creator_id)
+
+
+class DatabaseCart:
+    """
+    Cart kept in the cart and cart_item tables (CART_STORE = 'database').
+    - user_id: The id of the user the cart belongs to
+    - id: The id of the cart row, once lines() has found it (None for an empty cart), used as the reference of the
+    purchase in the wallet ledger
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.id = None
+
+    def add(self, guide_ids):
+        """
+        Adds study guides to the cart with two statements and one commit: an upsert that creates the cart or returns
+        the id of the existing one, and an INSERT ... SELECT that adds the guides that exist and are not in the cart
+        yet. Returns the ids of the guides added.
+        """
+        if not guide_ids:
+            return []
+        # Create the cart, or get the id of the user's cart (the no-op update makes RETURNING give the existing row)
+        statement = insert(Cart).values(user_id=self.user_id)
+        cart_id = db.session.scalar(
+            statement.on_conflict_do_update(index_elements=[Cart.user_id], set_={'user_id': statement.excluded.user_id})
+            .returning(Cart.id)
+        )
+        # Add the items, selected from study_guide so missing guides add nothing
+        added = db.session.scalars(
+            insert(CartItem)
+            .from_select(['cart_id', 'study_guide_id', 'quantity'],
+                         db.select(db.literal(cart_id), StudyGuide.id, db.literal(1))
+                         .where(StudyGuide.id.in_(guide_ids)))
+            .on_conflict_do_nothing(index_elements=[CartItem.cart_id, CartItem.study_guide_id])
+            .returning(CartItem.study_guide_id)
+        ).all()
+        db.session.commit()
+        return added
+
+    def remove(self, guide_ids):
+        """
+        Removes study guides from the cart with one DELETE and one commit, and returns the number removed.
+        """
+        if not guide_ids:
+            return 0
+        removed = db.session.execute(
+            db.delete(CartItem)
+            .where(CartItem.cart_id.in_(db.select(Cart.id).where(Cart.user_id == self.user_id).scalar_subquery()),
+                   CartItem.study_guide_id.in_(guide_ids))
+        ).rowcount
+        db.session.commit()
+        return removed
+
+    def contains(self, guide_id):
+        """
+        Returns True if the study guide is in the cart.
+        """
+        return db.session.scalar(
+            db.select(CartItem.id).join(Cart, Cart.id == CartItem.cart_id)
+            .where(Cart.user_id == self.user_id, CartItem.study_guide_id == guide_id)
+        ) is not None
+
+    def lines(self):
+        """
+        Returns the lines of the cart (LINE_COLUMNS and the quantity), in the order the guides were added, with one
+        query joining the cart to its study guides.
+        """
+        rows = db.session.execute(
+            db.select(CartItem.cart_id, CartItem.quantity, *LINE_COLUMNS)
+            .join(Cart, Cart.id == CartItem.cart_id)
+            .join(StudyGuide, StudyGuide.id == CartItem.study_guide_id)
+            .where(Cart.user_id == self.user_id)
+            .order_by(CartItem.id)
+        ).all()
+        self.id = rows[0].cart_id if rows else None
+        return rows
+
+    def claim(self):
+        """
+        Takes every line out of the cart for a checkout, in the current transaction (finalize_purchase commits it with
+        the purchase, or rolls it back to put the lines back). The items are deleted with DELETE ... RETURNING before
+        anything is read, so the checkout holds the write lock from its first statement and only ever prices the items
+        it removed itself. Returns the lines claimed (as lines() does), or [] if the cart was empty or another checkout
+        got to it first.
+        """
+        claimed = db.session.execute(
+            db.delete(CartItem)
+            .where(CartItem.cart_id.in_(db.select(Cart.id).where(Cart.user_id == self.user_id).scalar_subquery()))
+            .returning(CartItem.cart_id, CartItem.study_guide_id, CartItem.quantity)
+            .execution_options(synchronize_session=False)
+        ).all()
+        if not claimed:
+            return []
+        self.id = claimed[0].cart_id
+        db.session.execute(db.delete(Cart).where(Cart.id == self.id).execution_options(synchronize_session=False))
+        # Read the study guides of the claimed items, with the quantity of each item
+        quantities = {item.study_guide_id: item.quantity for item in claimed}
+        return db.session.execute(
+            db.select(db.case(quantities, value=StudyGuide.id, else_=0).label('quantity'), *LINE_COLUMNS)
+            .where(StudyGuide.id.in_(quantities))
+            .order_by(StudyGuide.id)
+        ).all()
+
+    def clear(self):
+        """
+        Empties the cart after a checkout committed. claim() already deleted its rows in the checkout transaction, so
+        there is nothing left to do.
+        """
+
+
+class SessionCart:
+    """
+    Cart kept in the signed session cookie (CART_STORE = 'session'), as [user id, [study guide ids], nonce]. The user
+    id keeps the cart from being seen by another user who logs in from the same browser. The nonce is made when the
+    cart gets its first guide and used up by its checkout (see claim()). Changing the cart writes nothing to the
+    database.
+    - user_id: The id of the user the cart belongs to
+    - max_items: The largest number of study guides the cart holds
+    - id: Always None (a session cart has no row to refer to)
+    """
+
+    def __init__(self, user_id, max_items=100):
+        self.user_id = user_id
+        self.max_items = max_items
+        self.id = None
+
+    def _stored(self):
+        """
+        Returns the ids of the study guides in the cart, in the order they were added, and the nonce of the cart (None
+        for an empty cart). Carts stored without a nonce are ignored, since they could be checked out more than once.
+        """
+        stored = session.get(CART_SESSION_KEY)
+        if not stored or len(stored) != 3 or stored[0] != self.user_id:
+            return [], None
+        return list(stored[1]), stored[2]
+
+    def _guide_ids(self):
+        """
+        Returns the ids of the study guides in the cart, in the order they were added.
+        """
+        return self._stored()[0]
+
+    def _unbought(self):
+        """
+        Returns the ids and nonce of the cart like _stored(), but drops the cart and returns ([], None) if its nonce is
+        already in cart_checkout: the browser sent back a copy of a cart that was bought (for example the response of
+        the losing one of two checkouts arriving last). Costs one primary key lookup.
+        """
+        guide_ids, nonce = self._stored()
+        if nonce is not None and db.session.scalar(
+                db.select(CartCheckout.nonce).where(CartCheckout.nonce == nonce)) is not None:
+            self._save([])
+            return [], None
+        return guide_ids, nonce
+
+    def _save(self, guide_ids, nonce=None):
+        """
+        Stores the ids of the study guides in the cart in the session with the cart's nonce, or a new nonce when none
+        is given (or drops the cart when it is empty). Only a nonce that has not been checked out may be passed.
+        """
+        if guide_ids:
+            session[CART_SESSION_KEY] = [self.user_id, guide_ids, nonce or secrets.token_urlsafe(16)]
+        else:
+            session.pop(CART_SESSION_KEY, None)
+
+    def add(self, guide_ids):
+        """
+        Adds study guides to the cart, keeping only the guides that exist (checked with one read) and are not in the
+        cart yet, up to max_items guides. Returns the ids of the guides added.
+        """
+        current, nonce = self._unbought()
+        wanted = [guide_id for guide_id in dict.fromkeys(guide_ids) if guide_id not in current]
+        room = self.max_items - len(current)
+        if not wanted or room <= 0:
+            return []
+        existing = set(db.session.scalars(db.select(StudyGuide.id).where(StudyGuide.id.in_(wanted))))
+        added = [guide_id for guide_id in wanted if guide_id in existing][:room]
+        self._save(current + added, nonce)
+        return added
+
+    def remove(self, guide_ids):
+        """
+        Removes study guides from the cart, and returns the number removed.
+        """
+        current, nonce = self._unbought()
+        removing = set(guide_ids)
+        kept = [guide_id for guide_id in current if guide_id not in removing]
+        self._save(kept, nonce)
+        return len(current) - len(kept)
+
+    def contains(self, guide_id):
+        """
+        Returns True if the study guide is in the cart.
+        """
+        return guide_id in self._guide_ids()
+
+    def lines(self):
+        """
+        Returns the lines of the cart (LINE_COLUMNS and a quantity of 1), in the order the guides were added, with one
+        query reading the study guides. Guides removed from the catalog since they were added are left out, and a cart
+        that was already bought is dropped (see _unbought()).
+        """
+        return self._lines(self._unbought()[0])
+
+    def _lines(self, guide_ids):
+        """
+        Returns the lines of the study guides with the given ids, as lines() does.
+        """
+        if not guide_ids:
+            return []
+        rows = {row.study_guide_id: row for row in db.session.execute(
+            db.select(db.literal(1).label('quantity'), *LINE_COLUMNS).where(StudyGuide.id.in_(guide_ids)))}
+        return [rows[guide_id] for guide_id in guide_ids if guide_id in rows]
+
+    def claim(self):
+        """
+        Takes every line of the cart for a checkout, in the current transaction (finalize_purchase commits it with the
+        purchase, or rolls it back to let the cart be bought later). The cart's nonce is inserted into cart_checkout
+        before anything is read, so the checkout holds the write lock from its first statement, and a nonce that is
+        already there means this copy of the cart was bought. Returns the lines (as lines() does), or [] if the cart
+        was empty or already bought. The cookie keeps the cart until clear() is called after the checkout commits.
+        """
+        guide_ids, nonce = self._stored()
+        if not guide_ids:
+            return []
+        claimed = db.session.scalar(
+            insert(CartCheckout)
+            .values(nonce=nonce, user_id=self.user_id, created_at=datetime.now(timezone.utc).replace(tzinfo=None))
+            .on_conflict_do_nothing(index_elements=[CartCheckout.nonce])
+            .returning(CartCheckout.nonce)
+        )
+        if claimed is None:
+            # Another checkout bought this cart, so drop it from the session, or the response would send it back
+            self._save([])
+            return []
+        return self._lines(guide_ids)
+
+    def clear(self):
+        """
+        Empties the cart after a checkout committed (the cookie sent with the response no longer holds it).
+        """
+        self._save([])
+
+
+def get_cart(user_id):
+    """
+    Returns the cart of a user from the store chosen by CART_STORE ('database' by default).
+    """
+    if current_app.config.get('CART_STORE', 'database') == 'session':
+        return SessionCart(user_id, max_items=current_app.config.get('CART_MAX_ITEMS', 100))
+    return DatabaseCart(user_id)
@@ -0,0 +1,189 @@
+"""
+catalog.py contains the queries used to list the study guide catalog. The market pages only show a handful of columns
+for each study guide, so these queries select just those columns and page through the catalog with keyset (seek)
+cursors instead of loading the whole table. The classes and functions in this file are:
+        - CatalogVersion: Number that changes whenever the catalog changes, used to key cached catalog pages.
+        - clamp_page_size(): Turns the page size requested by the client into a safe page size.
+        - parse_cursor(): Turns the cursor string sent by the client into the values used to seek to the next page.
+        - format_cursor(): Turns the last row of a page into the cursor string used to request the next page.
+        - catalog_query(): Returns the query listing the study guides after a cursor, in a given order, optionally
+        narrowed by facet filters.
+        - catalog_page(): Returns one page of study guides and the cursor of the following page.
+        - approve_pending_guides(): Moves pending study guides into the catalog.
+        - reject_pending_guides(): Deletes pending study guides.
+"""
+
+# Import for the time the catalog version was last checked
+import time
+
+# Database imports
+from extensions import db
+# Facet imports, to narrow the listing and count approved guides
+from facets import add_facet_counts, filter_conditions
+# Model imports
+from models import PendingStudyGuide, StudyGuide
+
+# The columns shown by the catalog listing (Link is only given out after purchase, so it is never loaded here)
+LISTING_COLUMNS = (StudyGuide.id, StudyGuide.Class, StudyGuide.UnitTopic, StudyGuide.Price, StudyGuide.Creator)
+# The orders the catalog can be sorted by
+SORT_ORDERS = ('id', 'price')
+# Page size used when the client does not ask for one
+DEFAULT_PAGE_SIZE = 20
+# Largest page size a client is allowed to ask for
+MAX_PAGE_SIZE = 100
+# Columns copied from a pending study guide into the catalog when it is approved
+APPROVED_COLUMNS = ('Class', 'UnitTopic', 'Price', 'Creator', 'Link', 'creator_id')
+
+
+def clamp_page_size(value):
+    """
+    Turns the page size requested by the client into a safe page size. Missing or invalid values fall back to the
+    default page size, and values are kept between 1 and MAX_PAGE_SIZE.
+    """
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def parse_cursor(sort, cursor):
+    """
+    Turns the cursor string sent by the client into the values used to seek to the next page. Cursors sorted by id
+    are just the last id ("42"), cursors sorted by price are the last price and id ("30:42"). Returns None when the
+    cursor is missing or invalid, which starts from the first page.
+    """
+    if not cursor:
+        return None
+    try:
+        if sort == 'price':
+            price, guide_id = cursor.split(':', 1)
+            return int(price), int(guide_id)
+        return int(cursor)
+    except ValueError:
+        return None
+
+
+def format_cursor(sort, row):
+    """
+    Turns the last row of a page into the cursor string used to request the next page.
+    """
+    if sort == 'price':
+        return f'{row.Price}:{row.id}'
+    return str(row.id)
+
+
+def catalog_query(sort='id', cursor=None, columns=LISTING_COLUMNS, filters=None):
+    """
+    Returns the query listing the study guides after the cursor, in the given order, selecting the given columns. The
+    guides are found by seeking past the cursor on an indexed key (id, or Price then id) instead of using OFFSET, so
+    every page costs the same no matter how deep into the catalog it is. columns must include the columns of the
+    cursor (id, and Price when sorting by price). filters (see facets.parse_filters()) narrows the listing to a class,
+    a creator and/or a price range; the listing indexes put the filtered guides next to each other in the order shown.
+    """
+    # Fall back to the default order if the client asked for an unknown one
+    if sort not in SORT_ORDERS:
+        sort = 'id'
+    # Select only the requested columns, of the guides matching the filters
+    query = db.select(*columns).where(*filter_conditions(filters or {}))
+    # Decode the cursor to find where the previous page stopped
+    after = parse_cursor(sort, cursor)
+    if sort == 'price':
+        # Seek past the last (Price, id) pair, which keeps guides with the same price in a stable order
+        if after is not None:
+            query = query.where(db.tuple_(StudyGuide.Price, StudyGuide.id) > db.tuple_(*after))
+        return query.order_by(StudyGuide.Price, StudyGuide.id)
+    # Seek past the last id
+    if after is not None:
+        query = query.where(StudyGuide.id > after)
+    return query.order_by(StudyGuide.id)
+
+
+def catalog_page(sort='id', cursor=None, page_size=DEFAULT_PAGE_SIZE, columns=LISTING_COLUMNS, filters=None):
+    """
+    Returns one page of study guides (matching the filters) and the cursor of the following page (None on the last
+    page).
+    """
+    # Fetch one extra row to find out whether there is a next page
+    rows = db.session.execute(catalog_query(sort, cursor, columns, filters).limit(page_size + 1)).all()
+    # Build the cursor of the next page from the last row that is shown
+    next_cursor = format_cursor(sort, rows[page_size - 1]) if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
+
+
+def approve_pending_guides(guide_ids):
+    """
+    Moves the pending study guides with the given ids into the catalog, with one INSERT ... SELECT that copies them and
+    one DELETE that removes them from the queue, and adds them to the facet counts, in a single transaction. Ids that
+    are no longer pending (for example because another admin handled them first) are skipped. Returns the number of
+    guides approved. The caller should call catalog_changed() afterwards.
+    """
+    if not guide_ids:
+        return 0
+    # Copy the pending guides into study_guide in queue order, so they get ids in the order they were shared, and get
+    # back the columns they are counted under
+    copied = db.session.execute(
+        db.insert(StudyGuide).from_select(
+            APPROVED_COLUMNS,
+            db.select(*(getattr(PendingStudyGuide, column) for column in APPROVED_COLUMNS))
+            .where(PendingStudyGuide.id.in_(guide_ids))
+            .order_by(PendingStudyGuide.id)
+        ).returning(StudyGuide.Class, StudyGuide.Creator, StudyGuide.Price)
+    ).all()
+    # Count the new guides under their class, creator and price range
+    add_facet_counts(copied)
+    # Remove the copied guides from the queue
+    approved = db.session.execute(db.delete(PendingStudyGuide).where(PendingStudyGuide.id.in_(guide_ids))).rowcount
+    db.session.commit()
+    return approved
+
+
+def reject_pending_guides(guide_ids):
+    """
+    Deletes the pending study guides with the given ids with one statement. Returns the number of guides rejected.
+    """
+    if not guide_ids:
+        return 0
+    rejected = db.session.execute(db.delete(PendingStudyGuide).where(PendingStudyGuide.id.in_(guide_ids))).rowcount
+    db.session.commit()
+    return rejected
+
+
+class CatalogVersion:
+    """
+    Number that changes whenever the catalog changes, used to key cached catalog pages and their ETags. Study guides
+    are only ever added to the catalog (approved), never edited or deleted, so the largest study guide id identifies
+    the catalog contents. The value is re-read from the database at most once every CATALOG_VERSION_TTL seconds, so
+    most requests get it without a query, and changes made by other worker processes are picked up within the TTL.
+    """
+
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self._value = None
+        # monotonic time after which the value has to be re-read
+        self._expires_at = 0.0
+
+    def init_app(self, app):
+        """
+        Reads the TTL from the app config.
+        """
+        self.ttl = app.config.get('CATALOG_VERSION_TTL', self.ttl)
+
+    def get(self):
+        """
+        Returns the current catalog version, re-reading it from the database if the TTL has passed.
+        """
+        if self._value is None or time.monotonic() >= self._expires_at:
+            self._value = db.session.scalar(db.select(db.func.max(StudyGuide.id))) or 0
+            self._expires_at = time.monotonic() + self.ttl
+        return self._value
+
+    def invalidate(self):
+        """
+        Makes the next get() re-read the version, for example right after this process approved a study guide.
+        """
+        self._expires_at = 0.0
+
+
+# Catalog version shared by every request in this process
+catalog_version = CatalogVersion()
@@ -0,0 +1,200 @@
+"""
+catalog_csv.py contains the CSV import and export of the study guide catalog, for loading a catalog in bulk instead of
+sharing and approving guides one at a time. The CSV has a header row naming its columns (as in data.csv~): Class,
+UnitTopic, Price and Creator are required, Link and creator_id are optional, and id is ignored unless asked for. Kept
+ids must be above every id already in the catalog and increase through the file, because the largest id is the
+catalog version that cached pages, ETags and the search suggestions of the running app follow (see catalog.py).
+Imports read the file in chunks and write each chunk with one executemany() INSERT and its own commit, so memory
+stays bounded and a million rows load in seconds (about twice as fast again when the search index is rebuilt once at
+the end instead of updated row by row). Each chunk adds its guides to the facet counts in its own transaction.
+Exports stream rows from the database a chunk at a time. The functions in this file are:
+        - import_catalog(): Adds the study guides of a CSV file to the catalog.
+        - iter_catalog_csv(): Yields the catalog as CSV text, a chunk of rows at a time.
+        - init_app(): Registers the "flask catalog import" and "flask catalog export" commands.
+"""
+
+# Imports for reading and writing CSV and timing the commands
+import csv
+import io
+import time
+from contextlib import nullcontext
+
+# General flask imports
+import click
+from flask.cli import AppGroup
+
+# Database imports
+from extensions import db
+# Model imports
+from models import StudyGuide, User
+# Search index import, to index large imports in one go
+from search_index import deferred_search_index
+# Facet count import, to count the imported guides
+from facets import add_facet_counts
+
+# Columns written by exports, in order
+CSV_COLUMNS = ('id', 'Class', 'UnitTopic', 'Price', 'Creator', 'Link', 'creator_id')
+# Columns every imported row must have
+REQUIRED_COLUMNS = ('Class', 'UnitTopic', 'Price', 'Creator')
+# Rows written per INSERT and commit during imports
+IMPORT_CHUNK_SIZE = 5000
+# Rows fetched from the database at a time during exports
+EXPORT_CHUNK_SIZE = 1000
+# Number of skipped rows described in detail after an import
+MAX_REPORTED_ERRORS = 10
+
+# Command group for "flask catalog ..."
+catalog_cli = AppGroup('catalog', help='Import and export the study guide catalog as CSV.')
+
+
+def _parse_row(record, keep_ids, last_id=0):
+    """
+    Turns one CSV record into a study_guide row. Raises ValueError if a required value is missing or invalid, or (with
+    keep_ids) if the id is not above last_id, the largest id in the catalog so far.
+    """
+    # Strip stray whitespace (data.csv~ has trailing tabs)
+    record = {key: (value or '').strip() for key, value in record.items() if key is not None}
+    for column in REQUIRED_COLUMNS:
+        if not record.get(column):
+            raise ValueError(f'missing {column}')
+    price = int(record['Price'])
+    if price < 0:
+        raise ValueError('negative Price')
+    row = {
+        'Class': record['Class'],
+        'UnitTopic': record['UnitTopic'],
+        'Price': price,
+        'Creator': record['Creator'],
+        'Link': record.get('Link', ''),
+        'creator_id': int(record['creator_id']) if record.get('creator_id') else None,
+    }
+    if keep_ids:
+        row['id'] = int(record['id'])
+        # A lower id would not change the catalog version, so the app would keep serving the catalog without it
+        if row['id'] <= last_id:
+            raise ValueError(f'id {row["id"]} is not above {last_id}, the largest id in the catalog so far')
+    return row
+
+
+def _write_chunk(connection, rows):
+    """
+    Fills in the creator_id of rows that only name their creator, then writes the rows with one INSERT, adds them to
+    the facet counts and commits.
+    """
+    # Look up the ids of the named creators with one query per chunk
+    usernames = {row['Creator'] for row in rows if row['creator_id'] is None}
+    if usernames:
+        creator_ids = dict(connection.execute(
+            db.select(User.username, User.id).where(User.username.in_(usernames))).all())
+        for row in rows:
+            if row['creator_id'] is None:
+                row['creator_id'] = creator_ids.get(row['Creator'])
+    connection.execute(StudyGuide.__table__.insert(), rows)
+    add_facet_counts(rows, connection)
+    connection.commit()
+
+
+def import_catalog(file, chunk_size=IMPORT_CHUNK_SIZE, keep_ids=False, defer_index=False):
+    """
+    Adds the study guides of a CSV file (an open text file) to the catalog, chunk_size rows per INSERT and commit.
+    Rows with missing or invalid values are skipped. With keep_ids=True the id column of the file is used as the id of
+    each guide, and rows whose id is not above every id before them (in the catalog or earlier in the file) are skipped.
+    With defer_index=True the search index is rebuilt once at the end instead of updated for every row,
+    which is faster for large files but leaves the new guides out of searches until the import ends. Returns the number
+    of rows imported, the number skipped, and (line number, reason) for the first skipped rows. Raises ValueError if
+    the header lacks a required column.
+    """
+    reader = csv.DictReader(file)
+    required = REQUIRED_COLUMNS + (('id',) if keep_ids else ())
+    missing = [column for column in required if column not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError(f'CSV header is missing {", ".join(missing)}')
+    imported, skipped, errors = 0, 0, []
+    rows = []
+    with db.engine.connect() as connection, (deferred_search_index(connection) if defer_index else nullcontext()):
+        # Largest id in the catalog so far, which kept ids have to stay above
+        last_id = (connection.scalar(db.select(db.func.max(StudyGuide.id))) or 0) if keep_ids else 0
+        for record in reader:
+            try:
+                rows.append(_parse_row(record, keep_ids, last_id))
+                last_id = rows[-1].get('id', last_id)
+            except ValueError as error:
+                skipped += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append((reader.line_num, str(error)))
+                continue
+            if len(rows) >= chunk_size:
+                _write_chunk(connection, rows)
+                imported += len(rows)
+                rows = []
+        if rows:
+            _write_chunk(connection, rows)
+            imported += len(rows)
+    return imported, skipped, errors
+
+
+def iter_catalog_csv(chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields the catalog as CSV text (header first, then the guides in id order), one chunk of rows at a time. Rows are
+    fetched chunk_size at a time from a streaming cursor, so the whole catalog is never held in memory.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    result = db.session.execute(
+        db.select(*(getattr(StudyGuide, column) for column in CSV_COLUMNS))
+        .order_by(StudyGuide.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    for partition in result.partitions():
+        writer.writerows(partition)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Yield the header of an empty catalog
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+
+@catalog_cli.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, show_default=True,
+              help='Rows written per INSERT and commit.')
+@click.option('--keep-ids', is_flag=True,
+              help='Use the id column of the file as the id of each guide (ids must be above every id in the catalog '
+                   'and increase through the file).')
+@click.option('--defer-index', is_flag=True,
+              help='Rebuild the search index once at the end (faster for large files; new guides are not searchable '
+                   'until the import ends).')
+def import_command(file, chunk_size, keep_ids, defer_index):
+    """
+    Add the study guides of a CSV file to the catalog.
+    """
+    started = time.perf_counter()
+    try:
+        imported, skipped, errors = import_catalog(file, chunk_size=chunk_size, keep_ids=keep_ids,
+                                                     defer_index=defer_index)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    for line, reason in errors:
+        click.echo(f'Skipped line {line}: {reason}', err=True)
+    click.echo(f'Imported {imported} study guides ({skipped} skipped) in {time.perf_counter() - started:.1f}s')
+
+
+@catalog_cli.command('export')
+@click.argument('file', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, show_default=True,
+              help='Rows fetched from the database at a time.')
+def export_command(file, chunk_size):
+    """
+    Write the catalog as CSV to FILE (standard output by default).
+    """
+    for chunk in iter_catalog_csv(chunk_size):
+        file.write(chunk)
+
+
+def init_app(app):
+    """
+    Registers the "flask catalog" commands.
+    """
+    app.cli.add_command(catalog_cli)
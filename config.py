@@ -0,0 +1,202 @@
+"""
+config.py contains the configuration of the app: one config object per environment (development, testing and
+production), and the database engine profiles they use. A profile is a set of SQLite pragmas, run on every new
+database connection, plus the SQLAlchemy engine options (connection pool sizing and driver arguments). The config is
+chosen with the ASD4ME_CONFIG environment variable, and the ASD4ME_DB_PROFILE environment variable can override the
+profile of any config. The classes and functions in this file are:
+        - env_milliseconds(): Reads a number of milliseconds, or "off", from the environment.
+        - Config: Settings shared by every environment.
+        - DevelopmentConfig / TestingConfig / ProductionConfig: Settings of each environment.
+        - get_config(): Returns the config object for a name, a config object, or the environment.
+        - engine_profile(): Returns the pragmas and engine options of a profile.
+        - register_sqlite_pragmas(): Runs the pragmas of a profile on every new connection made by an engine.
+"""
+
+# os import to read the profile name from the environment
+import os
+
+# SQLAlchemy imports
+from sqlalchemy import event
+
+# Environment variables used to choose the config and the engine profile
+CONFIG_ENV_VAR = 'ASD4ME_CONFIG'
+PROFILE_ENV_VAR = 'ASD4ME_DB_PROFILE'
+# Folder containing this file, where the database lives by default
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# Engine profiles by name
+ENGINE_PROFILES = {
+    # SQLite's own defaults (rollback journal, synchronous=FULL) and SQLAlchemy's default pool
+    'default': {
+        'pragmas': {},
+        'engine_options': {},
+    },
+    # Settings for several gunicorn workers sharing one database file
+    'production': {
+        'pragmas': {
+            # Write-ahead log: readers no longer block behind a writer, and a writer no longer waits for readers
+            'journal_mode': 'WAL',
+            # In WAL mode NORMAL is still crash-safe for the database, and skips an fsync on every commit
+            'synchronous': 'NORMAL',
+            # Wait up to 5 seconds for the write lock instead of failing at once with "database is locked"
+            'busy_timeout': 5000,
+            # Read the first 256 MB of the database through memory-mapped I/O
+            'mmap_size': 268435456,
+            # Page cache of 64 MB per connection (negative values are in KiB)
+            'cache_size': -65536,
+            # Keep temporary tables and indexes (sorts, GROUP BY) in memory
+            'temp_store': 'MEMORY',
+        },
+        'engine_options': {
+            # Connections kept open per worker, and extra connections allowed during bursts
+            'pool_size': 10,
+            'max_overflow': 20,
+            # Seconds to wait for a free connection before giving up
+            'pool_timeout': 30,
+            # The sqlite3 driver's own lock timeout (in seconds), kept in line with busy_timeout
+            'connect_args': {'timeout': 5},
+        },
+    },
+}
+
+
+def env_milliseconds(name, default):
+    """
+    Returns the whole number of milliseconds in an environment variable (default when it is not set), or None when it
+    is set to "off" or left empty, which turns off the setting it controls.
+    """
+    value = os.environ.get(name, default).strip()
+    if value.lower() in ('', 'off'):
+        return None
+    return int(value)
+
+
+class Config:
+    """
+    Settings shared by every environment. The database defaults to Database.db next to this file (not in the current
+    directory), and DATABASE_URL overrides it.
+    """
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'Study4Money')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(BASE_DIR, 'Database.db'))
+    # Name of the engine profile in ENGINE_PROFILES
+    DB_PROFILE = 'default'
+    # Size and time-to-live (in seconds) of the search result cache
+    SEARCH_CACHE_SIZE = 512
+    SEARCH_CACHE_TTL = 300
+    # Size and time-to-live (in seconds) of the rendered catalog listing cache, and how often (in seconds) the catalog
+    # version is re-read to notice guides approved by other worker processes
+    FRAGMENT_CACHE_SIZE = 256
+    FRAGMENT_CACHE_TTL = 600
+    CATALOG_VERSION_TTL = 5
+    # Size and time-to-live (in seconds) of the logged-in user cache. The TTL bounds how long another worker process
+    # can show a stale wallet or admin flag after it changes
+    IDENTITY_CACHE_SIZE = 4096
+    IDENTITY_CACHE_TTL = 30
+    # Size and time-to-live (in seconds) of the owned study guide cache. The TTL bounds how long another worker process
+    # can miss a purchase when marking owned guides
+    OWNERSHIP_CACHE_SIZE = 4096
+    OWNERSHIP_CACHE_TTL = 60
+    # bcrypt cost factor of new password hashes (older hashes are rehashed at login when it changes)
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', '12'))
+    # Threads hashing passwords per worker process, hashes allowed to wait for a thread, seconds a request waits for
+    # its hash, and the Retry-After (in seconds) sent when the pool is full. Running plus waiting hashes stay below
+    # gunicorn's threads per worker (gunicorn.conf.py), so logins can never take every request thread
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE_DEPTH = 4
+    PASSWORD_HASH_TIMEOUT = 10
+    PASSWORD_HASH_RETRY_AFTER = 2
+    # SQL statements slower than this many milliseconds are logged with their endpoint (None, set with SLOW_QUERY_MS=off
+    # or an empty SLOW_QUERY_MS, turns the log off), and whether responses carry a Server-Timing header with the
+    # request's query count and database time
+    SLOW_QUERY_MS = env_milliseconds('SLOW_QUERY_MS', '100')
+    SERVER_TIMING = True
+    # How creators are paid for their sales: 'thread' runs the payout worker in each app process, 'off' leaves it to a
+    # separate "flask worker" process. Payouts paid per transaction, and seconds to wait when none are owed
+    PAYOUT_WORKER = os.environ.get('PAYOUT_WORKER', 'thread')
+    PAYOUT_BATCH_SIZE = 500
+    PAYOUT_POLL_INTERVAL = 1.0
+    # Where carts are kept: 'database' (the cart tables, written on every change) or 'session' (the signed session
+    # cookie, only written to the database by the purchase), and the most study guides a session cart holds
+    CART_STORE = os.environ.get('CART_STORE', 'database')
+    CART_MAX_ITEMS = 100
+    # Seconds between compactions of the wallet ledger by the payout worker (None leaves it to "flask ledger compact")
+    LEDGER_COMPACT_INTERVAL = 3600
+    # Suggestions kept for each prefix of the search bar's typeahead (the most one request gets), and seconds between
+    # rebuilds of its index, which pick up sales made by other worker processes
+    TYPEAHEAD_SIZE = 10
+    TYPEAHEAD_REBUILD_INTERVAL = 3600
+
+
+class DevelopmentConfig(Config):
+    """
+    Settings for running the app locally with "python ASD4ME.py" or "flask run".
+    """
+
+
+class TestingConfig(Config):
+    """
+    Settings for tests and benchmarks: a private in-memory database, no CSRF tokens to fill in, the cheapest bcrypt
+    cost so creating users is fast, and no payout thread (payouts are paid by calling payouts.apply_payouts()).
+    """
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    PAYOUT_WORKER = 'off'
+
+
+class ProductionConfig(Config):
+    """
+    Settings for gunicorn workers sharing one database file.
+    """
+    DB_PROFILE = 'production'
+
+
+# Config objects by name
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+
+def get_config(config=None):
+    """
+    Returns the config object for a name, a config object, or (when config is None) the name in the ASD4ME_CONFIG
+    environment variable, falling back to development. Unknown names raise a ValueError.
+    """
+    if config is None:
+        config = os.environ.get(CONFIG_ENV_VAR, 'development')
+    if not isinstance(config, str):
+        return config
+    if config not in CONFIGS:
+        raise ValueError(f'Unknown config {config!r}, expected one of {", ".join(CONFIGS)}')
+    return CONFIGS[config]
+
+
+def engine_profile(name='default'):
+    """
+    Returns the pragmas and engine options of a profile. The ASD4ME_DB_PROFILE environment variable, when set, is used
+    instead of name. Unknown names raise a ValueError so a typo in the deployment does not silently run with the wrong
+    settings.
+    """
+    name = os.environ.get(PROFILE_ENV_VAR) or name
+    if name not in ENGINE_PROFILES:
+        raise ValueError(f'Unknown database profile {name!r}, expected one of {", ".join(ENGINE_PROFILES)}')
+    return ENGINE_PROFILES[name]
+
+
+def register_sqlite_pragmas(engine, pragmas):
+    """
+    Runs the pragmas on every new connection made by the engine. Pragmas are per connection in SQLite (apart from
+    journal_mode=WAL, which is stored in the database file), so they have to be set each time the pool connects.
+    """
+    if not pragmas or engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
@@ -7,11 +7,36 @@ from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+from flask_wtf import CSRFProtect
+
+# In-process cache used for search results
+from cache import TTLCache
+# Per-request SQL instrumentation
+from instrumentation import RequestMetrics
+# Bounded thread pool used for password hashing
+from password_pool import PasswordHasher
 
 # Instantiating the extensions
 db = SQLAlchemy()
 bcrypt = Bcrypt()
+# Runs bcrypt's hashing in a bounded thread pool (sized by the PASSWORD_HASH_* config keys)
+password_hasher = PasswordHasher(bcrypt)
+csrf = CSRFProtect()
 login_manager = LoginManager()
 migrate = Migrate()
+# Search results keyed by the normalized query (sized by SEARCH_CACHE_SIZE and SEARCH_CACHE_TTL)
+search_cache = TTLCache(maxsize=512, ttl=300, config_prefix='SEARCH_CACHE')
+# Rendered catalog listings keyed by catalog version and page (sized by FRAGMENT_CACHE_SIZE and FRAGMENT_CACHE_TTL)
+fragment_cache = TTLCache(maxsize=256, ttl=600, config_prefix='FRAGMENT_CACHE')
+# Logged-in users keyed by id, so load_user() does not query the database on every request (sized by
+# IDENTITY_CACHE_SIZE and IDENTITY_CACHE_TTL)
+identity_cache = TTLCache(maxsize=4096, ttl=30, config_prefix='IDENTITY_CACHE')
+# Ids of the study guides each user owns, keyed by user id (sized by OWNERSHIP_CACHE_SIZE and OWNERSHIP_CACHE_TTL)
+ownership_cache = TTLCache(maxsize=4096, ttl=60, config_prefix='OWNERSHIP_CACHE')
+# Every in-process cache above, configured together by the app factory (and emptied by cold benchmark runs)
+CACHES = (search_cache, fragment_cache, identity_cache, ownership_cache)
+# Query counts, Server-Timing headers, slow query log and per-endpoint histograms (set by SLOW_QUERY_MS and
+# SERVER_TIMING)
+request_metrics = RequestMetrics()
 
 
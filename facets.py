@@ -0,0 +1,186 @@
+"""
+facets.py contains the faceted browse of the catalog: narrowing the market listing by class, creator and price range.
+The number of study guides under each facet value is kept in the catalog_facet table, which is updated in the same
+transaction that adds guides to the catalog (approving them, or importing a CSV), so showing the counts reads a few
+dozen rows instead of grouping the whole catalog on every page view. Study guides are never edited or deleted, so
+adding to the counts is all the upkeep they need; "flask facets rebuild" recounts them from scratch if they are ever
+in doubt. Filtered listings are read from covering indexes on study_guide (see StudyGuide in models.py). The functions
+in this file are:
+        - price_bucket(): Returns the price range (its lowest price) a price falls in.
+        - price_label(): Returns the text shown for a price range.
+        - add_facet_counts(): Adds newly cataloged study guides to the facet counts.
+        - rebuild_facets(): Recounts every facet from the catalog.
+        - get_facets(): Returns the most common values of each facet, with their counts.
+        - parse_filters(): Turns the query string of the market page into the filters to apply.
+        - filter_conditions(): Returns the WHERE conditions of a set of filters.
+        - init_app(): Registers the "flask facets" commands.
+"""
+
+# Imports for counting facet values and finding price ranges
+import bisect
+from collections import Counter
+
+# General flask imports
+import click
+from flask.cli import AppGroup
+# SQLite's INSERT, which supports ON CONFLICT DO UPDATE (upserts)
+from sqlalchemy.dialects.sqlite import insert
+
+# Database imports
+from extensions import db
+# Model imports
+from models import CatalogFacet, StudyGuide
+
+# Facets of the catalog, in the order they are shown
+FACETS = ('class', 'creator', 'price')
+# Lowest price of each price range (the last range has no upper bound)
+PRICE_BUCKETS = (0, 5, 10, 20, 50, 100)
+# Number of values shown for each facet (the most common ones)
+FACET_LIMIT = 15
+
+# Command group for "flask facets ..."
+facets_cli = AppGroup('facets', help='Maintain the catalog facet counts.')
+
+
+def price_bucket(price):
+    """
+    Returns the lowest price of the price range a price falls in.
+    """
+    return PRICE_BUCKETS[max(0, bisect.bisect_right(PRICE_BUCKETS, price) - 1)]
+
+
+def price_label(bucket):
+    """
+    Returns the text shown for the price range starting at bucket ("$10-19", or "$100+" for the last one).
+    """
+    index = PRICE_BUCKETS.index(bucket)
+    if index == len(PRICE_BUCKETS) - 1:
+        return f'${bucket}+'
+    return f'${bucket}-{PRICE_BUCKETS[index + 1] - 1}'
+
+
+def _facet_values(guide):
+    """
+    Returns the (facet, value) pairs of a study guide (an object or mapping with Class, Creator and Price).
+    """
+    if isinstance(guide, dict):
+        class_name, creator, price = guide['Class'], guide['Creator'], guide['Price']
+    else:
+        class_name, creator, price = guide.Class, guide.Creator, guide.Price
+    return ('class', class_name), ('creator', creator), ('price', str(price_bucket(price)))
+
+
+def add_facet_counts(guides, connection=None):
+    """
+    Adds study guides just added to the catalog to the facet counts, with one executemany() upsert however many guides
+    there are. Runs in the caller's transaction (on connection, or on the session by default); the caller commits.
+    """
+    counts = Counter(pair for guide in guides for pair in _facet_values(guide))
+    if not counts:
+        return
+    statement = insert(CatalogFacet)
+    statement = statement.on_conflict_do_update(
+        index_elements=[CatalogFacet.facet, CatalogFacet.value],
+        set_={'count': CatalogFacet.count + statement.excluded.count}
+    )
+    (connection or db.session).execute(statement, [{'facet': facet, 'value': value, 'count': count}
+                                                   for (facet, value), count in counts.items()])
+
+
+def _price_bucket_column():
+    """
+    Returns the SQL expression giving the price range of a study guide, as text (like price_bucket()).
+    """
+    return db.case(*((StudyGuide.Price >= bucket, str(bucket)) for bucket in reversed(PRICE_BUCKETS[1:])),
+                   else_=str(PRICE_BUCKETS[0]))
+
+
+def rebuild_facets(connection=None):
+    """
+    Recounts every facet from the catalog, with one GROUP BY per facet, in the caller's transaction (on connection, or
+    on the session by default). Returns the number of facet values. The caller commits.
+    """
+    connection = connection or db.session
+    connection.execute(db.delete(CatalogFacet))
+    values = 0
+    for facet, column in (('class', StudyGuide.Class), ('creator', StudyGuide.Creator),
+                          ('price', _price_bucket_column())):
+        values += connection.execute(
+            db.insert(CatalogFacet).from_select(
+                ['facet', 'value', 'count'],
+                db.select(db.literal(facet), column, db.func.count()).group_by(column)
+            )
+        ).rowcount
+    return values
+
+
+def get_facets(limit=FACET_LIMIT):
+    """
+    Returns the most common values of each facet, as {facet: [(value, count), ...]}, most guides first (price ranges
+    in price order). Each facet is one read of its rows of catalog_facet (through its primary key), which hold one row
+    per distinct value rather than one per study guide.
+    """
+    facets = {}
+    for facet in FACETS:
+        query = db.select(CatalogFacet.value, CatalogFacet.count).where(CatalogFacet.facet == facet)
+        if facet != 'price':
+            query = query.order_by(CatalogFacet.count.desc(), CatalogFacet.value).limit(limit)
+        rows = db.session.execute(query).all()
+        if facet == 'price':
+            rows.sort(key=lambda row: int(row.value))
+        facets[facet] = [(row.value, row.count) for row in rows]
+    return facets
+
+
+def parse_filters(args):
+    """
+    Turns the class, creator and price arguments of a query string into the filters to apply, as a dict holding the
+    filters given. Empty values and unknown price ranges are ignored.
+    """
+    filters = {}
+    for facet in ('class', 'creator'):
+        value = (args.get(facet) or '').strip()
+        if value:
+            filters[facet] = value
+    try:
+        price = int(args.get('price', ''))
+    except ValueError:
+        price = None
+    if price in PRICE_BUCKETS:
+        filters['price'] = price
+    return filters
+
+
+def filter_conditions(filters):
+    """
+    Returns the WHERE conditions selecting the study guides that match every filter.
+    """
+    conditions = []
+    if 'class' in filters:
+        conditions.append(StudyGuide.Class == filters['class'])
+    if 'creator' in filters:
+        conditions.append(StudyGuide.Creator == filters['creator'])
+    if 'price' in filters:
+        bucket = filters['price']
+        conditions.append(StudyGuide.Price >= bucket)
+        index = PRICE_BUCKETS.index(bucket)
+        if index < len(PRICE_BUCKETS) - 1:
+            conditions.append(StudyGuide.Price < PRICE_BUCKETS[index + 1])
+    return conditions
+
+
+@facets_cli.command('rebuild')
+def rebuild_command():
+    """
+    Recount the catalog facets from the study guides.
+    """
+    values = rebuild_facets()
+    db.session.commit()
+    click.echo(f'Counted {values} facet values')
+
+
+def init_app(app):
+    """
+    Registers the "flask facets" commands.
+    """
+    app.cli.add_command(facets_cli)
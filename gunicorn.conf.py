@@ -0,0 +1,53 @@
+"""
+gunicorn.conf.py contains the settings gunicorn uses to serve the app ("gunicorn" in this folder picks it up). The app
+is built once in the master process (preload_app), so every worker starts from the same already-imported code instead
+of importing and initializing everything again. Workers are threaded (gthread): each one serves GUNICORN_THREADS
+requests at once, so a request waiting on a password hash (password_pool.py) or on SQLite's write lock does not hold
+up the worker's other requests. To serve the app in production (gunicorn is pinned in requirements.txt):
+        pip install -r requirements.txt
+        ASD4ME_CONFIG=production FLASK_APP=ASD4ME.py flask db upgrade
+        ASD4ME_CONFIG=production SECRET_KEY=... gunicorn
+Running "gunicorn" in this folder reads this file; GUNICORN_BIND, GUNICORN_WORKERS and GUNICORN_THREADS override the
+address, the number of worker processes and the threads per worker. The hooks in this file are:
+        - pre_fork(): Moves the master's objects out of the garbage collector's reach before each worker is forked.
+        - post_fork(): Drops any database connections the master opened, so workers never share a SQLite connection,
+        and starts building the worker's typeahead index in the background.
+"""
+
+# Imports for the garbage collector and environment settings
+import gc
+import os
+
+# Build the app with the factory in ASD4ME.py
+wsgi_app = 'ASD4ME:create_app()'
+# Build the app once in the master and fork workers from it
+preload_app = True
+# Address and number of worker processes
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', '4'))
+# Threaded workers, and the number of requests each worker serves at once. This must stay above PASSWORD_HASH_WORKERS
+# plus PASSWORD_HASH_QUEUE_DEPTH (config.py), so a burst of logins is turned away with a 503 before it takes every
+# thread
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+
+
+def pre_fork(server, worker):
+    """
+    Moves the master's objects out of the garbage collector's reach before each worker is forked. Otherwise the first
+    collection in a worker touches every preloaded object, which copies the memory pages shared with the master.
+    """
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """
+    Drops any database connections the master opened, so workers never share a SQLite connection. Workers open their
+    own connections on first use. Then starts building the worker's typeahead index in a background thread, so it is
+    ready before the first suggestion is asked for.
+    """
+    from extensions import db
+    from typeahead import typeahead
+    with server.app.wsgi().app_context():
+        db.engine.dispose(close=False)
+    typeahead.start()
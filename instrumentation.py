@@ -0,0 +1,213 @@
+"""
+instrumentation.py contains the per-request SQL instrumentation. SQLAlchemy engine events count and time every
+statement sent to the database while a request is handled, which makes N+1 query problems (one query per item shown
+by a template) easy to spot:
+        - Each response gets a Server-Timing header with the database time, the query count and the total time, which
+        browser developer tools show next to the request.
+        - Statements slower than SLOW_QUERY_MS are logged with the endpoint that ran them and the shape (not the
+        values) of their bound parameters.
+        - Per-endpoint histograms of request duration, database time and query count are kept, and rendered in the
+        Prometheus text format by the admin-only metrics page in Market.py.
+The histograms live in the worker process, so each gunicorn worker reports its own. The classes and functions in this
+file are:
+        - Histogram: Cumulative histogram with fixed buckets, as used by Prometheus.
+        - parameter_shape(): Describes the bound parameters of a statement without their values.
+        - RequestMetrics: Extension that hooks the engine and the request cycle, and renders the metrics.
+"""
+
+# Imports for timing, thread safety and tidying logged statements
+import re
+import threading
+import time
+
+# General flask imports
+from flask import g, has_request_context, request
+# SQLAlchemy imports
+from sqlalchemy import event
+
+# Upper bounds (in seconds) of the request duration and database time buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the query count buckets
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Label used for requests that did not match a route
+UNMATCHED_ENDPOINT = 'unmatched'
+# Longest statement text written to the slow query log
+MAX_LOGGED_STATEMENT = 500
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, as used by Prometheus.
+    - buckets: The upper bounds of the buckets, in increasing order (an infinite bucket is always added)
+    - counts: The number of observations in each bucket (not cumulative; made cumulative when rendered)
+    - total: The sum of all observations
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+
+    def observe(self, value):
+        """
+        Adds one observation.
+        """
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.total += value
+
+    def render(self, name, labels):
+        """
+        Returns the Prometheus text lines of the histogram (its buckets, sum and count) with the given labels.
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+def _label_value(value):
+    """
+    Escapes a Prometheus label value.
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def parameter_shape(parameters):
+    """
+    Describes the bound parameters of a statement without their values (which may hold passwords or personal data):
+    the type of each parameter, and the number of rows of an executemany().
+    """
+    if isinstance(parameters, (list, tuple)) and parameters and isinstance(parameters[0], (dict, list, tuple)):
+        return f'{len(parameters)} x {parameter_shape(parameters[0])}'
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in parameters.items()) + '}'
+    if isinstance(parameters, (list, tuple)):
+        return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+    return type(parameters).__name__
+
+
+class RequestMetrics:
+    """
+    Extension that counts and times the SQL statements of each request, adds the Server-Timing header, logs slow
+    statements and keeps per-endpoint histograms. init_app() reads these config keys:
+    - SLOW_QUERY_MS: Statements taking longer than this many milliseconds are logged (None, which config.py reads from
+    SLOW_QUERY_MS=off or an empty SLOW_QUERY_MS, turns the log off)
+    - SERVER_TIMING: Whether responses get the Server-Timing header
+    """
+
+    def __init__(self):
+        self.slow_query_ms = 100
+        self.server_timing = True
+        self.logger = None
+        # Histograms and slow query counters by endpoint
+        self._durations = {}
+        self._db_times = {}
+        self._query_counts = {}
+        self._slow_queries = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app, engine):
+        """
+        Reads the settings from the app config, listens to the statements of the engine, and hooks the start and end
+        of every request.
+        """
+        self.slow_query_ms = app.config.get('SLOW_QUERY_MS', self.slow_query_ms)
+        self.server_timing = app.config.get('SERVER_TIMING', self.server_timing)
+        self.logger = app.logger
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """
+        Notes the time a statement starts (a stack, since a statement's events can nest on one connection).
+        """
+        conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """
+        Adds the statement's time to the request's totals, and logs it if it was slow.
+        """
+        elapsed = time.perf_counter() - conn.info['query_started_at'].pop()
+        # Statements run outside of requests (CLI commands such as bulk imports) are not measured
+        if not has_request_context():
+            return
+        endpoint = request.endpoint or UNMATCHED_ENDPOINT
+        g.query_count = g.get('query_count', 0) + 1
+        g.query_time = g.get('query_time', 0.0) + elapsed
+        if self.slow_query_ms is not None and elapsed * 1000 > self.slow_query_ms:
+            with self._lock:
+                self._slow_queries[endpoint] = self._slow_queries.get(endpoint, 0) + 1
+            self.logger.warning('Slow query (%.1f ms) in %s: %s -- parameters %s', elapsed * 1000, endpoint,
+                                re.sub(r'\s+', ' ', statement)[:MAX_LOGGED_STATEMENT], parameter_shape(parameters))
+
+    def _start_request(self):
+        """
+        Notes the time the request starts.
+        """
+        g.request_started_at = time.perf_counter()
+
+    def _finish_request(self, response):
+        """
+        Records the request in the endpoint's histograms and adds the Server-Timing header.
+        """
+        started_at = g.get('request_started_at')
+        if started_at is None:
+            return response
+        total = time.perf_counter() - started_at
+        query_count = g.get('query_count', 0)
+        query_time = g.get('query_time', 0.0)
+        endpoint = request.endpoint or UNMATCHED_ENDPOINT
+        with self._lock:
+            self._histogram(self._durations, endpoint, DURATION_BUCKETS).observe(total)
+            self._histogram(self._db_times, endpoint, DURATION_BUCKETS).observe(query_time)
+            self._histogram(self._query_counts, endpoint, QUERY_COUNT_BUCKETS).observe(query_count)
+        if self.server_timing:
+            # Server-Timing durations are in milliseconds
+            response.headers['Server-Timing'] = (f'db;dur={query_time * 1000:.2f};desc="{query_count} queries", '
+                                                 f'total;dur={total * 1000:.2f}')
+        return response
+
+    @staticmethod
+    def _histogram(histograms, endpoint, buckets):
+        """
+        Returns the histogram of an endpoint, creating it on first use.
+        """
+        if endpoint not in histograms:
+            histograms[endpoint] = Histogram(buckets)
+        return histograms[endpoint]
+
+    def render_prometheus(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        metrics = (
+            ('asd4me_request_duration_seconds', 'Time spent handling requests, by endpoint.', self._durations),
+            ('asd4me_request_db_seconds', 'Time spent waiting for SQL statements per request, by endpoint.',
+             self._db_times),
+            ('asd4me_request_queries', 'Number of SQL statements run per request, by endpoint.', self._query_counts),
+        )
+        lines = []
+        with self._lock:
+            for name, description, histograms in metrics:
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} histogram')
+                for endpoint in sorted(histograms):
+                    lines.extend(histograms[endpoint].render(name, f'endpoint="{_label_value(endpoint)}"'))
+            lines.append('# HELP asd4me_slow_queries_total SQL statements slower than SLOW_QUERY_MS, by endpoint.')
+            lines.append('# TYPE asd4me_slow_queries_total counter')
+            for endpoint in sorted(self._slow_queries):
+                lines.append(f'asd4me_slow_queries_total{{endpoint="{_label_value(endpoint)}"}} '
+                             f'{self._slow_queries[endpoint]}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,49 @@
+"""
+inventory.py contains the ownership model of the market. A user owns each study guide at most once: the Inventory
+table holds one row per (user, study guide) with the number of copies bought, so buying a guide again adds to the
+row's quantity instead of adding rows. The study guides a user owns are kept in the ownership cache as a set of ids,
+so pages can check whether a guide is already owned in constant time, without a query per guide shown. Cached sets
+live in a single worker process: the process that records a purchase drops the buyer's set right away, and other
+processes notice the purchase when the set expires (OWNERSHIP_CACHE_TTL). The functions in this file are:
+        - add_to_inventory(): Adds bought study guides to a user's inventory with one upsert.
+        - owned_guide_ids(): Returns the ids of the study guides a user owns, from the cache when possible.
+"""
+
+# SQLite's INSERT, which supports ON CONFLICT DO UPDATE (upserts)
+from sqlalchemy.dialects.sqlite import insert
+
+# Database imports
+from extensions import db, ownership_cache
+# Model imports
+from models import Inventory
+
+
+def add_to_inventory(user_id, quantities):
+    """
+    Adds bought study guides (a mapping of study guide id to the number of copies bought) to a user's inventory. Guides
+    the user does not own yet get a new row, and guides they already own get their quantity increased, with one
+    executemany() upsert however many guides there are. The caller commits, then should drop the user from
+    ownership_cache.
+    """
+    if not quantities:
+        return
+    statement = insert(Inventory)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Inventory.user_id, Inventory.study_guide_id],
+        set_={'quantity': Inventory.quantity + statement.excluded.quantity}
+    )
+    db.session.execute(statement, [{'user_id': user_id, 'study_guide_id': study_guide_id, 'quantity': quantity}
+                                   for study_guide_id, quantity in quantities.items()])
+
+
+def owned_guide_ids(user_id):
+    """
+    Returns the ids of the study guides a user owns as a frozenset. The set is read with one query (answered from the
+    unique (user_id, study_guide_id) index alone) and cached, so checking many guides costs nothing more.
+    """
+    owned = ownership_cache.get(user_id)
+    if owned is None:
+        owned = frozenset(db.session.scalars(
+            db.select(Inventory.study_guide_id).where(Inventory.user_id == user_id)))
+        ownership_cache.set(user_id, owned)
+    return owned
@@ -0,0 +1,186 @@
+"""
+ledger.py contains the wallet ledger. Every change to a wallet appends a WalletLedger entry (a signed amount) in the
+same transaction that changes User.wallet, so the wallet column is a materialized balance that can always be audited
+and rebuilt from the ledger. Entries are never edited or deleted. To keep audits cheap as the ledger grows, "flask
+ledger compact" folds the entries of each user into a WalletCheckpoint (the balance up to a ledger id), so a balance
+is its checkpoint plus the few entries written after it. The payout worker also compacts every
+LEDGER_COMPACT_INTERVAL seconds. The functions in this file are:
+        - debit_wallet(): Takes an amount from a wallet if (and only if) the wallet covers it.
+        - credit_wallets(): Adds amounts to several wallets with one statement.
+        - compact_ledger(): Folds the ledger entries written since the last compaction into the checkpoints.
+        - audit_balances(): Returns the users whose wallet does not match the ledger.
+        - rebuild_balances(): Recomputes the checkpoints from the whole ledger and resets every wallet to match.
+        - init_app(): Registers the "flask ledger compact", "flask ledger audit" and "flask ledger rebuild" commands.
+"""
+
+# Imports for the time of entries
+from datetime import datetime, timezone
+
+# General flask imports
+import click
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, text
+
+# Database imports
+from extensions import db, identity_cache
+# Model imports
+from models import User, WalletLedger
+
+# Kinds of ledger entries
+OPENING = 'opening'
+PURCHASE = 'purchase'
+PAYOUT = 'payout'
+ADJUSTMENT = 'adjustment'
+
+# Statement adding an amount to a user's wallet, run once per user with executemany()
+CREDIT_WALLET = (User.__table__.update()
+                 .where(User.__table__.c.id == bindparam('ledger_user_id'))
+                 .values(wallet=User.__table__.c.wallet + bindparam('ledger_amount')))
+
+# Statement folding the entries written since each user's checkpoint (up to :high) into the checkpoint
+COMPACT_LEDGER = text(
+    """INSERT INTO wallet_checkpoint (user_id, balance, ledger_id, updated_at)
+    SELECT wallet_ledger.user_id, COALESCE(wallet_checkpoint.balance, 0) + SUM(wallet_ledger.amount), :high, :now
+    FROM wallet_ledger LEFT JOIN wallet_checkpoint ON wallet_checkpoint.user_id = wallet_ledger.user_id
+    WHERE wallet_ledger.id > COALESCE(wallet_checkpoint.ledger_id, 0) AND wallet_ledger.id <= :high
+    GROUP BY wallet_ledger.user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        balance = excluded.balance, ledger_id = excluded.ledger_id, updated_at = excluded.updated_at"""
+)
+
+# Query of each user's balance according to the ledger: the checkpoint plus the entries written after it
+LEDGER_BALANCES = """SELECT user.id AS user_id, user.wallet AS wallet,
+        COALESCE(wallet_checkpoint.balance, 0) + COALESCE((
+            SELECT SUM(wallet_ledger.amount) FROM wallet_ledger
+            WHERE wallet_ledger.user_id = user.id AND wallet_ledger.id > COALESCE(wallet_checkpoint.ledger_id, 0)
+        ), 0) AS expected
+    FROM user LEFT JOIN wallet_checkpoint ON wallet_checkpoint.user_id = user.id"""
+# The same from the whole ledger, ignoring the checkpoints
+FULL_LEDGER_BALANCES = """SELECT user.id AS user_id, user.wallet AS wallet,
+        COALESCE((SELECT SUM(wallet_ledger.amount) FROM wallet_ledger WHERE wallet_ledger.user_id = user.id), 0)
+        AS expected
+    FROM user"""
+
+# Command group for "flask ledger ..."
+ledger_cli = AppGroup('ledger', help='Compact, audit and rebuild the wallet ledger.')
+
+
+def _now():
+    """
+    Returns the current UTC time, without a time zone like the other times in the database.
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def debit_wallet(user_id, amount, kind=PURCHASE, reference_id=None):
+    """
+    Takes amount from a user's wallet if (and only if) the wallet covers it, and records the debit in the ledger.
+    The check and the write are a single conditional UPDATE, so two debits at once can never both spend the same
+    money, and no lock is held in Python. Returns False (and changes nothing) when the wallet is short. The caller
+    commits.
+    """
+    debited = db.session.execute(
+        db.update(User)
+        .where(User.id == user_id, User.wallet >= amount)
+        .values(wallet=User.wallet - amount)
+    )
+    if debited.rowcount == 0:
+        return False
+    db.session.execute(db.insert(WalletLedger).values(user_id=user_id, amount=-amount, kind=kind,
+                                                      reference_id=reference_id, created_at=_now()))
+    return True
+
+
+def credit_wallets(amounts, kind=PAYOUT):
+    """
+    Adds amounts (a mapping of user id to amount) to the users' wallets and records the credits in the ledger, with
+    one executemany() UPDATE and one executemany() INSERT however many users there are. The caller commits, then
+    should drop the users from identity_cache.
+    """
+    if not amounts:
+        return
+    db.session.execute(CREDIT_WALLET, [{'ledger_user_id': user_id, 'ledger_amount': amount}
+                                       for user_id, amount in amounts.items()])
+    now = _now()
+    db.session.execute(db.insert(WalletLedger), [{'user_id': user_id, 'amount': amount, 'kind': kind,
+                                                  'created_at': now} for user_id, amount in amounts.items()])
+
+
+def compact_ledger():
+    """
+    Folds the ledger entries written since the last compaction into the checkpoints, and returns the number of users
+    whose checkpoint moved. Entries are kept; only the checkpoints change.
+    """
+    high = db.session.scalar(db.select(db.func.max(WalletLedger.id)))
+    if high is None:
+        return 0
+    compacted = db.session.execute(COMPACT_LEDGER, {'high': high, 'now': _now()}).rowcount
+    db.session.commit()
+    return compacted
+
+
+def audit_balances(full=False):
+    """
+    Returns (user id, wallet, balance according to the ledger) for every user whose wallet does not match the
+    ledger. By default balances are read from the checkpoints plus the entries after them; with full=True they are
+    summed from the whole ledger, which also checks the checkpoints.
+    """
+    balances = FULL_LEDGER_BALANCES if full else LEDGER_BALANCES
+    return db.session.execute(
+        text(f'SELECT user_id, wallet, expected FROM ({balances}) WHERE wallet != expected ORDER BY user_id')
+    ).all()
+
+
+def rebuild_balances():
+    """
+    Recomputes every checkpoint from the whole ledger and resets every wallet to its balance according to the ledger,
+    in one transaction. Returns the number of wallets that changed.
+    """
+    # Emptying the checkpoints takes the write lock, so no entries are added while the balances are rebuilt
+    db.session.execute(text('DELETE FROM wallet_checkpoint'))
+    high = db.session.scalar(db.select(db.func.max(WalletLedger.id)))
+    if high is not None:
+        db.session.execute(COMPACT_LEDGER, {'high': high, 'now': _now()})
+    balance = 'COALESCE((SELECT balance FROM wallet_checkpoint WHERE wallet_checkpoint.user_id = user.id), 0)'
+    changed = db.session.execute(text(f'UPDATE user SET wallet = {balance} WHERE wallet != {balance}')).rowcount
+    db.session.commit()
+    # Every cached user may now hold a stale wallet
+    identity_cache.clear()
+    return changed
+
+
+@ledger_cli.command('compact')
+def compact_command():
+    """
+    Fold the ledger entries written since the last compaction into the checkpoints.
+    """
+    click.echo(f'Compacted the ledger of {compact_ledger()} users')
+
+
+@ledger_cli.command('audit')
+@click.option('--full', is_flag=True, help='Sum the whole ledger instead of starting from the checkpoints.')
+def audit_command(full):
+    """
+    Check every wallet against the ledger (exits with status 1 on a mismatch).
+    """
+    mismatches = audit_balances(full=full)
+    for user_id, wallet, expected in mismatches:
+        click.echo(f'User {user_id}: wallet {wallet}, ledger {expected}', err=True)
+    if mismatches:
+        raise click.ClickException(f'{len(mismatches)} wallets do not match the ledger')
+    click.echo('Every wallet matches the ledger')
+
+
+@ledger_cli.command('rebuild')
+def rebuild_command():
+    """
+    Recompute the checkpoints from the whole ledger and reset every wallet to match.
+    """
+    click.echo(f'Rebuilt the balances, {rebuild_balances()} wallets changed')
+
+
+def init_app(app):
+    """
+    Registers the "flask ledger" commands.
+    """
+    app.cli.add_command(ledger_cli)
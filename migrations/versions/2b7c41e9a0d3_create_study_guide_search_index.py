@@ -0,0 +1,50 @@
+"""Create study guide search index
+
+Revision ID: 2b7c41e9a0d3
+Revises: 813580dee35a
+Create Date: 2024-06-12 16:04:21.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7c41e9a0d3'
+down_revision = '813580dee35a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # FTS5 virtual table over study_guide, kept in sync by triggers (see search_index.py)
+    op.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS study_guide_fts USING fts5(
+        "Class", "UnitTopic", "Creator",
+        content='study_guide', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""")
+    op.execute("""CREATE TRIGGER IF NOT EXISTS study_guide_fts_ai AFTER INSERT ON study_guide BEGIN
+        INSERT INTO study_guide_fts(rowid, "Class", "UnitTopic", "Creator")
+        VALUES (new.id, new."Class", new."UnitTopic", new."Creator");
+    END""")
+    op.execute("""CREATE TRIGGER IF NOT EXISTS study_guide_fts_ad AFTER DELETE ON study_guide BEGIN
+        INSERT INTO study_guide_fts(study_guide_fts, rowid, "Class", "UnitTopic", "Creator")
+        VALUES ('delete', old.id, old."Class", old."UnitTopic", old."Creator");
+    END""")
+    # Only updates of the searched columns touch the index (as in search_index.py)
+    op.execute("""CREATE TRIGGER IF NOT EXISTS study_guide_fts_au
+    AFTER UPDATE OF "Class", "UnitTopic", "Creator" ON study_guide BEGIN
+        INSERT INTO study_guide_fts(study_guide_fts, rowid, "Class", "UnitTopic", "Creator")
+        VALUES ('delete', old.id, old."Class", old."UnitTopic", old."Creator");
+        INSERT INTO study_guide_fts(rowid, "Class", "UnitTopic", "Creator")
+        VALUES (new.id, new."Class", new."UnitTopic", new."Creator");
+    END""")
+    # Index the study guides that already exist
+    op.execute("INSERT INTO study_guide_fts(study_guide_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS study_guide_fts_au")
+    op.execute("DROP TRIGGER IF EXISTS study_guide_fts_ad")
+    op.execute("DROP TRIGGER IF EXISTS study_guide_fts_ai")
+    op.execute("DROP TABLE IF EXISTS study_guide_fts")
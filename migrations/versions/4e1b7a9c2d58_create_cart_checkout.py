@@ -0,0 +1,30 @@
+"""Create cart checkout
+
+Revision ID: 4e1b7a9c2d58
+Revises: a6c2e9f40b18
+Create Date: 2024-07-08 11:17:52.604381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e1b7a9c2d58'
+down_revision = 'a6c2e9f40b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cart_checkout',
+    sa.Column('nonce', sa.String(length=32), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('nonce')
+    )
+
+
+def downgrade():
+    op.drop_table('cart_checkout')
@@ -0,0 +1,91 @@
+"""Add lookup indexes and creator_id
+
+Revision ID: 5f0d9c2e8b41
+Revises: 2b7c41e9a0d3
+Create Date: 2024-06-14 10:37:52.604119
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f0d9c2e8b41'
+down_revision = '2b7c41e9a0d3'
+branch_labels = None
+depends_on = None
+
+# Search index trigger that only fires when a searched column changes (replaces the one from 2b7c41e9a0d3)
+SEARCH_INDEX_UPDATE_TRIGGER = """CREATE TRIGGER IF NOT EXISTS study_guide_fts_au
+    AFTER UPDATE OF "Class", "UnitTopic", "Creator" ON study_guide BEGIN
+        INSERT INTO study_guide_fts(study_guide_fts, rowid, "Class", "UnitTopic", "Creator")
+        VALUES ('delete', old.id, old."Class", old."UnitTopic", old."Creator");
+        INSERT INTO study_guide_fts(rowid, "Class", "UnitTopic", "Creator")
+        VALUES (new.id, new."Class", new."UnitTopic", new."Creator");
+    END"""
+# All of the search index triggers, recreated after batch mode copies study_guide
+SEARCH_INDEX_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS study_guide_fts_ai AFTER INSERT ON study_guide BEGIN
+        INSERT INTO study_guide_fts(rowid, "Class", "UnitTopic", "Creator")
+        VALUES (new.id, new."Class", new."UnitTopic", new."Creator");
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS study_guide_fts_ad AFTER DELETE ON study_guide BEGIN
+        INSERT INTO study_guide_fts(study_guide_fts, rowid, "Class", "UnitTopic", "Creator")
+        VALUES ('delete', old.id, old."Class", old."UnitTopic", old."Creator");
+    END""",
+    SEARCH_INDEX_UPDATE_TRIGGER,
+)
+# Number of study guides given a creator_id per UPDATE, so the backfill never holds the write lock for long
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def backfill_creator_id(table):
+    """
+    Sets creator_id from the Creator username, one chunk of ids at a time. Each chunk is an index range scan on the
+    primary key plus one user.username index lookup per row.
+    """
+    connection = op.get_bind()
+    max_id = connection.execute(sa.text(f'SELECT MAX(id) FROM {table}')).scalar() or 0
+    for start in range(0, max_id + 1, BACKFILL_CHUNK_SIZE):
+        connection.execute(
+            sa.text(f'UPDATE {table} SET creator_id = (SELECT user.id FROM user WHERE user.username = {table}."Creator") '
+                    f'WHERE id >= :start AND id < :end AND creator_id IS NULL'),
+            {'start': start, 'end': start + BACKFILL_CHUNK_SIZE}
+        )
+
+
+def upgrade():
+    # Keep only the first row of any duplicated (cart, study guide) pair so the unique index can be created
+    op.execute('DELETE FROM cart_item WHERE id NOT IN (SELECT MIN(id) FROM cart_item GROUP BY cart_id, study_guide_id)')
+    # Cart items are looked up by cart and by (cart, study guide). The unique index serves both (cart_id is its first
+    # column) and stops the same guide from being added to a cart twice
+    op.create_index('ix_cart_item_cart_id_study_guide_id', 'cart_item', ['cart_id', 'study_guide_id'], unique=True)
+    # Inventory is looked up by owner and by study guide
+    op.create_index('ix_inventory_user_id', 'inventory', ['user_id'], unique=False)
+    op.create_index('ix_inventory_study_guide_id', 'inventory', ['study_guide_id'], unique=False)
+
+    # Only reindex study guides for search when a searched column changes, so the backfill below does not rewrite the
+    # search index
+    op.execute('DROP TRIGGER IF EXISTS study_guide_fts_au')
+    op.execute(SEARCH_INDEX_UPDATE_TRIGGER)
+
+    # Link study guides to their creator by id instead of by username. SQLite can add a nullable column with a
+    # REFERENCES clause in place, which avoids the full table copy of batch mode (and keeps the search index triggers)
+    for table in ('study_guide', 'pending_study_guide'):
+        op.execute(f'ALTER TABLE {table} ADD COLUMN creator_id INTEGER REFERENCES user (id)')
+        op.create_index(f'ix_{table}_creator_id', table, ['creator_id'], unique=False)
+        backfill_creator_id(table)
+
+
+def downgrade():
+    for table in ('pending_study_guide', 'study_guide'):
+        op.drop_index(f'ix_{table}_creator_id', table_name=table)
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('creator_id')
+    # Batch mode recreated study_guide, which dropped its triggers, so put back the search index triggers
+    for trigger in SEARCH_INDEX_TRIGGERS:
+        op.execute(trigger)
+
+    op.drop_index('ix_inventory_study_guide_id', table_name='inventory')
+    op.drop_index('ix_inventory_user_id', table_name='inventory')
+    op.drop_index('ix_cart_item_cart_id_study_guide_id', table_name='cart_item')
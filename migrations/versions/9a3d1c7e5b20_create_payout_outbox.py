@@ -0,0 +1,41 @@
+"""Create payout outbox
+
+Revision ID: 9a3d1c7e5b20
+Revises: 5f0d9c2e8b41
+Create Date: 2024-06-21 16:05:11.270344
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a3d1c7e5b20'
+down_revision = '5f0d9c2e8b41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('payout_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('creator_id', sa.Integer(), nullable=False),
+    sa.Column('study_guide_id', sa.Integer(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('applied_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['creator_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['study_guide_id'], ['study_guide.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_payout_outbox_creator_id', 'payout_outbox', ['creator_id'], unique=False)
+    # Only the rows that are still owed are indexed, so the worker's lookup stays small as paid rows pile up
+    op.create_index('ix_payout_outbox_pending', 'payout_outbox', ['id'], unique=False,
+                    sqlite_where=sa.text('applied_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_payout_outbox_pending', table_name='payout_outbox')
+    op.drop_index('ix_payout_outbox_creator_id', table_name='payout_outbox')
+    op.drop_table('payout_outbox')
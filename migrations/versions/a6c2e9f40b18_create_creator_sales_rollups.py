@@ -0,0 +1,51 @@
+"""Create creator sales rollups
+
+Revision ID: a6c2e9f40b18
+Revises: d3f8a61c2e57
+Create Date: 2024-07-05 16:22:40.918357
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6c2e9f40b18'
+down_revision = 'd3f8a61c2e57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('guide_sales',
+    sa.Column('study_guide_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('creator_id', sa.Integer(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.Column('revenue', sa.Integer(), nullable=False),
+    sa.Column('last_sold_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['creator_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['study_guide_id'], ['study_guide.id'], ),
+    sa.PrimaryKeyConstraint('study_guide_id')
+    )
+    op.create_index('ix_guide_sales_creator_id_revenue', 'guide_sales', ['creator_id', 'revenue'], unique=False)
+    op.create_table('creator_daily_sales',
+    sa.Column('creator_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.Column('revenue', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['creator_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('creator_id', 'day')
+    )
+    # Roll up the sales already recorded in the payout outbox (as "flask sales rebuild" does)
+    op.execute("""INSERT INTO guide_sales (study_guide_id, creator_id, units, revenue, last_sold_at)
+        SELECT study_guide_id, MAX(creator_id), SUM(units), SUM(amount), MAX(created_at)
+        FROM payout_outbox GROUP BY study_guide_id""")
+    op.execute("""INSERT INTO creator_daily_sales (creator_id, day, units, revenue)
+        SELECT creator_id, date(created_at), SUM(units), SUM(amount)
+        FROM payout_outbox GROUP BY creator_id, date(created_at)""")
+
+
+def downgrade():
+    op.drop_table('creator_daily_sales')
+    op.drop_index('ix_guide_sales_creator_id_revenue', table_name='guide_sales')
+    op.drop_table('guide_sales')
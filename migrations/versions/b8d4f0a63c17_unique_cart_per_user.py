@@ -0,0 +1,36 @@
+"""Unique cart per user
+
+Revision ID: b8d4f0a63c17
+Revises: e7a2c95b1f48
+Create Date: 2024-06-28 14:03:27.559102
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d4f0a63c17'
+down_revision = 'e7a2c95b1f48'
+branch_labels = None
+depends_on = None
+
+# The cart each user keeps (their first one)
+KEPT_CARTS = 'SELECT MIN(id) FROM cart GROUP BY user_id'
+
+
+def upgrade():
+    # Merge the items of any extra carts into the user's first cart (items already in it are left behind), then delete
+    # the extra carts and what is left in them, so the unique index can be created
+    op.execute(f"""UPDATE OR IGNORE cart_item
+        SET cart_id = (SELECT MIN(kept.id) FROM cart AS kept
+                       WHERE kept.user_id = (SELECT cart.user_id FROM cart WHERE cart.id = cart_item.cart_id))
+        WHERE cart_id NOT IN ({KEPT_CARTS})""")
+    op.execute(f'DELETE FROM cart_item WHERE cart_id NOT IN ({KEPT_CARTS})')
+    op.execute(f'DELETE FROM cart WHERE id NOT IN ({KEPT_CARTS})')
+    # One cart per user; the index also serves looking up a user's cart
+    op.create_index('ix_cart_user_id', 'cart', ['user_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_cart_user_id', table_name='cart')
@@ -0,0 +1,47 @@
+"""Create wallet ledger
+
+Revision ID: c41f7b2d9e63
+Revises: 9a3d1c7e5b20
+Create Date: 2024-06-25 11:42:03.815527
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41f7b2d9e63'
+down_revision = '9a3d1c7e5b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('wallet_ledger',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('reference_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_wallet_ledger_user_id_id', 'wallet_ledger', ['user_id', 'id'], unique=False)
+    op.create_table('wallet_checkpoint',
+    sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('balance', sa.Integer(), nullable=False),
+    sa.Column('ledger_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    # Open the ledger with every existing balance, so the ledger accounts for every wallet from the start
+    op.execute("INSERT INTO wallet_ledger (user_id, amount, kind, created_at) "
+               "SELECT id, wallet, 'opening', strftime('%Y-%m-%d %H:%M:%f', 'now') FROM user WHERE wallet != 0")
+
+
+def downgrade():
+    op.drop_table('wallet_checkpoint')
+    op.drop_index('ix_wallet_ledger_user_id_id', table_name='wallet_ledger')
+    op.drop_table('wallet_ledger')
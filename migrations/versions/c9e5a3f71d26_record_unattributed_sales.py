@@ -0,0 +1,41 @@
+"""Record unattributed sales
+
+Revision ID: c9e5a3f71d26
+Revises: 4e1b7a9c2d58
+Create Date: 2024-07-09 10:05:33.471920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9e5a3f71d26'
+down_revision = '4e1b7a9c2d58'
+branch_labels = None
+depends_on = None
+
+# Tables whose creator_id becomes optional, so sales of study guides without a creator account can be recorded
+TABLES = ('payout_outbox', 'guide_sales')
+
+
+def alter_creator_id(nullable):
+    # Batch mode copies the tables, and may not carry over the WHERE clause of the partial index of owed payouts, so
+    # drop it first and create it again afterwards
+    op.drop_index('ix_payout_outbox_pending', table_name='payout_outbox')
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.alter_column('creator_id', existing_type=sa.Integer(), nullable=nullable)
+    op.create_index('ix_payout_outbox_pending', 'payout_outbox', ['id'], unique=False,
+                    sqlite_where=sa.text('applied_at IS NULL'))
+
+
+def upgrade():
+    alter_creator_id(nullable=True)
+
+
+def downgrade():
+    # Unattributed sales cannot be kept without a creator
+    for table in TABLES:
+        op.execute(f'DELETE FROM {table} WHERE creator_id IS NULL')
+    alter_creator_id(nullable=False)
@@ -0,0 +1,49 @@
+"""Add catalog facets and listing indexes
+
+Revision ID: d3f8a61c2e57
+Revises: b8d4f0a63c17
+Create Date: 2024-07-02 09:41:18.203746
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f8a61c2e57'
+down_revision = 'b8d4f0a63c17'
+branch_labels = None
+depends_on = None
+
+# Covering indexes of the catalog listing, by name (see StudyGuide in models.py)
+LISTING_INDEXES = {
+    'ix_study_guide_price_listing': ['Price', 'id', 'Class', 'UnitTopic', 'Creator'],
+    'ix_study_guide_class_listing': ['Class', 'id', 'UnitTopic', 'Price', 'Creator'],
+    'ix_study_guide_class_price_listing': ['Class', 'Price', 'id', 'UnitTopic', 'Creator'],
+    'ix_study_guide_creator_listing': ['Creator', 'id', 'Class', 'UnitTopic', 'Price'],
+    'ix_study_guide_creator_price_listing': ['Creator', 'Price', 'id', 'Class', 'UnitTopic'],
+}
+# Price range of a study guide, as the text of its lowest price (PRICE_BUCKETS in facets.py)
+PRICE_BUCKET = """CASE WHEN "Price" >= 100 THEN '100' WHEN "Price" >= 50 THEN '50' WHEN "Price" >= 20 THEN '20'
+    WHEN "Price" >= 10 THEN '10' WHEN "Price" >= 5 THEN '5' ELSE '0' END"""
+
+
+def upgrade():
+    op.create_table('catalog_facet',
+    sa.Column('facet', sa.String(length=10), nullable=False),
+    sa.Column('value', sa.String(length=20), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('facet', 'value')
+    )
+    # Count the guides already in the catalog under each facet value
+    for facet, column in (('class', '"Class"'), ('creator', '"Creator"'), ('price', PRICE_BUCKET)):
+        op.execute(f"""INSERT INTO catalog_facet (facet, value, count)
+            SELECT '{facet}', {column}, COUNT(*) FROM study_guide GROUP BY {column}""")
+    for name, columns in LISTING_INDEXES.items():
+        op.create_index(name, 'study_guide', columns, unique=False)
+
+
+def downgrade():
+    for name in LISTING_INDEXES:
+        op.drop_index(name, table_name='study_guide')
+    op.drop_table('catalog_facet')
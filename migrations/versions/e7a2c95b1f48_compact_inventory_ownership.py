@@ -0,0 +1,63 @@
+"""Compact inventory to one row per owned guide
+
+Revision ID: e7a2c95b1f48
+Revises: c41f7b2d9e63
+Create Date: 2024-06-27 09:15:44.203871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2c95b1f48'
+down_revision = 'c41f7b2d9e63'
+branch_labels = None
+depends_on = None
+
+
+def create_inventory_table(name, with_quantity):
+    """
+    Creates an inventory table under a temporary name, with or without the quantity column.
+    """
+    op.create_table(name,
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('study_guide_id', sa.Integer(), nullable=False),
+    *([sa.Column('quantity', sa.Integer(), nullable=False)] if with_quantity else []),
+    sa.ForeignKeyConstraint(['study_guide_id'], ['study_guide.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def upgrade():
+    # Fold the rows of each (user, study guide) into one row counting them. The row keeps the id of the latest copy,
+    # so the inventory stays in the order the guides were last bought
+    create_inventory_table('inventory_compact', with_quantity=True)
+    op.execute('INSERT INTO inventory_compact (id, user_id, study_guide_id, quantity) '
+               'SELECT MAX(id), user_id, study_guide_id, COUNT(*) FROM inventory GROUP BY user_id, study_guide_id')
+    # Replace the old table (dropping it drops its indexes too)
+    op.drop_table('inventory')
+    op.rename_table('inventory_compact', 'inventory')
+    # One row per owned guide; the unique index also serves lookups by owner
+    op.create_index('ix_inventory_user_id_study_guide_id', 'inventory', ['user_id', 'study_guide_id'], unique=True)
+    op.create_index('ix_inventory_study_guide_id', 'inventory', ['study_guide_id'], unique=False)
+
+
+def downgrade():
+    # Expand each row back into one row per copy (the copies get new ids, in the order of the rows)
+    create_inventory_table('inventory_expanded', with_quantity=False)
+    op.execute(
+        """WITH RECURSIVE copies(id, user_id, study_guide_id, remaining) AS (
+            SELECT id, user_id, study_guide_id, quantity FROM inventory
+            UNION ALL
+            SELECT id, user_id, study_guide_id, remaining - 1 FROM copies WHERE remaining > 1
+        )
+        INSERT INTO inventory_expanded (user_id, study_guide_id)
+        SELECT user_id, study_guide_id FROM copies ORDER BY id"""
+    )
+    op.drop_table('inventory')
+    op.rename_table('inventory_expanded', 'inventory')
+    op.create_index('ix_inventory_user_id', 'inventory', ['user_id'], unique=False)
+    op.create_index('ix_inventory_study_guide_id', 'inventory', ['study_guide_id'], unique=False)
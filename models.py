@@ -33,13 +33,40 @@ class StudyGuide(db.Model):
     - Price: The price of the study guide
     - Creator: The creator of the study guide
     - Link: The link to the study guide
+    - creator_id: The foreign key to the User table for the creator (indexed, used instead of joining on Creator)
+    The listing indexes hold every column the catalog listing shows (all but Link and creator_id), so the market page,
+    filtered by class or creator or not, and sorted by id or price, is read from an index alone, seeking straight to
+    the page after its cursor. Study guides are only written when approved or imported, so the extra indexes cost
+    little.
     """
+    __table_args__ = (
+        db.Index('ix_study_guide_price_listing', 'Price', 'id', 'Class', 'UnitTopic', 'Creator'),
+        db.Index('ix_study_guide_class_listing', 'Class', 'id', 'UnitTopic', 'Price', 'Creator'),
+        db.Index('ix_study_guide_class_price_listing', 'Class', 'Price', 'id', 'UnitTopic', 'Creator'),
+        db.Index('ix_study_guide_creator_listing', 'Creator', 'id', 'Class', 'UnitTopic', 'Price'),
+        db.Index('ix_study_guide_creator_price_listing', 'Creator', 'Price', 'id', 'Class', 'UnitTopic'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     Class = db.Column(db.String(20), nullable=False)
     UnitTopic = db.Column(db.String(20), nullable=False)
     Price = db.Column(db.Integer, nullable=False)
     Creator = db.Column(db.String(20), nullable=False)
     Link = db.Column(db.String(100), nullable=False)
+    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+
+
+class CatalogFacet(db.Model):
+    """
+    This class creates the CatalogFacet table in the database. It holds the number of study guides in the catalog under
+    each facet value, kept up to date as guides are added (see facets.py), so the market page shows the counts without
+    grouping the catalog. The CatalogFacet table contains the following columns:
+    - facet: What the catalog is narrowed by ('class', 'creator' or 'price'), part of the primary key
+    - value: The class, the creator's username, or the lowest price of the price range, part of the primary key
+    - count: The number of study guides with that value
+    """
+    facet = db.Column(db.String(10), primary_key=True)
+    value = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
 
 
 class PendingStudyGuide(db.Model):
@@ -52,6 +79,7 @@ class PendingStudyGuide(db.Model):
     - Price: The price of the study guide
     - Creator: The creator of the study guide
     - Link: The link to the study guide
+    - creator_id: The foreign key to the User table for the creator (indexed, used instead of joining on Creator)
     """
     id = db.Column(db.Integer, primary_key=True)
     Class = db.Column(db.String(20), nullable=False)
@@ -59,6 +87,7 @@ class PendingStudyGuide(db.Model):
     Price = db.Column(db.Integer, nullable=False)
     Creator = db.Column(db.String(20), nullable=False)
     Link = db.Column(db.String(100), nullable=False)
+    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
 
 
 class Cart(db.Model):
@@ -67,7 +96,10 @@ class Cart(db.Model):
     - id: The primary key of the table
     - user_id: The foreign key to the User table
     - items: A relationship to the CartItem table
+    A unique index on user_id keeps one cart per user, serves lookups by user, and lets the cart be created or found
+    with one upsert (see cart.py).
     """
+    __table_args__ = (db.Index('ix_cart_user_id', 'user_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     items = db.relationship('CartItem', backref='cart', lazy=True)
@@ -81,7 +113,9 @@ class CartItem(db.Model):
     - study_guide_id: The foreign key to the StudyGuide table
     - quantity: The quantity of the study guide in the cart
     - study_guide: A relationship to the StudyGuide table
+    A unique index on (cart_id, study_guide_id) serves lookups by cart and stops a guide being added to a cart twice.
     """
+    __table_args__ = (db.Index('ix_cart_item_cart_id_study_guide_id', 'cart_id', 'study_guide_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     cart_id = db.Column(db.Integer, db.ForeignKey('cart.id'), nullable=False)
     study_guide_id = db.Column(db.Integer, db.ForeignKey('study_guide.id'), nullable=False)
@@ -89,17 +123,138 @@ class CartItem(db.Model):
     study_guide = db.relationship('StudyGuide')
 
 
+class CartCheckout(db.Model):
+    """
+    This class creates the CartCheckout table in the database. Each session cart (see cart.py) carries a random nonce,
+    and checking it out inserts the nonce here in the checkout transaction, so a cart can only be bought once even if
+    an old copy of the session cookie is sent again. The CartCheckout table contains the following columns:
+    - nonce: The primary key of the table, the nonce of the cart checked out
+    - user_id: The foreign key to the User table for the buyer
+    - created_at: The time of the checkout (UTC)
+    """
+    nonce = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+
 class Inventory(db.Model):
     """
-    This class creates the Inventory table in the database. The Inventory table contains the following columns:
-    - id: The primary key of the table
+    This class creates the Inventory table in the database. A user owns each study guide at most once, so the table
+    holds one row per (user, study guide) with the number of copies bought (see inventory.py). The Inventory table
+    contains the following columns:
+    - id: The primary key of the table (a guide bought again keeps its row, and so its place in the inventory)
     - user_id: The foreign key to the User table
     - study_guide_id: The foreign key to the StudyGuide table
+    - quantity: The number of copies of the study guide the user bought
     - study_guide: A relationship to the StudyGuide table
     - user: A relationship to the User table
+    A unique index on (user_id, study_guide_id) keeps one row per owned guide, serves lookups by owner, and answers
+    "which guides does this user own" without reading the table.
     """
+    __table_args__ = (db.Index('ix_inventory_user_id_study_guide_id', 'user_id', 'study_guide_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    study_guide_id = db.Column(db.Integer, db.ForeignKey('study_guide.id'), nullable=False)
+    study_guide_id = db.Column(db.Integer, db.ForeignKey('study_guide.id'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False, default=1)
     study_guide = db.relationship('StudyGuide')
     user = db.relationship('User', backref='inventory_items')
+
+
+class PayoutOutbox(db.Model):
+    """
+    This class creates the PayoutOutbox table in the database. Checkout writes one row per study guide sold, and the
+    payout worker in payouts.py later adds the amounts to the creators' wallets, so checkout does not have to update
+    every creator's wallet itself. The PayoutOutbox table contains the following columns:
+    - id: The primary key of the table
+    - creator_id: The foreign key to the User table for the creator being paid, or None for a study guide without a
+    creator account (such a sale is written already applied, since there is nobody to pay)
+    - study_guide_id: The foreign key to the StudyGuide table for the study guide sold
+    - units: The number of copies sold
+    - amount: The amount owed to the creator (price times units)
+    - created_at: The time of the sale (UTC)
+    - applied_at: The time the amount was added to the creator's wallet (UTC), or None while it is still owed
+    A partial index on the rows that are still owed lets the worker find them without scanning the paid ones.
+    """
+    __table_args__ = (db.Index('ix_payout_outbox_pending', 'id', sqlite_where=db.text('applied_at IS NULL')),)
+    id = db.Column(db.Integer, primary_key=True)
+    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    study_guide_id = db.Column(db.Integer, db.ForeignKey('study_guide.id'), nullable=False)
+    units = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=True)
+
+
+class GuideSales(db.Model):
+    """
+    This class creates the GuideSales table in the database. It holds the sales of each study guide sold so far, added
+    to by every checkout (see sales.py), so the creator dashboard does not have to add up purchases. The GuideSales
+    table contains the following columns:
+    - study_guide_id: The primary key of the table, and the foreign key to the StudyGuide table
+    - creator_id: The foreign key to the User table for the creator of the study guide, or None for a guide without a
+    creator account (the rows with None are the unattributed sales, counted so the totals match what buyers paid)
+    - units: The number of copies sold
+    - revenue: The amount the copies sold for
+    - last_sold_at: The time of the latest sale (UTC)
+    An index on (creator_id, revenue) serves a creator's best selling guides.
+    """
+    __table_args__ = (db.Index('ix_guide_sales_creator_id_revenue', 'creator_id', 'revenue'),)
+    study_guide_id = db.Column(db.Integer, db.ForeignKey('study_guide.id'), primary_key=True, autoincrement=False)
+    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Integer, nullable=False, default=0)
+    last_sold_at = db.Column(db.DateTime, nullable=False)
+
+
+class CreatorDailySales(db.Model):
+    """
+    This class creates the CreatorDailySales table in the database. It holds the sales of each creator on each UTC day
+    they sold something, added to by every checkout (see sales.py). The CreatorDailySales table contains the following
+    columns:
+    - creator_id: The foreign key to the User table for the creator, part of the primary key
+    - day: The day of the sales (UTC), part of the primary key
+    - units: The number of copies sold that day
+    - revenue: The amount they sold for
+    """
+    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, autoincrement=False)
+    day = db.Column(db.Date, primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Integer, nullable=False, default=0)
+
+
+class WalletLedger(db.Model):
+    """
+    This class creates the WalletLedger table in the database. Every change to a wallet appends an entry in the same
+    transaction that changes User.wallet, and entries are never edited or deleted, so wallets can be audited and
+    rebuilt from the ledger (see ledger.py). The WalletLedger table contains the following columns:
+    - id: The primary key of the table (entries are in the order they were written)
+    - user_id: The foreign key to the User table for the wallet that changed
+    - amount: The change to the wallet (negative for purchases)
+    - kind: What changed the wallet ('opening', 'purchase', 'payout' or 'adjustment')
+    - reference_id: The id of what caused the change, if any (the cart checked out for purchases)
+    - created_at: The time of the change (UTC)
+    An index on (user_id, id) serves summing a user's entries after their checkpoint.
+    """
+    __table_args__ = (db.Index('ix_wallet_ledger_user_id_id', 'user_id', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    reference_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+
+class WalletCheckpoint(db.Model):
+    """
+    This class creates the WalletCheckpoint table in the database. A checkpoint is a user's balance after every ledger
+    entry up to ledger_id, so a balance can be checked without summing the user's whole ledger. The WalletCheckpoint
+    table contains the following columns:
+    - user_id: The primary key of the table, and the foreign key to the User table
+    - balance: The sum of the user's ledger entries up to ledger_id
+    - ledger_id: The id of the last ledger entry folded into the balance
+    - updated_at: The time of the last compaction that moved the checkpoint (UTC)
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, autoincrement=False)
+    balance = db.Column(db.Integer, nullable=False)
+    ledger_id = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
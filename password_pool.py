@@ -0,0 +1,98 @@
+"""
+password_pool.py contains the password hasher used by login() and signup(). bcrypt is slow on purpose, so instead of
+hashing on the request thread, hashes are computed by a small pool of worker threads (bcrypt releases the GIL while it
+works). Only a limited number of hashes may be running or waiting at once; when the pool is full, requests fail fast
+with HashingBusy, which ASD4ME.py turns into a 503 response with a Retry-After header. gunicorn runs threaded
+workers (gunicorn.conf.py) with more request threads than the pool has slots, so while logins wait for their hashes
+the worker's other threads keep serving other requests, and a burst of logins gets 503s instead of every thread. The
+classes in this file are:
+        - HashingBusy: Raised when the pool is full, or a hash took longer than the configured timeout.
+        - PasswordHasher: Extension that runs Flask-Bcrypt's hashing in the bounded pool.
+"""
+
+# Imports for the thread pool and the limit on queued hashes
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+class HashingBusy(Exception):
+    """
+    Raised when the pool is full, or a hash took longer than the configured timeout.
+    - retry_after: The number of seconds the client should wait before trying again
+    """
+
+    def __init__(self, retry_after):
+        super().__init__('Password hashing pool is busy')
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """
+    Extension that runs the hashing of a Flask-Bcrypt instance in a bounded thread pool. init_app() reads these config
+    keys:
+    - PASSWORD_HASH_WORKERS: The number of hashes computed at the same time
+    - PASSWORD_HASH_QUEUE_DEPTH: The number of hashes allowed to wait for a free worker
+    - PASSWORD_HASH_TIMEOUT: The number of seconds a request waits for its hash before giving up
+    - PASSWORD_HASH_RETRY_AFTER: The number of seconds sent in the Retry-After header when the pool is busy
+    - BCRYPT_LOG_ROUNDS: The bcrypt cost factor of new hashes (read by Flask-Bcrypt, used here to spot old hashes)
+    """
+
+    def __init__(self, bcrypt):
+        # Flask-Bcrypt instance that does the hashing
+        self.bcrypt = bcrypt
+        self.rounds = 12
+        self.timeout = 10
+        self.retry_after = 2
+        self._executor = None
+        self._slots = None
+
+    def init_app(self, app):
+        """
+        Creates the pool from the app config. The worker threads only start when the first hash is submitted.
+        """
+        workers = app.config.get('PASSWORD_HASH_WORKERS', 2)
+        queue_depth = app.config.get('PASSWORD_HASH_QUEUE_DEPTH', 16)
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', 10)
+        self.retry_after = app.config.get('PASSWORD_HASH_RETRY_AFTER', 2)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        # One slot per hash that is running or waiting
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+
+    def _run(self, function, *args):
+        """
+        Runs function in the pool and returns its result. Raises HashingBusy if every slot is taken or the result does
+        not arrive within the timeout.
+        """
+        # Fail fast instead of queueing without limit
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy(self.retry_after)
+        future = self._executor.submit(function, *args)
+        # Free the slot when the hash finishes, even if this request stopped waiting for it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingBusy(self.retry_after)
+
+    def generate_password_hash(self, password):
+        """
+        Returns a new bcrypt hash of password (as a string), using the configured cost factor.
+        """
+        return self._run(self.bcrypt.generate_password_hash, password).decode('utf-8')
+
+    def check_password_hash(self, pw_hash, password):
+        """
+        Returns True if password matches pw_hash.
+        """
+        return self._run(self.bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """
+        Returns True if pw_hash was made with a different cost factor than the configured one. bcrypt hashes look like
+        $2b$12$..., where 12 is the cost factor.
+        """
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
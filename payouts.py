@@ -0,0 +1,185 @@
+"""
+payouts.py contains the payout worker, which pays creators for the study guides they sold. finalize_purchase only
+writes one PayoutOutbox row per study guide sold, inside the checkout transaction; the worker later claims the rows
+that are still owed, a batch at a time, and adds their amounts to the creators' wallets. Claiming a batch (setting
+applied_at) and crediting the wallets happen in the same transaction, so every row is paid exactly once even when
+several workers run at the same time or a batch fails halfway. The worker runs as a background thread in each app
+process (PAYOUT_WORKER = 'thread'), or as a separate "flask worker" process (PAYOUT_WORKER = 'off' in the app). The
+classes and functions in this file are:
+        - apply_payouts(): Pays one batch of owed payouts and returns the number of rows paid.
+        - PayoutWorker: Background thread that keeps paying payouts as they are written (and compacts the wallet
+        ledger now and then).
+        - worker_command(): The "flask worker" command, which pays payouts in the foreground.
+"""
+
+# Imports for the worker thread and the payout times
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+# General flask imports
+import click
+
+# Database imports
+from extensions import db, identity_cache
+# Wallet ledger imports
+from ledger import PAYOUT, compact_ledger, credit_wallets
+# Model imports
+from models import PayoutOutbox
+
+
+def apply_payouts(batch_size=500):
+    """
+    Pays one batch of at most batch_size owed payouts, oldest first, and returns the number of rows paid. The batch is
+    claimed with an UPDATE ... RETURNING, which takes the write lock before anything is read, so two workers never
+    claim the same row.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    # Mark the oldest owed rows as paid and get their creators and amounts
+    owed = (db.select(PayoutOutbox.id)
+            .where(PayoutOutbox.applied_at.is_(None))
+            .order_by(PayoutOutbox.id)
+            .limit(batch_size))
+    claimed = db.session.execute(
+        db.update(PayoutOutbox)
+        .where(PayoutOutbox.id.in_(owed.scalar_subquery()))
+        .values(applied_at=now)
+        .returning(PayoutOutbox.creator_id, PayoutOutbox.amount)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if not claimed:
+        db.session.rollback()
+        return 0
+    # Add up the amounts owed to each creator, and credit every creator of the batch (and record it in the ledger)
+    totals = Counter()
+    for creator_id, amount in claimed:
+        totals[creator_id] += amount
+    credit_wallets(totals, kind=PAYOUT)
+    db.session.commit()
+    # Drop the cached copies of the creators, whose wallets just changed
+    identity_cache.invalidate(*totals)
+    return len(claimed)
+
+
+class PayoutWorker:
+    """
+    Background thread that keeps paying payouts as they are written. init_app() reads these config keys:
+    - PAYOUT_WORKER: 'thread' to run the thread in each app process, 'off' when a "flask worker" process pays them
+    - PAYOUT_BATCH_SIZE: The largest number of payouts paid per transaction
+    - PAYOUT_POLL_INTERVAL: The number of seconds to wait for new payouts when none are owed
+    - LEDGER_COMPACT_INTERVAL: The number of seconds between compactions of the wallet ledger (None turns them off)
+    The thread starts with the first request of each process rather than in init_app(), so the gunicorn master (which
+    builds the app and forks the workers, but serves no requests) never runs one.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.batch_size = 500
+        self.poll_interval = 1.0
+        self.compact_interval = 3600
+        self._thread = None
+        # Process the running thread belongs to (threads do not survive a fork)
+        self._pid = None
+        self._lock = threading.Lock()
+        # Set to wake the thread early, for example right after a checkout
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        """
+        Reads the settings from the app config, registers the "flask worker" command and, when the worker runs as a
+        thread, starts it on the first request.
+        """
+        self.app = app
+        self.enabled = app.config.get('PAYOUT_WORKER', 'thread') == 'thread'
+        self.batch_size = app.config.get('PAYOUT_BATCH_SIZE', self.batch_size)
+        self.poll_interval = app.config.get('PAYOUT_POLL_INTERVAL', self.poll_interval)
+        self.compact_interval = app.config.get('LEDGER_COMPACT_INTERVAL', self.compact_interval)
+        app.cli.add_command(worker_command)
+        if self.enabled:
+            app.before_request(self.start)
+
+    def start(self):
+        """
+        Starts the thread in this process if it is not running yet.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='payout-worker', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """
+        Stops the thread after its current batch.
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self._pid = None
+
+    def notify(self):
+        """
+        Wakes the thread so payouts written by a checkout are paid right away instead of at the next poll.
+        """
+        self._wake.set()
+
+    def _run(self):
+        """
+        Pays payouts until stopped, waiting for a checkout (or the poll interval) whenever none are owed, and compacts
+        the wallet ledger every compact_interval seconds.
+        """
+        compacted_at = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    paid = apply_payouts(self.batch_size)
+                    if self.compact_interval is not None and time.monotonic() - compacted_at >= self.compact_interval:
+                        compact_ledger()
+                        compacted_at = time.monotonic()
+            except Exception:
+                # Log and retry later; a failed batch was rolled back, so its rows are still owed
+                self.app.logger.exception('Payout batch failed')
+                paid = 0
+            if paid < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+
+@click.command('worker')
+@click.option('--batch-size', type=int, help='Largest number of payouts paid per transaction.')
+@click.option('--interval', type=float, help='Seconds to wait for new payouts when none are owed.')
+@click.option('--once', is_flag=True, help='Pay every owed payout, then exit.')
+def worker_command(batch_size, interval, once):
+    """
+    Pay creators for their sales in the foreground (run with PAYOUT_WORKER=off in the app processes).
+    """
+    batch_size = batch_size or payout_worker.batch_size
+    interval = interval or payout_worker.poll_interval
+    total = 0
+    try:
+        while True:
+            paid = apply_payouts(batch_size)
+            total += paid
+            if paid:
+                click.echo(f'Paid {paid} payouts')
+            # Wait for new payouts once every owed payout is paid (or exit with --once)
+            if paid < batch_size:
+                if once:
+                    break
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    click.echo(f'Paid {total} payouts in total')
+
+
+# Payout worker shared by every request in this process
+payout_worker = PayoutWorker()
@@ -0,0 +1,177 @@
+"""
+sales.py contains the sales rollups behind the creator dashboard. finalize_purchase adds each checkout's sales to two
+small tables in the checkout transaction: GuideSales (units sold and revenue of each study guide) and
+CreatorDailySales (units and revenue of each creator per UTC day). The dashboard reads one creator's rows of those
+tables, so its cost grows with the number of guides the creator sold and the days shown, never with the number of
+purchases. Both tables are built from the same rows as the PayoutOutbox, which keeps every sale ever made, so "flask
+sales rebuild" can recompute them from scratch at any time. Sales of study guides without a creator account are kept
+in GuideSales with no creator (the unattributed sales), so the sales of every guide add up to what buyers were charged
+even though no dashboard shows them. The functions in this file are:
+        - record_sales(): Adds the sales of a checkout to the rollups.
+        - rebuild_sales(): Recomputes the rollups from the payout outbox.
+        - unattributed_sales(): Returns the totals of the sales of study guides without a creator account.
+        - creator_dashboard(): Returns the totals, best selling guides and daily series of a creator.
+        - init_app(): Registers the "flask sales rebuild" command.
+"""
+
+# Imports for the days of the daily series
+from datetime import datetime, timedelta, timezone
+
+# General flask imports
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+# SQLite's INSERT, which supports ON CONFLICT DO UPDATE (upserts)
+from sqlalchemy.dialects.sqlite import insert
+
+# Database imports
+from extensions import db
+# Model imports
+from models import CreatorDailySales, GuideSales, StudyGuide
+
+# Number of days shown in the dashboard's series when the client does not ask for a number, and the most it can ask for
+DEFAULT_DASHBOARD_DAYS = 30
+MAX_DASHBOARD_DAYS = 365
+# Number of best selling guides shown on the dashboard
+DASHBOARD_GUIDE_LIMIT = 50
+
+# Statements recomputing the rollups from the payout outbox (one row per study guide sold in a checkout)
+REBUILD_GUIDE_SALES = text(
+    """INSERT INTO guide_sales (study_guide_id, creator_id, units, revenue, last_sold_at)
+    SELECT study_guide_id, MAX(creator_id), SUM(units), SUM(amount), MAX(created_at)
+    FROM payout_outbox GROUP BY study_guide_id"""
+)
+REBUILD_CREATOR_DAILY_SALES = text(
+    """INSERT INTO creator_daily_sales (creator_id, day, units, revenue)
+    SELECT creator_id, date(created_at), SUM(units), SUM(amount)
+    FROM payout_outbox WHERE creator_id IS NOT NULL GROUP BY creator_id, date(created_at)"""
+)
+
+# Command group for "flask sales ..."
+sales_cli = AppGroup('sales', help='Maintain the creator sales rollups.')
+
+
+def record_sales(sold):
+    """
+    Adds the sales of a checkout to the rollups, with one executemany() upsert per table. sold holds the PayoutOutbox
+    rows of the checkout (dicts with creator_id, study_guide_id, units, amount and created_at). Sales without a
+    creator (creator_id None) only go to GuideSales, as unattributed sales. Runs in the checkout transaction; the
+    caller commits.
+    """
+    if not sold:
+        return
+    # Add up the sales of each guide, and of each creator on each day
+    guides, days = {}, {}
+    for sale in sold:
+        guide = guides.setdefault(sale['study_guide_id'], {
+            'study_guide_id': sale['study_guide_id'], 'creator_id': sale['creator_id'], 'units': 0, 'revenue': 0,
+            'last_sold_at': sale['created_at']})
+        guide['units'] += sale['units']
+        guide['revenue'] += sale['amount']
+        if sale['creator_id'] is not None:
+            day = days.setdefault((sale['creator_id'], sale['created_at'].date()), {
+                'creator_id': sale['creator_id'], 'day': sale['created_at'].date(), 'units': 0, 'revenue': 0})
+            day['units'] += sale['units']
+            day['revenue'] += sale['amount']
+        guide['last_sold_at'] = max(guide['last_sold_at'], sale['created_at'])
+    # Add them to the rows of the guides and days, creating the rows that do not exist yet
+    statement = insert(GuideSales)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[GuideSales.study_guide_id],
+        set_={'units': GuideSales.units + statement.excluded.units,
+              'revenue': GuideSales.revenue + statement.excluded.revenue,
+              'last_sold_at': db.func.max(GuideSales.last_sold_at, statement.excluded.last_sold_at)}
+    ), list(guides.values()))
+    if not days:
+        return
+    statement = insert(CreatorDailySales)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[CreatorDailySales.creator_id, CreatorDailySales.day],
+        set_={'units': CreatorDailySales.units + statement.excluded.units,
+              'revenue': CreatorDailySales.revenue + statement.excluded.revenue}
+    ), list(days.values()))
+
+
+def rebuild_sales(connection=None):
+    """
+    Recomputes both rollups from the payout outbox, with one GROUP BY each, in the caller's transaction (on
+    connection, or on the session by default). Returns the number of guide rows and day rows written. The caller
+    commits.
+    """
+    connection = connection or db.session
+    # Emptying the rollups takes the write lock, so no checkout adds to them while they are rebuilt
+    connection.execute(db.delete(GuideSales))
+    connection.execute(db.delete(CreatorDailySales))
+    guides = connection.execute(REBUILD_GUIDE_SALES).rowcount
+    days = connection.execute(REBUILD_CREATOR_DAILY_SALES).rowcount
+    return guides, days
+
+
+def unattributed_sales():
+    """
+    Returns the units sold, revenue and number of study guides of the sales of guides without a creator account (the
+    GuideSales rows with no creator). Added to the totals of every creator, they give what buyers were charged.
+    """
+    return db.session.execute(
+        db.select(db.func.coalesce(db.func.sum(GuideSales.units), 0).label('units'),
+                  db.func.coalesce(db.func.sum(GuideSales.revenue), 0).label('revenue'),
+                  db.func.count().label('guides'))
+        .where(GuideSales.creator_id.is_(None))
+    ).one()
+
+
+def creator_dashboard(creator_id, days=DEFAULT_DASHBOARD_DAYS, limit=DASHBOARD_GUIDE_LIMIT):
+    """
+    Returns the dashboard of a creator as a dict with:
+    - totals: The units sold, revenue and number of guides sold, over all time
+    - guides: The limit best selling guides (by revenue), with their class, topic, price, units, revenue and last sale
+    - series: (day, units, revenue) for each of the last days UTC days, oldest first (days without sales included)
+    Each part is one index range read of the creator's rollup rows.
+    """
+    totals = db.session.execute(
+        db.select(db.func.coalesce(db.func.sum(GuideSales.units), 0).label('units'),
+                  db.func.coalesce(db.func.sum(GuideSales.revenue), 0).label('revenue'),
+                  db.func.count().label('guides'))
+        .where(GuideSales.creator_id == creator_id)
+    ).one()
+    guides = db.session.execute(
+        db.select(GuideSales.study_guide_id, StudyGuide.Class, StudyGuide.UnitTopic, StudyGuide.Price,
+                  GuideSales.units, GuideSales.revenue, GuideSales.last_sold_at)
+        .join(StudyGuide, StudyGuide.id == GuideSales.study_guide_id)
+        .where(GuideSales.creator_id == creator_id)
+        .order_by(GuideSales.revenue.desc(), GuideSales.study_guide_id)
+        .limit(limit)
+    ).all()
+    # Read the days with sales, then fill in the days without any
+    today = datetime.now(timezone.utc).date()
+    first_day = today - timedelta(days=days - 1)
+    sold = {row.day: row for row in db.session.execute(
+        db.select(CreatorDailySales.day, CreatorDailySales.units, CreatorDailySales.revenue)
+        .where(CreatorDailySales.creator_id == creator_id, CreatorDailySales.day >= first_day)
+    )}
+    series = []
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        series.append((day, sold[day].units, sold[day].revenue) if day in sold else (day, 0, 0))
+    return {'totals': totals, 'guides': guides, 'series': series}
+
+
+@sales_cli.command('rebuild')
+def rebuild_command():
+    """
+    Recompute the creator sales rollups from the payout outbox.
+    """
+    guides, days = rebuild_sales()
+    db.session.commit()
+    click.echo(f'Rebuilt the sales of {guides} study guides over {days} creator days')
+    unattributed = unattributed_sales()
+    if unattributed.guides:
+        click.echo(f'{unattributed.units} copies of {unattributed.guides} study guides without a creator account sold '
+                   f'for {unattributed.revenue} in total')
+
+
+def init_app(app):
+    """
+    Registers the "flask sales" commands.
+    """
+    app.cli.add_command(sales_cli)
@@ -0,0 +1,122 @@
+"""
+search_index.py contains the full-text search index used by the market search. The index is an SQLite FTS5 virtual
+table over the Class, UnitTopic and Creator columns of the study_guide table. It stores no copy of the rows (it is an
+"external content" table), and triggers on study_guide keep it in sync whenever guides are inserted, updated or
+deleted, for example when admin_home approves a guide. The functions in this file are:
+        - rebuild_search_index(): Refills the index from the rows currently in study_guide.
+        - deferred_search_index(): Turns off indexing of new guides during a bulk load, and rebuilds the index after.
+        - build_match_query(): Turns the text typed by a user into an FTS5 prefix query.
+        - search_guides(): Returns the study guides matching a query, best matches first.
+"""
+
+# Regular expressions to split search text into words
+import re
+# Context manager import for deferred indexing
+from contextlib import contextmanager
+
+# SQLAlchemy imports
+from sqlalchemy import DDL, event, text
+
+# Database imports
+from extensions import db
+# Model imports
+from models import StudyGuide
+
+# Number of search results returned when the caller does not ask for a different limit
+DEFAULT_RESULT_LIMIT = 50
+
+# Statements that create the index and the triggers that keep it in sync with study_guide
+SEARCH_INDEX_DDL = (
+    # The index itself. prefix='2 3' stores extra prefix entries so short prefix queries stay fast
+    """CREATE VIRTUAL TABLE IF NOT EXISTS study_guide_fts USING fts5(
+        "Class", "UnitTopic", "Creator",
+        content='study_guide', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    # Add new study guides to the index
+    """CREATE TRIGGER IF NOT EXISTS study_guide_fts_ai AFTER INSERT ON study_guide BEGIN
+        INSERT INTO study_guide_fts(rowid, "Class", "UnitTopic", "Creator")
+        VALUES (new.id, new."Class", new."UnitTopic", new."Creator");
+    END""",
+    # Remove deleted study guides from the index
+    """CREATE TRIGGER IF NOT EXISTS study_guide_fts_ad AFTER DELETE ON study_guide BEGIN
+        INSERT INTO study_guide_fts(study_guide_fts, rowid, "Class", "UnitTopic", "Creator")
+        VALUES ('delete', old.id, old."Class", old."UnitTopic", old."Creator");
+    END""",
+    # Replace the index entry of study guides whose searched columns are updated
+    """CREATE TRIGGER IF NOT EXISTS study_guide_fts_au
+    AFTER UPDATE OF "Class", "UnitTopic", "Creator" ON study_guide BEGIN
+        INSERT INTO study_guide_fts(study_guide_fts, rowid, "Class", "UnitTopic", "Creator")
+        VALUES ('delete', old.id, old."Class", old."UnitTopic", old."Creator");
+        INSERT INTO study_guide_fts(rowid, "Class", "UnitTopic", "Creator")
+        VALUES (new.id, new."Class", new."UnitTopic", new."Creator");
+    END""",
+)
+
+# Query returning the matching study guides ordered by BM25 rank (rank is bm25() for FTS5 tables)
+SEARCH_QUERY = text(
+    """SELECT study_guide.id, study_guide."Class", study_guide."UnitTopic", study_guide."Price", study_guide."Creator"
+    FROM study_guide_fts JOIN study_guide ON study_guide.id = study_guide_fts.rowid
+    WHERE study_guide_fts MATCH :match
+    ORDER BY study_guide_fts.rank
+    LIMIT :limit OFFSET :offset"""
+)
+
+
+def rebuild_search_index(connection):
+    """
+    Refills the index from the rows currently in study_guide. Only needed after rows were written with the triggers
+    missing, for example by a bulk load into a database created before the index existed.
+    """
+    connection.execute(text("INSERT INTO study_guide_fts(study_guide_fts) VALUES ('rebuild')"))
+
+
+@contextmanager
+def deferred_search_index(connection):
+    """
+    Drops the trigger that indexes new study guides while the block runs, then recreates it and rebuilds the index.
+    Indexing a million guides at once after a bulk load is much faster than indexing them one row at a time, but
+    searches miss the new guides until the block ends. Does nothing on databases other than SQLite.
+    """
+    if connection.dialect.name != 'sqlite':
+        yield
+        return
+    connection.execute(text('DROP TRIGGER IF EXISTS study_guide_fts_ai'))
+    connection.commit()
+    try:
+        yield
+    finally:
+        # Put the trigger back (SEARCH_INDEX_DDL[1]) and index every guide, including any written while it was missing
+        connection.rollback()
+        connection.execute(text(SEARCH_INDEX_DDL[1]))
+        rebuild_search_index(connection)
+        connection.commit()
+
+
+# Create the index (only on SQLite) whenever db.create_all() creates the study_guide table. Existing databases get it
+# from the "Create study guide search index" migration
+for _statement in SEARCH_INDEX_DDL:
+    event.listen(StudyGuide.__table__, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+
+
+def build_match_query(query):
+    """
+    Turns the text typed by a user into an FTS5 prefix query. Every word must match the start of a word in one of the
+    indexed columns, so "comp sci" finds "Computer Science". Words are quoted so FTS5 operators typed by users are
+    treated as plain text. Returns None when the text contains no words.
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_guides(query, limit=DEFAULT_RESULT_LIMIT, offset=0):
+    """
+    Returns the study guides matching a query, best matches first, with at most limit results after skipping the
+    first offset. Only the columns shown in the search results are returned.
+    """
+    match = build_match_query(query)
+    if match is None:
+        return []
+    return db.session.execute(SEARCH_QUERY, {'match': match, 'limit': limit, 'offset': offset}).all()
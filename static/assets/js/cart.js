@@ -0,0 +1,50 @@
+/*
+ Add-to-cart buttons. Each button has the id of its study guide in data-add-to-cart and the URL of the cart endpoint in
+ data-url. Clicking it posts the id with fetch() (sending the page's CSRF token in the X-CSRFToken header) and updates
+ the button from the JSON answer, so the page is not reloaded.
+*/
+(function () {
+	'use strict';
+	var token = document.querySelector('meta[name="csrf-token"]');
+
+	function finish(button, text) {
+		button.textContent = text;
+		button.disabled = true;
+	}
+
+	document.addEventListener('click', function (event) {
+		var button = event.target.closest('[data-add-to-cart]');
+		if (!button || button.disabled) {
+			return;
+		}
+		button.disabled = true;
+		fetch(button.dataset.url, {
+			method: 'POST',
+			credentials: 'same-origin',
+			headers: {
+				'Content-Type': 'application/json',
+				'X-CSRFToken': token ? token.content : ''
+			},
+			body: JSON.stringify({study_guide_id: Number(button.dataset.addToCart)})
+		}).then(function (response) {
+			if (response.ok) {
+				return response.json().then(function (data) {
+					finish(button, data.added.length ? 'Added to Cart' : 'Already in Cart');
+				});
+			}
+			if (response.status === 401) {
+				// The session ended: log in again
+				window.location.reload();
+			} else if (response.status === 409) {
+				finish(button, 'Owned');
+			} else {
+				// Let the user try again
+				button.disabled = false;
+				button.textContent = 'Try again';
+			}
+		}).catch(function () {
+			button.disabled = false;
+			button.textContent = 'Try again';
+		});
+	});
+}());
@@ -0,0 +1,26 @@
+/*
+ Marks the study guides the user owns in the catalog listing. The listing is cached and shared by every user, so the
+ page carries the ids of the owned guides on it as JSON (in #owned-guides), and each listed guide has a data-guide-id.
+ The add-to-cart button of an owned guide is replaced by an "Owned" badge.
+*/
+(function () {
+	'use strict';
+	var data = document.getElementById('owned-guides');
+	if (!data) {
+		return;
+	}
+	JSON.parse(data.textContent).forEach(function (guideId) {
+		var item = document.querySelector('[data-guide-id="' + guideId + '"]');
+		if (item) {
+			var badge = document.createElement('span');
+			badge.className = 'badge bg-success mt-2';
+			badge.textContent = 'Owned';
+			var button = item.querySelector('[data-add-to-cart]');
+			if (button) {
+				button.replaceWith(badge);
+			} else {
+				item.appendChild(badge);
+			}
+		}
+	});
+}());
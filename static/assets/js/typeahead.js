@@ -0,0 +1,51 @@
+/*
+ Search suggestions. The search input has the URL of the suggestion endpoint in data-suggest-url and is linked to a
+ <datalist>. While the user types, the text is sent with fetch() (once they pause for a moment, and only the latest
+ answer is used) and the datalist is filled with the classes, topics and creators it starts.
+*/
+(function () {
+	'use strict';
+	var input = document.querySelector('[data-suggest-url]');
+	var list = input && document.getElementById(input.getAttribute('list'));
+	if (!list) {
+		return;
+	}
+	var timer = null;
+	var latest = 0;
+
+	function show(suggestions) {
+		list.replaceChildren.apply(list, suggestions.map(function (suggestion) {
+			var option = document.createElement('option');
+			option.value = suggestion.text;
+			return option;
+		}));
+	}
+
+	function fetchSuggestions(text) {
+		var request = ++latest;
+		fetch(input.dataset.suggestUrl + '?q=' + encodeURIComponent(text) + '&limit=8', {credentials: 'same-origin'})
+			.then(function (response) {
+				return response.ok ? response.json() : {data: []};
+			})
+			.then(function (answer) {
+				// Ignore answers to text the user has typed past
+				if (request === latest) {
+					show(answer.data);
+				}
+			})
+			.catch(function () {
+				// Suggestions are optional, so a failed request just shows none
+			});
+	}
+
+	input.addEventListener('input', function () {
+		var text = input.value.trim();
+		clearTimeout(timer);
+		if (!text) {
+			latest++;
+			show([]);
+			return;
+		}
+		timer = setTimeout(fetchSuggestions, 100, text);
+	});
+}());
@@ -0,0 +1,105 @@
+"""
+test_session_cart.py checks that a session cart (CART_STORE = 'session') is bought at most once when its checkout is
+sent twice, and that the copy of the bought cart left in the browser never blocks the next purchase. The tests in this
+file are:
+        - test_double_checkout_then_stale_cookie(): Double-submits a checkout, replays the old cookie, then buys again.
+"""
+
+# Test framework import
+import pytest
+
+# Import the app factory and the testing config the test app is built from
+from ASD4ME import create_app
+from cart import CART_SESSION_KEY
+from config import TestingConfig
+# Database imports
+from extensions import db
+# Model imports
+from models import Inventory, StudyGuide, User
+
+# Starting wallet of the buyer, and the price of every study guide
+WALLET = 100
+PRICE = 10
+
+
+class SessionCartConfig(TestingConfig):
+    """
+    Testing config that keeps carts in the session.
+    """
+    CART_STORE = 'session'
+
+
+@pytest.fixture
+def app():
+    """
+    Returns an app with an empty in-memory database holding a buyer (id 1), a creator (id 2) and three study guides.
+    """
+    app = create_app(SessionCartConfig)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([User(id=1, username='buyer', password='x', wallet=WALLET),
+                            User(id=2, username='creator', password='x')])
+        db.session.add_all([StudyGuide(id=guide_id, Class='Math', UnitTopic=f'Unit{guide_id}', Price=PRICE,
+                                       Creator='creator', Link='', creator_id=2) for guide_id in (1, 2, 3)])
+        db.session.commit()
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+def _client(app, cookie=None):
+    """
+    Returns a test client logged in as the buyer, sending the given session cookie if there is one.
+    """
+    client = app.test_client()
+    if cookie is None:
+        with client.session_transaction() as session:
+            session['_user_id'] = '1'
+            session['_fresh'] = True
+    else:
+        client.set_cookie('session', cookie)
+    return client
+
+
+def _cart(client):
+    """
+    Returns the cart stored in a client's session, or None if it has none.
+    """
+    with client.session_transaction() as session:
+        return session.get(CART_SESSION_KEY)
+
+
+def _wallet_and_owned(app):
+    """
+    Returns the buyer's wallet and the ids of the study guides they own.
+    """
+    with app.app_context():
+        wallet = db.session.scalar(db.select(User.wallet).where(User.id == 1))
+        owned = set(db.session.scalars(db.select(Inventory.study_guide_id).where(Inventory.user_id == 1)))
+    return wallet, owned
+
+
+def test_double_checkout_then_stale_cookie(app):
+    """
+    Sends the checkout of a two-guide cart twice from the same cookie, replays that cookie (as the browser does when
+    the losing checkout's response arrives last), adds a guide and checks out: the first cart is bought once, and the
+    new guide is bought on its own.
+    """
+    client = _client(app)
+    assert client.post('/market/cart/items', json={'study_guide_ids': [1, 2]}).status_code == 200
+    stale = client.get_cookie('session').value
+    first, second = _client(app, stale), _client(app, stale)
+    assert first.post('/market/finalize_purchase').status_code == 302
+    assert second.post('/market/finalize_purchase').status_code == 302
+    assert _wallet_and_owned(app) == (WALLET - 2 * PRICE, {1, 2})
+    # The losing checkout dropped the bought cart from its session instead of sending it back
+    assert _cart(second) is None
+
+    # The browser still holds the old cookie: the bought cart is dropped, and the new guide starts a new cart
+    replayed = _client(app, stale)
+    assert replayed.post('/market/cart/items', json={'study_guide_id': 3}).status_code == 200
+    user_id, guide_ids, nonce = _cart(replayed)
+    assert guide_ids == [3] and nonce != _cart(_client(app, stale))[2]
+    assert replayed.post('/market/finalize_purchase').status_code == 302
+    assert _wallet_and_owned(app) == (WALLET - 3 * PRICE, {1, 2, 3})
+    assert _cart(replayed) is None
@@ -0,0 +1,339 @@
+"""
+typeahead.py contains the in-memory search suggestions shown while users type in the search bar. The distinct
+classes, topics and creators of the catalog are kept in a compressed prefix trie (a radix tree: each edge holds a
+whole run of characters, so there are at most about twice as many nodes as keys). Every node stores the ids of the k
+best terms below it, ranked by the number of copies sold of their study guides, so a suggestion is one walk down the
+prefix and never touches the database. Terms are reachable from the start of each of their words ("alg" suggests
+"Linear Algebra"). The index is built from the database in a background thread of each worker process (started as
+gunicorn forks the worker, or by its first suggestion), so no request ever waits for a build, then kept up to date
+without rebuilding it:
+        - Study guides approved since the index was built (by this process or another one) are added when the catalog
+        version (the largest study guide id) changes, with one query for just the new guides. The approving process
+        adds them right away.
+        - Sales made by this process raise the weights of their terms right away. Sales made by other processes are
+        picked up by the full rebuild every TYPEAHEAD_REBUILD_INTERVAL seconds, which also runs in the background
+        while the old index keeps answering.
+The classes in this file are:
+        - PrefixIndex: Compressed prefix trie of weighted terms, answering top-k suggestions for a prefix.
+        - Typeahead: Extension that builds the index, keeps it up to date and answers suggestions.
+"""
+
+# Imports for thread safety and the time of the last build
+import threading
+import time
+
+# Database imports
+from sqlalchemy.exc import OperationalError
+from extensions import db
+# Catalog version import, to notice approved study guides
+from catalog import catalog_version
+# Model imports
+from models import Inventory, StudyGuide
+
+# Fields of the study guides that are suggested
+SUGGESTED_FIELDS = ('Class', 'UnitTopic', 'Creator')
+# Seconds to wait before trying again after a build failed because the catalog tables are missing
+BUILD_RETRY_DELAY = 60
+
+
+def normalize(text):
+    """
+    Returns the key of a term or prefix: lower case, with runs of whitespace turned into single spaces.
+    """
+    return ' '.join(text.lower().split())
+
+
+class _Node:
+    """
+    Node of the prefix trie.
+    - children: Maps the first character of each edge to (the edge's characters, the child node)
+    - top: The ids of the best terms below this node, best first (at most k)
+    """
+    __slots__ = ('children', 'top')
+
+    def __init__(self, top=()):
+        self.children = {}
+        self.top = list(top)
+
+
+class PrefixIndex:
+    """
+    Compressed prefix trie of weighted terms, answering the k best terms starting with a prefix.
+    - k: The number of terms kept at each node (the most suggestions one lookup can return)
+    - terms: The terms, by id, as [text, field, weight, guides]
+    Writers (add() and add_weight()) must not run at the same time; readers never need a lock, because nodes are
+    only ever changed by replacing a top list or adding a fully built child.
+    """
+
+    def __init__(self, k=10):
+        self.k = k
+        self.terms = []
+        # Maps (field, key) to the id of the term
+        self._ids = {}
+        self._root = _Node()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _rank(self, term_id):
+        """
+        Returns the sort key of a term: most copies sold first, then most study guides, then alphabetical.
+        """
+        text, field, weight, guides = self.terms[term_id]
+        return -weight, -guides, text.lower()
+
+    def _offer(self, node, term_id):
+        """
+        Puts a term in a node's top list if it ranks among the k best below the node (the list is replaced, not
+        changed in place, so readers never see a half sorted list).
+        """
+        top = node.top if term_id in node.top else node.top + [term_id]
+        node.top = sorted(top, key=self._rank)[:self.k]
+
+    def _insert(self, key, term_id):
+        """
+        Adds a key leading to a term, splitting an edge where the key leaves it, and offers the term to every node
+        on the way.
+        """
+        node = self._root
+        self._offer(node, term_id)
+        while key:
+            edge = node.children.get(key[0])
+            if edge is None:
+                # Hang the rest of the key under a new leaf
+                node.children[key[0]] = (key, _Node([term_id]))
+                return
+            label, child = edge
+            common = 1
+            while common < len(label) and common < len(key) and label[common] == key[common]:
+                common += 1
+            if common < len(label):
+                # Split the edge: the new middle node has the same terms below it as the old child
+                middle = _Node(child.top)
+                middle.children[label[common]] = (label[common:], child)
+                node.children[key[0]] = (label[:common], middle)
+                child = middle
+            node = child
+            key = key[common:]
+            self._offer(node, term_id)
+
+    def _path(self, key):
+        """
+        Yields the nodes on the way to a key that is in the trie.
+        """
+        node = self._root
+        yield node
+        while key:
+            label, node = node.children[key[0]]
+            key = key[len(label):]
+            yield node
+
+    @staticmethod
+    def _keys(key):
+        """
+        Returns the keys a term is reached from: the term from the start of each of its words.
+        """
+        return [key[index:] for index in range(len(key)) if index == 0 or key[index - 1] == ' ']
+
+    def add(self, text, field, weight=0, guides=1):
+        """
+        Adds a term (or adds the weight and study guides to it if the field already has it), and returns its id.
+        """
+        key = normalize(text)
+        if not key:
+            return None
+        term_id = self._ids.get((field, key))
+        if term_id is not None:
+            self.add_weight(term_id, weight, guides)
+            return term_id
+        term_id = len(self.terms)
+        self.terms.append([' '.join(text.split()), field, weight, guides])
+        self._ids[(field, key)] = term_id
+        for suffix in self._keys(key):
+            self._insert(suffix, term_id)
+        return term_id
+
+    def term_id(self, text, field):
+        """
+        Returns the id of a term, or None if it is not in the index.
+        """
+        return self._ids.get((field, normalize(text)))
+
+    def add_weight(self, term_id, weight=0, guides=0):
+        """
+        Raises the weight (and the number of study guides) of a term, and moves it up the top lists it is in or can
+        now enter.
+        """
+        term = self.terms[term_id]
+        term[2] += weight
+        term[3] += guides
+        for suffix in self._keys(normalize(term[0])):
+            for node in self._path(suffix):
+                self._offer(node, term_id)
+
+    def suggest(self, prefix, limit=None):
+        """
+        Returns the best terms starting with prefix (or with one of their words starting with it), as (text, field,
+        weight) tuples, best first.
+        """
+        key = normalize(prefix)
+        node = self._root
+        while key:
+            edge = node.children.get(key[0])
+            if edge is None:
+                return []
+            label, child = edge
+            if label.startswith(key):
+                # The prefix ends inside (or at the end of) this edge, so every term below the child matches
+                node = child
+                break
+            if not key.startswith(label):
+                return []
+            node = child
+            key = key[len(label):]
+        return [tuple(self.terms[term_id][:3]) for term_id in node.top[:limit]]
+
+
+class Typeahead:
+    """
+    Extension that builds the prefix index of the catalog, keeps it up to date and answers suggestions. init_app()
+    reads these config keys:
+    - TYPEAHEAD_SIZE: The number of suggestions kept for each prefix (the most one request can get)
+    - TYPEAHEAD_REBUILD_INTERVAL: The number of seconds after which the index is rebuilt from the database, to pick up
+    sales made by other worker processes (None never rebuilds it)
+    Builds run in a background thread, never in a request: gunicorn starts the first one as each worker is forked (see
+    gunicorn.conf.py), or the first suggestion asked for does. Until it finishes suggest() returns no suggestions, and
+    while a rebuild runs the old index keeps answering.
+    """
+
+    def __init__(self, k=10, rebuild_interval=3600):
+        self.app = None
+        self.k = k
+        self.rebuild_interval = rebuild_interval
+        self.index = None
+        # Largest study guide id in the index, and the monotonic time it was built
+        self._max_id = 0
+        self._built_at = 0.0
+        # Whether a build is running, and the monotonic time before which a failed build is not tried again
+        self._building = False
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Reads the settings from the app config. The index is not built here, so CLI commands and the gunicorn master
+        never build one.
+        """
+        self.app = app
+        self.k = app.config.get('TYPEAHEAD_SIZE', self.k)
+        self.rebuild_interval = app.config.get('TYPEAHEAD_REBUILD_INTERVAL', self.rebuild_interval)
+
+    def _expired(self):
+        """
+        Returns True if there is no index yet, or the rebuild interval has passed since it was built.
+        """
+        if self.index is None:
+            return True
+        return self.rebuild_interval is not None and time.monotonic() - self._built_at >= self.rebuild_interval
+
+    def start(self):
+        """
+        Starts building the index in a background thread if it is missing or expired, unless a build is already
+        running or the last one failed less than BUILD_RETRY_DELAY seconds ago. Returns True if a build was started.
+        """
+        with self._lock:
+            # Checked under the lock, so of many requests that find the index expired only the first starts a build
+            if self._building or not self._expired() or time.monotonic() < self._retry_at:
+                return False
+            self._building = True
+        threading.Thread(target=self._build_in_background, name='typeahead-build', daemon=True).start()
+        return True
+
+    def _build_in_background(self):
+        """
+        Builds the index in the app's context (run by the thread start() starts).
+        """
+        try:
+            with self.app.app_context():
+                self.build()
+        except OperationalError:
+            # The catalog tables do not exist yet (an empty or unmigrated database), so try again later
+            self._retry_at = time.monotonic() + BUILD_RETRY_DELAY
+            self.app.logger.warning('Typeahead index not built: the catalog tables are missing')
+        finally:
+            with self._lock:
+                self._building = False
+
+    def build(self):
+        """
+        Builds a new index from the database (one query per suggested field, each grouping the catalog by the field
+        and summing the copies sold), then swaps it in. The old index keeps answering until then.
+        """
+        sold = (db.select(Inventory.study_guide_id, db.func.sum(Inventory.quantity).label('copies'))
+                .group_by(Inventory.study_guide_id).subquery())
+        index = PrefixIndex(self.k)
+        max_id = db.session.scalar(db.select(db.func.max(StudyGuide.id))) or 0
+        for field in SUGGESTED_FIELDS:
+            column = getattr(StudyGuide, field)
+            rows = db.session.execute(
+                db.select(column, db.func.coalesce(db.func.sum(sold.c.copies), 0), db.func.count())
+                .outerjoin(sold, sold.c.study_guide_id == StudyGuide.id)
+                .where(StudyGuide.id <= max_id)
+                .group_by(column)
+            )
+            for text, copies, guides in rows:
+                index.add(text, field, weight=copies, guides=guides)
+        with self._lock:
+            self.index, self._max_id, self._built_at = index, max_id, time.monotonic()
+
+    def refresh(self):
+        """
+        Keeps the index up to date: starts a background rebuild when it is missing or the rebuild interval has passed,
+        and adds the study guides approved since the index last saw the catalog (usually without a query, since the
+        catalog version is cached).
+        """
+        self.start()
+        if self.index is None or catalog_version.get() <= self._max_id:
+            return
+        with self._lock:
+            # Another request may have added the new guides while this one waited for the lock
+            if catalog_version.get() <= self._max_id:
+                return
+            new_guides = db.session.execute(
+                db.select(StudyGuide.id, *(getattr(StudyGuide, field) for field in SUGGESTED_FIELDS))
+                .where(StudyGuide.id > self._max_id)
+                .order_by(StudyGuide.id)
+            ).all()
+            for guide in new_guides:
+                for field in SUGGESTED_FIELDS:
+                    self.index.add(getattr(guide, field), field)
+                self._max_id = guide.id
+
+    def record_sales(self, lines):
+        """
+        Raises the weights of the terms of the study guides sold (lines with Class, UnitTopic, Creator and quantity),
+        so this process's suggestions follow its sales right away.
+        """
+        if self.index is None:
+            return
+        with self._lock:
+            for line in lines:
+                for field in SUGGESTED_FIELDS:
+                    term_id = self.index.term_id(getattr(line, field), field)
+                    if term_id is not None:
+                        self.index.add_weight(term_id, weight=line.quantity)
+
+    def suggest(self, prefix, limit=None):
+        """
+        Returns the best suggestions for a prefix as (text, field, weight) tuples, or [] while the index is being
+        built for the first time.
+        """
+        self.refresh()
+        index = self.index
+        if index is None:
+            return []
+        return index.suggest(prefix, limit)
+
+
+# Search suggestions shared by every request in this process
+typeahead = Typeahead()